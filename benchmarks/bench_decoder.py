@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compares the wire format decoder with the generated kurapayload_pb2 classes.
+
+    python benchmarks/bench_decoder.py [--metrics 5 50 200] [--messages 2000]
+"""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from corpora import build_payload
+import kura_payload_handler
+
+
+def measure(decoder, payloads):
+    started = time.perf_counter()
+    for payload in payloads:
+        decoder(payload)
+    return (time.perf_counter() - started) / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--metrics", type=int, nargs="+", default=[5, 50, 200], help="metrics per payload")
+    parser.add_argument("--messages", type=int, default=2000, help="payloads decoded per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, the best one is reported")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    print("{:<16} {:>14} {:>14} {:>9}".format("corpus", "pb2 (us/msg)", "wire (us/msg)", "speedup"))
+    for metrics in args.metrics:
+        payloads = [build_payload(metrics, rnd) for _ in range(args.messages)]
+        for name, corpus in (("{} metrics".format(metrics), payloads),
+                             ("{} metrics gz".format(metrics), [gzip.compress(p) for p in payloads])):
+            for payload in corpus[:10]:
+                assert kura_payload_handler.decode_payload(payload) == kura_payload_handler.decode_payload_fast(payload)
+            generated = min(measure(kura_payload_handler.decode_payload, corpus) for _ in range(args.repeat))
+            wire = min(measure(kura_payload_handler.decode_payload_fast, corpus) for _ in range(args.repeat))
+            print("{:<16} {:>14.1f} {:>14.1f} {:>8.2f}x".format(name, generated * 1e6, wire * 1e6, generated / wire))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""End-to-end throughput of the gateway against in-process stand-in brokers.
+
+The real KuraDevicesHandler, KuraDevice and TbGatewayHandler run in this
+process, connected to two FakeBroker instances (Kura side and ThingsBoard
+side) running with the synthetic fleet in a child process, so the CPU time
+and RSS reported are the gateway's own.
+
+    python benchmarks/bench_e2e.py --devices 100 --channels 20 --rate 2 --duration 30 [--gzip]
+        [--set DECODER=wire --set INGEST_DECODE_WORKERS=4] [--set RUNTIME=asyncio] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fake_broker import FakeBroker
+from kura_fleet import KuraFleet, SENT_AT_CHANNEL
+import tb_proto
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_TOPIC = "v1/gateway/telemetry"
+CONNECT_TOPIC = "v1/gateway/connect"
+RSS_SAMPLE_INTERVAL = 0.5
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class TelemetrySink(object):
+    """Collects what the gateway publishes to the ThingsBoard broker"""
+
+    def __init__(self, codec="json"):
+        self.codec = codec
+        self.connected = set()
+        self.received = 0
+        self.received_bytes = 0
+        self.latencies = []
+        self.measuring = False
+
+    def handle_publish(self, topic, payload):
+        if topic == TELEMETRY_TOPIC:
+            now = time.time()
+            if self.measuring:
+                self.received_bytes += len(payload)
+            telemetry = tb_proto.decode_gateway_telemetry(payload) if self.codec == "protobuf" else json.loads(payload)
+            for records in telemetry.values():
+                for record in records:
+                    sent_at = record.get("values", {}).get(SENT_AT_CHANNEL)
+                    if sent_at is None or not self.measuring:
+                        continue
+                    self.received += 1
+                    self.latencies.append(now - sent_at)
+        elif topic == CONNECT_TOPIC:
+            connect = tb_proto.decode_connect(payload) if self.codec == "protobuf" else json.loads(payload)
+            self.connected.add(connect["device"])
+
+
+async def run_fleet(connection, args):
+    sink = TelemetrySink(dict(parse_setting(setting) for setting in args.set).get("THINGSBOARD_CODEC", "json"))
+    tb_broker = FakeBroker(on_publish=sink.handle_publish)
+    kura_broker = FakeBroker()
+    fleet = KuraFleet(kura_broker, args.devices, args.channels, args.rate, args.gzip)
+    kura_broker.on_publish = fleet.handle_publish
+    await kura_broker.start()
+    await tb_broker.start()
+    loop = asyncio.get_event_loop()
+
+    connection.send(("ports", kura_broker.port, tb_broker.port))
+    await loop.run_in_executor(None, connection.recv)
+
+    started = time.monotonic()
+    # The BIRTH messages published before the gateway subscribes would be missed
+    while not any(topic.endswith("/MQTT/BIRTH") for session in kura_broker.sessions for topic in session.subscriptions):
+        if time.monotonic() - started > args.startup_timeout:
+            break
+        await asyncio.sleep(0.01)
+    await fleet.birth()
+    while len(fleet.assets_served) < args.devices or len(sink.connected) < args.devices:
+        if time.monotonic() - started > args.startup_timeout:
+            break
+        await asyncio.sleep(0.05)
+    startup = time.monotonic() - started
+
+    connection.send(("measuring",))
+    sink.measuring = True
+    duration = await fleet.run(args.duration)
+    sent = fleet.sent
+    drain_started = time.monotonic()
+    while sink.received < sent and time.monotonic() - drain_started < args.drain_timeout:
+        await asyncio.sleep(0.05)
+    sink.measuring = False
+    elapsed = time.monotonic() - started - startup
+
+    latencies = sorted(sink.latencies)
+    connection.send(("results", {
+        "startup_seconds": startup,
+        "devices_connected": len(sink.connected),
+        "sent": sent,
+        "received": sink.received,
+        "lost": sent - sink.received,
+        "send_rate": sent / duration,
+        "msgs_per_second": sink.received / elapsed,
+        "uplink_bytes_per_message": sink.received_bytes / sink.received if sink.received else None,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "latency_max_ms": latencies[-1] * 1000 if latencies else None,
+    }))
+    await loop.run_in_executor(None, connection.recv)
+    await kura_broker.stop()
+    await tb_broker.stop()
+
+
+def fleet_process(connection, args):
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run_fleet(connection, args))
+
+
+def read_rss():
+    """Current resident set size in bytes, the peak one where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler(object):
+
+    def __init__(self):
+        self.samples = []
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="rss-sampler")
+        self.__thread.daemon = True
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def __run(self):
+        while not self.__stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.samples.append(read_rss())
+
+
+def parse_setting(setting):
+    key, _, value = setting.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def gateway_configuration(args, folder):
+    configuration = {
+        "KURA_PREFIX": "$EDC",
+        "ASSET_CACHE_FOLDER": os.path.join(folder, "asset_cache"),
+        "THINGSBOARD_QUEUE_FOLDER": os.path.join(folder, "outbound_queue"),
+        "KURA_BOOTSTRAP_CONCURRENCY": 0,
+        "KURA_BOOTSTRAP_RATE": 0,
+    }
+    configuration.update(parse_setting(setting) for setting in args.set)
+    return configuration
+
+
+def run_gateway(args, kura_port, tb_port, folder):
+    # Imported here so the fleet process doesn't load the gateway
+    import paho.mqtt.client as mqtt_client
+    from kura_devices_handler import KuraDevicesHandler
+    from mqtt_loop import MqttLoop
+    from scheduler import LoopScheduler, Scheduler
+    from tb_gateway_handler import TbGatewayHandler
+
+    configuration = gateway_configuration(args, folder)
+    loop = None
+    if configuration.get("RUNTIME") == "asyncio":
+        # The loop runs in its own thread, the way main.py runs it in the main one
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever, name="event-loop")
+        loop_thread.daemon = True
+        loop_thread.start()
+        scheduler = LoopScheduler(loop)
+    else:
+        scheduler = Scheduler()
+    scheduler.start()
+    client = mqtt_client.Client("bench-gateway")
+    kura_loop = MqttLoop(loop, client) if loop is not None else None
+    client.connect("127.0.0.1", kura_port, 60)
+    if kura_loop is not None:
+        kura_loop.start()
+    else:
+        client.loop_start()
+    kura_devices_handler = KuraDevicesHandler(configuration["KURA_PREFIX"], client,
+                                              os.path.join(folder, "registered_devices.json"), configuration, scheduler,
+                                              flow_control=kura_loop)
+    tb_gateway = TbGatewayHandler("127.0.0.1", "bench-token", kura_devices_handler, tb_port, configuration, scheduler, loop)
+    tb_gateway.start()
+    kura_devices_handler.start()
+
+    def stop():
+        if kura_loop is not None:
+            kura_loop.stop()
+        else:
+            client.loop_stop()
+        tb_gateway.stop()
+        kura_devices_handler.stop()
+        scheduler.stop()
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            loop_thread.join()
+    return configuration, stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=20, help="channels per device")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second and device")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of publishing measured")
+    parser.add_argument("--gzip", action="store_true", help="gzip the Kura payloads")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="gateway configuration setting, the value parsed as JSON when possible")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--drain-timeout", type=float, default=10.0)
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    folder = tempfile.mkdtemp(prefix="kura-bench-")
+    context = multiprocessing.get_context("spawn")
+    connection, child_connection = context.Pipe()
+    fleet = context.Process(target=fleet_process, args=(child_connection, args), name="kura-fleet")
+    fleet.start()
+    try:
+        _, kura_port, tb_port = connection.recv()
+        configuration, stop_gateway = run_gateway(args, kura_port, tb_port, folder)
+        connection.send("ready")
+
+        connection.recv()
+        sampler = RssSampler()
+        sampler.start()
+        cpu_started = time.process_time()
+        wall_started = time.monotonic()
+        _, results = connection.recv()
+        threads = threading.active_count()
+        cpu = time.process_time() - cpu_started
+        wall = time.monotonic() - wall_started
+        sampler.stop()
+
+        connection.send("done")
+        stop_gateway()
+        fleet.join()
+    finally:
+        if fleet.is_alive():
+            fleet.terminate()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    results.update({
+        "threads": threads,
+        "cpu_seconds": cpu,
+        "cpu_percent": 100.0 * cpu / wall,
+        "rss_mean_mb": sum(sampler.samples) / len(sampler.samples) / 2 ** 20 if sampler.samples else None,
+        "rss_max_mb": max(sampler.samples) / 2 ** 20 if sampler.samples else None,
+    })
+    report = {
+        "benchmark": "e2e",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parameters": { "devices": args.devices, "channels": args.channels, "rate": args.rate,
+                        "duration": args.duration, "gzip": args.gzip },
+        "configuration": configuration,
+        "environment": { "python": platform.python_version(), "platform": platform.platform(),
+                         "cpus": os.cpu_count() },
+        "results": results,
+    }
+    print(json.dumps(report["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of the per message hot paths, with a regression check.
+
+Every case runs over the small (5 metrics), wide (200 metrics) and gzipped
+wide corpora where it applies, and reports the best time per operation out
+of the repeated runs. Baselines are machine specific: save one on the machine
+the checks will run on.
+
+    python benchmarks/bench_micro.py [--messages 500] [--repeat 5] [--cases decode extract]
+    python benchmarks/bench_micro.py --save-baseline baseline.json
+    python benchmarks/bench_micro.py --check baseline.json [--threshold 0.25]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from corpora import build_assets, build_corpora
+import kura_payload_handler
+from kura_device import KuraDevice
+from tb_mqtt_client.tb_device_mqtt import TBDeviceMqttClient, DEVICE_TS_KV_VALIDATOR, KV_VALIDATOR, STRUCTURAL_VALIDATORS
+from tb_mqtt_client.tb_json import BACKENDS, JsonSerializer
+
+DEVICE = "device-00001"
+
+
+def measure(operation, items, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            operation(item)
+        elapsed = (time.perf_counter() - started) / len(items)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def device_for(metrics):
+    device = KuraDevice("$EDC", DEVICE, "account", None, None)
+    device._KuraDevice__load_assets(build_assets(metrics))
+    return device
+
+
+def extracted_telemetry(device, payloads):
+    """Channel values of the corpus as the gateway forwards them"""
+    return [device._KuraDevice__extract_metrics_values(kura_payload_handler.decode_payload(payload))[0]
+            for payload in payloads]
+
+
+def serializers():
+    """One JsonSerializer per installed backend"""
+    for backend in BACKENDS:
+        try:
+            yield JsonSerializer(backend)
+        except ValueError:
+            pass
+
+
+def cases(corpora):
+    """Yields (case, corpus, operation, items)"""
+    for corpus, (metrics, payloads) in corpora.items():
+        yield "decode_message", corpus, kura_payload_handler.decode_message, payloads
+        yield "decode_payload", corpus, kura_payload_handler.decode_payload, payloads
+        yield "decode_payload_fast", corpus, kura_payload_handler.decode_payload_fast, payloads
+
+        device = device_for(metrics)
+        decoded = [kura_payload_handler.decode_payload(payload) for payload in payloads]
+        yield "extract_metrics_values", corpus, device._KuraDevice__extract_metrics_values, decoded
+
+        if corpus.endswith("_gzip"):
+            continue
+        values = extracted_telemetry(device, payloads)
+        ts = int(time.time() * 1000)
+        records = [[{ "ts": ts, "values": item }] for item in values]
+        yield "validate_kv", corpus, lambda item: TBDeviceMqttClient.validate(KV_VALIDATOR, item), values
+        # Run on the records of every device of a gateway telemetry message
+        yield ("validate_device_ts_kv", corpus,
+               lambda item: TBDeviceMqttClient.validate(DEVICE_TS_KV_VALIDATOR, item), records)
+        yield ("validate_kv_structural", corpus,
+               lambda item: TBDeviceMqttClient.validate(STRUCTURAL_VALIDATORS[id(KV_VALIDATOR)], item), values)
+        yield ("validate_device_ts_kv_structural", corpus,
+               lambda item: TBDeviceMqttClient.validate(STRUCTURAL_VALIDATORS[id(DEVICE_TS_KV_VALIDATOR)], item), records)
+        # What publish_data encodes before handing the message to paho
+        batches = [{ DEVICE: item } for item in records]
+        for serializer in serializers():
+            yield "publish_data_json_{}".format(serializer.backend), corpus, serializer.dumps, batches
+
+    requests = [{ "request.id": uuid.uuid4().hex, "requester.client.id": "account-{}-requester".format(DEVICE) }
+                for _ in range(len(next(iter(corpora.values()))[1]))]
+    yield "create_payload", "request", kura_payload_handler.create_payload, requests
+
+
+def check(results, baseline, threshold):
+    """Returns the cases more than 'threshold' slower than in the baseline"""
+    regressions = []
+    for name, elapsed in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is not None and elapsed > reference * (1 + threshold):
+            regressions.append((name, reference, elapsed))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500, help="payloads per corpus")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, the best one is reported")
+    parser.add_argument("--cases", nargs="+", help="only the cases with these prefixes")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the results as the new baseline")
+    parser.add_argument("--check", metavar="FILE", help="fail when a case is slower than in this baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="slowdown tolerated by --check (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    print("{:<40} {:>12} {:>10}".format("case", "us/op", "baseline"))
+    for case, corpus, operation, items in cases(build_corpora(args.messages)):
+        if args.cases and not any(case.startswith(prefix) for prefix in args.cases):
+            continue
+        name = "{}/{}".format(case, corpus)
+        results[name] = measure(operation, items, args.repeat) * 1e6
+        reference = baseline.get(name) if baseline else None
+        ratio = "{:>9.2f}x".format(results[name] / reference) if reference else ""
+        print("{:<40} {:>12.2f} {}".format(name, results[name], ratio))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({ "environment": { "python": platform.python_version(), "platform": platform.platform() },
+                        "results": results }, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = check(results, baseline, args.threshold)
+        for name, reference, elapsed in regressions:
+            print("REGRESSION {}: {:.2f} us/op, baseline {:.2f} us/op".format(name, elapsed, reference))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
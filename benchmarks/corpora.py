@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic KuraPayload corpora shared by the micro-benchmarks"""
+
+import gzip
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import kurapayload_pb2 as kura_payload
+
+ASSET_NAME = "asset-1"
+# Kura channel type of each KuraMetric ValueType used
+CHANNEL_TYPES = ("DOUBLE", "FLOAT", "LONG", "INTEGER", "BOOLEAN", "STRING")
+
+
+def channel_name(index):
+    return "channel-{}".format(index)
+
+
+def build_payload(metrics, rnd):
+    """Serialized KuraPayload with an 'assetName' metric and 'metrics' channels of every type"""
+    payload = kura_payload.KuraPayload()
+    payload.timestamp = int(time.time() * 1000)
+    payload.position.latitude = 43.3
+    payload.position.longitude = -2.0
+    metric = payload.metric.add()
+    metric.name = "assetName"
+    metric.type = metric.STRING
+    metric.string_value = ASSET_NAME
+    for i in range(metrics):
+        metric = payload.metric.add()
+        metric.name = channel_name(i)
+        metric.type = i % 6
+        if metric.type == metric.DOUBLE:
+            metric.double_value = rnd.uniform(-1000, 1000)
+        elif metric.type == metric.FLOAT:
+            metric.float_value = rnd.uniform(-1000, 1000)
+        elif metric.type == metric.INT64:
+            metric.long_value = rnd.randint(-2 ** 40, 2 ** 40)
+        elif metric.type == metric.INT32:
+            metric.int_value = rnd.randint(-2 ** 20, 2 ** 20)
+        elif metric.type == metric.BOOL:
+            metric.bool_value = rnd.random() < 0.5
+        else:
+            metric.string_value = "value-{}".format(rnd.randint(0, 1000))
+    return payload.SerializeToString()
+
+
+def build_assets(metrics):
+    """GET/assets reply body describing the channels of build_payload"""
+    return [{ "name": ASSET_NAME,
+              "channels": [{ "name": channel_name(i), "type": CHANNEL_TYPES[i % 6], "mode": "READ" }
+                           for i in range(metrics)] }]
+
+
+def build_corpora(messages, small=5, wide=200, seed=0):
+    """{name: (metrics, payloads)} with small, wide and gzipped wide payloads"""
+    rnd = random.Random(seed)
+    small_payloads = [build_payload(small, rnd) for _ in range(messages)]
+    wide_payloads = [build_payload(wide, rnd) for _ in range(messages)]
+    return {
+        "small": (small, small_payloads),
+        "wide": (wide, wide_payloads),
+        "wide_gzip": (wide, [gzip.compress(payload) for payload in wide_payloads]),
+    }
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Minimal MQTT 3.1.1 broker on asyncio, a stand-in for mosquitto in the benchmarks.
+
+Supports what the gateway and its clients use: CONNECT with will messages,
+PUBLISH at QoS 0, 1 and 2, retained messages, SUBSCRIBE and UNSUBSCRIBE with
+wildcards, PINGREQ and DISCONNECT. Messages are always delivered to the
+subscribers at QoS 0. No authentication, no persistent sessions.
+"""
+
+import asyncio
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    """MQTT topic filter matching, wildcards don't match topics starting with '$'"""
+    if topic_filter == topic:
+        return True
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    if topic.startswith("$") and filter_levels[0] in ("+", "#"):
+        return False
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    return packet(PUBLISH, 1 if retain else 0, encode_string(topic) + payload)
+
+
+class Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def uint16(self):
+        value, = struct.unpack_from("!H", self.data, self.offset)
+        self.offset += 2
+        return value
+
+    def uint8(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def binary(self):
+        length = self.uint16()
+        value = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return value
+
+    def string(self):
+        return self.binary().decode("utf-8")
+
+    def rest(self):
+        return self.data[self.offset:]
+
+    def remaining(self):
+        return len(self.data) - self.offset
+
+
+class Session(object):
+
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = {}
+        self.will = None
+        self.closed = False
+
+    def send(self, data):
+        if not self.closed:
+            self.writer.write(data)
+
+    async def run(self):
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = await self.__read_packet()
+                if packet_type == CONNECT:
+                    self.__connect(Reader(body))
+                elif packet_type == PUBLISH:
+                    self.__publish(flags, Reader(body))
+                elif packet_type == PUBREL:
+                    self.send(packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    self.__subscribe(Reader(body))
+                elif packet_type == UNSUBSCRIBE:
+                    self.__unsubscribe(Reader(body))
+                elif packet_type == PINGREQ:
+                    self.send(packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            self.broker.remove_session(self, clean)
+            self.writer.close()
+
+    async def __read_packet(self):
+        header = await self.reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await self.reader.readexactly(length) if length else b""
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    def __connect(self, reader):
+        reader.string()
+        reader.uint8()
+        flags = reader.uint8()
+        reader.uint16()
+        # Like real brokers, assign a unique id to the clients connecting without one
+        self.client_id = reader.string() or "auto-{}".format(id(self))
+        if flags & 0x04:
+            topic = reader.string()
+            message = reader.binary()
+            self.will = (topic, message, bool(flags & 0x20))
+        self.send(packet(CONNACK, 0, b"\x00\x00"))
+        self.broker.add_session(self)
+
+    def __publish(self, flags, reader):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic = reader.string()
+        if qos:
+            packet_id = reader.uint16()
+            self.send(packet(PUBACK if qos == 1 else PUBREC, 0, struct.pack("!H", packet_id)))
+        self.broker.route(topic, reader.rest(), retain)
+
+    def __subscribe(self, reader):
+        packet_id = reader.uint16()
+        topics = []
+        while reader.remaining():
+            topics.append(reader.string())
+            reader.uint8()
+        self.send(packet(SUBACK, 0, struct.pack("!H", packet_id) + bytes(len(topics))))
+        for topic_filter in topics:
+            self.subscriptions[topic_filter] = True
+            for topic, payload in self.broker.retained_messages(topic_filter):
+                self.send(publish_packet(topic, payload, True))
+
+    def __unsubscribe(self, reader):
+        packet_id = reader.uint16()
+        while reader.remaining():
+            self.subscriptions.pop(reader.string(), None)
+        self.send(packet(UNSUBACK, 0, struct.pack("!H", packet_id)))
+
+    def matches(self, topic):
+        return any(topic_matches(topic_filter, topic) for topic_filter in self.subscriptions)
+
+
+class FakeBroker(object):
+    """'on_publish(topic, payload)' is called from the event loop for every
+    message published by the clients, before it is delivered"""
+
+    def __init__(self, host="127.0.0.1", port=0, on_publish=None):
+        self.host = host
+        self.port = port
+        self.on_publish = on_publish
+        self.sessions = []
+        self.retained = {}
+        self.__server = None
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__accept, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        logger.debug("Fake broker listening on {}:{}".format(self.host, self.port))
+
+    async def stop(self):
+        self.__server.close()
+        await self.__server.wait_closed()
+        for session in list(self.sessions):
+            session.writer.close()
+
+    async def drain(self):
+        """Waits for the clients to catch up with the messages already sent to them"""
+        for session in list(self.sessions):
+            try:
+                await session.writer.drain()
+            except ConnectionError:
+                pass
+
+    def publish(self, topic, payload, retain=False):
+        """Publishes from the event loop, as if a client had"""
+        self.route(topic, payload, retain)
+
+    def route(self, topic, payload, retain=False):
+        if self.on_publish is not None:
+            self.on_publish(topic, payload)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        data = publish_packet(topic, payload)
+        for session in self.sessions:
+            if session.matches(topic):
+                session.send(data)
+
+    def retained_messages(self, topic_filter):
+        return [(topic, payload) for topic, payload in self.retained.items() if topic_matches(topic_filter, topic)]
+
+    def add_session(self, session):
+        for other in list(self.sessions):
+            if other.client_id == session.client_id:
+                # Session taken over by a new connection with the same client id
+                other.will = None
+                other.closed = True
+                other.writer.close()
+                self.sessions.remove(other)
+        self.sessions.append(session)
+
+    def remove_session(self, session, clean):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if session.will is not None and not clean:
+            topic, message, retain = session.will
+            self.route(topic, message, retain)
+
+    async def __accept(self, reader, writer):
+        await Session(self, reader, writer).run()
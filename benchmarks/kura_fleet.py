@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic Kura fleet publishing straight into a FakeBroker.
+
+Every device has one asset with 'channels' DOUBLE channels plus the 'sent_at'
+channel, which carries the wall clock time the message was published at so
+the end-to-end latency can be measured where the telemetry comes out. The
+devices answer the ASSET-V1 GET/assets and EXEC/read requests of the gateway.
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import kurapayload_pb2 as kura_payload
+
+ASSET_NAME = "asset-1"
+SENT_AT_CHANNEL = "sent_at"
+TICK = 0.01
+
+
+def encode_metric(name, value):
+    """Serialized KuraPayload holding a single DOUBLE metric.
+
+    Repeated fields of concatenated serialized messages are merged, so it is
+    appended to a payload serialized beforehand."""
+    payload = kura_payload.KuraPayload()
+    metric = payload.metric.add()
+    metric.name = name
+    metric.type = metric.DOUBLE
+    metric.double_value = value
+    return payload.SerializeToString()
+
+
+class KuraFleet(object):
+
+    def __init__(self, broker, devices=10, channels=10, rate=1.0, compress=False, prefix="$EDC", account="account",
+                 seed=0):
+        self.broker = broker
+        self.devices = ["device-{:05d}".format(index) for index in range(devices)]
+        self.channels = ["channel-{}".format(index) for index in range(channels)]
+        self.rate = rate
+        self.compress = compress
+        self.prefix = prefix
+        self.account = account
+        self.random = random.Random(seed)
+        self.assets_served = set()
+        self.sent = 0
+        self.__templates = [self.__template(device) for device in self.devices]
+
+    def handle_publish(self, topic, payload):
+        """Answers the asset requests of the gateway, to be chained in the broker 'on_publish'"""
+        levels = topic.split("/")
+        if len(levels) != 6 or levels[0] != self.prefix or levels[3] != "ASSET-V1":
+            return
+        request = kura_payload.KuraPayload()
+        request.ParseFromString(payload)
+        metrics = { metric.name: metric.string_value for metric in request.metric }
+        device = levels[2]
+        resource = "/".join(levels[4:])
+        if resource == "GET/assets":
+            body = [{ "name": ASSET_NAME,
+                      "channels": [{ "name": channel, "type": "DOUBLE", "mode": "READ" }
+                                   for channel in self.channels + [SENT_AT_CHANNEL]] }]
+            self.assets_served.add(device)
+        elif resource == "EXEC/read":
+            body = [{ "name": ASSET_NAME,
+                      "channels": [{ "name": channel, "type": "DOUBLE", "value": 0.0 } for channel in self.channels] }]
+        else:
+            return
+        reply = kura_payload.KuraPayload()
+        reply.timestamp = int(time.time() * 1000)
+        reply.body = json.dumps(body).encode("utf-8")
+        reply_topic = "{}/{}/{}/ASSET-V1/REPLY/{}".format(self.prefix, levels[1], metrics.get("requester.client.id"),
+                                                         metrics.get("request.id"))
+        # Replying from within the broker callback would deliver it before the request
+        asyncio.get_event_loop().call_soon(self.broker.publish, reply_topic, reply.SerializeToString())
+
+    async def birth(self, rate=500):
+        for device in self.devices:
+            topic = "{}/{}/{}/MQTT/BIRTH".format(self.prefix, self.account, device)
+            self.broker.publish(topic, kura_payload.KuraPayload().SerializeToString())
+            await asyncio.sleep(1.0 / rate)
+
+    async def run(self, duration):
+        """Publishes at 'rate' messages per second and device for 'duration' seconds"""
+        total_rate = self.rate * len(self.devices)
+        started = time.monotonic()
+        index = 0
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= duration:
+                break
+            due = int(elapsed * total_rate) - self.sent
+            for _ in range(due):
+                self.__publish(index)
+                index = (index + 1) % len(self.devices)
+            await self.broker.drain()
+            await asyncio.sleep(TICK)
+        return time.monotonic() - started
+
+    def __template(self, device):
+        payload = kura_payload.KuraPayload()
+        payload.timestamp = int(time.time() * 1000)
+        metric = payload.metric.add()
+        metric.name = "assetName"
+        metric.type = metric.STRING
+        metric.string_value = ASSET_NAME
+        for channel in self.channels:
+            metric = payload.metric.add()
+            metric.name = channel
+            metric.type = metric.DOUBLE
+            metric.double_value = self.random.uniform(-1000, 1000)
+        return "{}/{}/{}".format(self.account, device, ASSET_NAME), payload.SerializeToString()
+
+    def __publish(self, index):
+        topic, template = self.__templates[index]
+        payload = template + encode_metric(SENT_AT_CHANNEL, time.time())
+        if self.compress:
+            payload = gzip.compress(payload, 1)
+        self.broker.publish(topic, payload)
+        self.sent += 1
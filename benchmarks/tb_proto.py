@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""The ThingsBoard gateway protobuf messages as ThingsBoard reads and writes them, with
+the classes protoc generates from src/tb_mqtt_client/transport.proto (transport_pb2).
+
+The benchmark sink reads back what the gateway publishes, the tests also build the
+downlink messages with it. protoc --python_out=. transport.proto regenerates the classes."""
+
+import json
+
+from tb_mqtt_client import transport_pb2
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def key_value(key, value):
+    """KeyValueProto of a JSON value, typed as ThingsBoard types the JSON values it receives"""
+    kv = transport_pb2.KeyValueProto(key=key)
+    if isinstance(value, bool):
+        kv.type = transport_pb2.BOOLEAN_V
+        kv.bool_v = value
+    elif isinstance(value, int) and INT64_MIN <= value <= INT64_MAX:
+        kv.type = transport_pb2.LONG_V
+        kv.long_v = value
+    elif isinstance(value, (int, float)):
+        kv.type = transport_pb2.DOUBLE_V
+        kv.double_v = value
+    elif isinstance(value, str):
+        kv.type = transport_pb2.STRING_V
+        kv.string_v = value
+    else:
+        kv.type = transport_pb2.JSON_V
+        kv.json_v = json.dumps(value)
+    return kv
+
+
+def key_value_pair(kv):
+    """(key, value) of a KeyValueProto"""
+    if kv.type == transport_pb2.BOOLEAN_V:
+        return kv.key, kv.bool_v
+    if kv.type == transport_pb2.LONG_V:
+        return kv.key, kv.long_v
+    if kv.type == transport_pb2.DOUBLE_V:
+        return kv.key, kv.double_v
+    if kv.type == transport_pb2.STRING_V:
+        return kv.key, kv.string_v
+    return kv.key, json.loads(kv.json_v)
+
+
+def decode_key_value(buf):
+    return key_value_pair(transport_pb2.KeyValueProto.FromString(buf))
+
+
+def ts_key_values(values, ts=0):
+    """TsKvProto list, as ThingsBoard sends the attributes"""
+    return [transport_pb2.TsKvProto(ts=ts, kv=key_value(key, value)) for key, value in values.items()]
+
+
+# Uplink, the gateway JSON payloads of the messages the gateway publishes
+
+def decode_connect(buf):
+    """ConnectMsg as the gateway JSON connect message"""
+    message = transport_pb2.ConnectMsg.FromString(buf)
+    connect = { "device": message.deviceName }
+    if message.deviceType:
+        connect["type"] = message.deviceType
+    return connect
+
+
+def decode_disconnect(buf):
+    return { "device": transport_pb2.DisconnectMsg.FromString(buf).deviceName }
+
+
+def decode_gateway_telemetry(buf):
+    """GatewayTelemetryMsg as the gateway JSON telemetry, {device: [{"ts": ts, "values": {...}}]}"""
+    telemetry = {}
+    for message in transport_pb2.GatewayTelemetryMsg.FromString(buf).msg:
+        records = telemetry.setdefault(message.deviceName, [])
+        for ts_kv_list in message.msg.tsKvList:
+            records.append({ "ts": ts_kv_list.ts, "values": dict(key_value_pair(kv) for kv in ts_kv_list.kv) })
+    return telemetry
+
+
+def decode_gateway_attributes(buf):
+    """GatewayAttributesMsg as the gateway JSON attributes, {device: {key: value}}"""
+    attributes = {}
+    for message in transport_pb2.GatewayAttributesMsg.FromString(buf).msg:
+        attributes.setdefault(message.deviceName, {}).update(key_value_pair(kv) for kv in message.msg.kv)
+    return attributes
+
+
+def decode_attributes_request(buf):
+    """GatewayAttributesRequestMsg as the gateway JSON attribute request"""
+    message = transport_pb2.GatewayAttributesRequestMsg.FromString(buf)
+    return { "id": message.id, "device": message.deviceName, "client": message.client, "key": ",".join(message.keys) }
+
+
+def decode_rpc_reply(buf):
+    """GatewayRpcResponseMsg as the gateway JSON RPC reply"""
+    message = transport_pb2.GatewayRpcResponseMsg.FromString(buf)
+    return { "device": message.deviceName, "id": message.id, "data": json.loads(message.data) }
+
+
+# Downlink, the messages ThingsBoard sends to the gateway and its devices
+
+def _rpc_request(request_id, method, params):
+    return transport_pb2.ToDeviceRpcRequestMsg(requestId=request_id, methodName=method, params=json.dumps(params))
+
+
+def _attributes_update(values, deleted, ts):
+    return transport_pb2.AttributeUpdateNotificationMsg(sharedUpdated=ts_key_values(values, ts), sharedDeleted=deleted)
+
+
+def _attributes_response(request_id, client, shared, ts):
+    return transport_pb2.GetAttributeResponseMsg(requestId=request_id, clientAttributeList=ts_key_values(client or {}, ts),
+                                                 sharedAttributeList=ts_key_values(shared or {}, ts))
+
+
+def encode_rpc_request(request_id, method, params):
+    return _rpc_request(request_id, method, params).SerializeToString()
+
+
+def encode_rpc_response(request_id, payload=None, error=None):
+    return transport_pb2.ToServerRpcResponseMsg(requestId=request_id, payload=payload, error=error).SerializeToString()
+
+
+def encode_attributes_update(values, deleted=(), ts=0):
+    return _attributes_update(values, deleted, ts).SerializeToString()
+
+
+def encode_attributes_response(request_id, client=None, shared=None, error=None, ts=0):
+    response = _attributes_response(request_id, client, shared, ts)
+    if error is not None:
+        response.error = error
+    return response.SerializeToString()
+
+
+def encode_gateway_rpc_request(device, request_id, method, params):
+    return transport_pb2.GatewayDeviceRpcRequestMsg(deviceName=device,
+                                                    rpcRequestMsg=_rpc_request(request_id, method, params)).SerializeToString()
+
+
+def encode_gateway_attributes_update(device, values, deleted=(), ts=0):
+    return transport_pb2.GatewayAttributeUpdateNotificationMsg(deviceName=device,
+                                                               notificationMsg=_attributes_update(values, deleted, ts)).SerializeToString()
+
+
+def encode_gateway_attributes_response(device, request_id, client=None, shared=None, ts=0):
+    return transport_pb2.GatewayAttributeResponseMsg(deviceName=device,
+                                                     responseMsg=_attributes_response(request_id, client, shared, ts)).SerializeToString()
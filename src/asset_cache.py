@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+
+class AssetCache(object):
+    """Asset definitions of the devices (the body of their GET/assets reply)
+    kept on disk, one file per device, together with the body digest"""
+
+    def __init__(self, folder="conf/asset_cache"):
+        self.folder = folder
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def digest(body):
+        return hashlib.sha1(body).hexdigest()
+
+    def __path(self, account, client_id):
+        return os.path.join(self.folder, "{}_{}.json".format(quote(account, safe=""), quote(client_id, safe="")))
+
+    def load(self, account, client_id):
+        """Returns the cached (digest, assets) of a device, or None"""
+        try:
+            with open(self.__path(account, client_id), 'r') as f:
+                entry = json.load(f)
+            return entry["digest"], entry["assets"]
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            logger.error("Invalid asset cache of device '{}', ignoring it: {}".format(client_id, e))
+            return None
+
+    def store(self, account, client_id, digest, assets):
+        path = self.__path(account, client_id)
+        try:
+            with open(path + ".tmp", 'w') as f:
+                json.dump({ "digest": digest, "assets": assets }, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.error("Unable to cache the assets of device '{}': {}".format(client_id, e))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import metrics
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterMembership(object):
+    """Gateway processes splitting the devices of a Kura broker between them.
+
+    Each node publishes a retained heartbeat on '{topic}/nodes/{node_id}' every
+    'heartbeat_interval' seconds, with an empty retained message on the same
+    topic as its will so the broker clears it when the node dies. Nodes not
+    heard of for 'expiry' seconds are dropped too. Each device goes to the
+    node with the highest hash of (node, client_id), so a node joining or
+    leaving only moves its own share of the devices.
+
+    The devices registered by any node are kept as retained messages on
+    '{topic}/devices/{client_id}', which lets the new owner of a device start
+    it without waiting for its next BIRTH. The callbacks are called with the
+    members from the scheduler thread, once no node or device has appeared or
+    left for 'settle_time' seconds."""
+
+    def __init__(self, node_id, mqtt_connection, scheduler, topic="kura-tb-gateway/cluster",
+                 heartbeat_interval=5, expiry=15, settle_time=2):
+        self.node_id = node_id
+        self.mqtt_connection = mqtt_connection
+        self.scheduler = scheduler
+        self.nodes_topic = "{}/nodes/".format(topic)
+        self.devices_topic = "{}/devices/".format(topic)
+        self.heartbeat_interval = heartbeat_interval
+        self.expiry = expiry
+        self.settle_time = settle_time
+        self.callbacks = []
+        self.__members = {}
+        self.__devices = {}
+        self.__heartbeat_timer = None
+        self.__change_timer = None
+        self.__lock = threading.Lock()
+        metrics.gauge("cluster_members", "Gateway processes in the cluster", lambda: len(self.members()))
+
+    def set_will(self, client):
+        """Clears the heartbeat if the node disconnects abruptly, to be set before connecting"""
+        client.will_set(self.nodes_topic + self.node_id, b"", qos=1, retain=True)
+
+    def register_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def start(self):
+        logger.info("Joining the cluster as '{}'".format(self.node_id))
+        with self.__lock:
+            self.__members = {}
+        self.subscribe()
+        self.__heartbeat_timer = self.scheduler.call_later(0, self.__heartbeat)
+        self.__changed()
+
+    def subscribe(self):
+        """Registers the message callbacks and subscribes, again after the MQTT client is reinitialised"""
+        self.mqtt_connection.message_callback_add(self.nodes_topic + "+", self.__node_handler)
+        self.mqtt_connection.message_callback_add(self.devices_topic + "+", self.__device_handler)
+        self.mqtt_connection.subscribe([(self.nodes_topic + "+", 1), (self.devices_topic + "+", 1)])
+
+    def stop(self):
+        self.scheduler.cancel(self.__heartbeat_timer)
+        self.scheduler.cancel(self.__change_timer)
+        self.__heartbeat_timer = None
+        self.__change_timer = None
+        self.mqtt_connection.unsubscribe([self.nodes_topic + "+", self.devices_topic + "+"])
+        self.mqtt_connection.message_callback_remove(self.nodes_topic + "+")
+        self.mqtt_connection.message_callback_remove(self.devices_topic + "+")
+        # Leaving cleanly, the other nodes take over right away
+        self.mqtt_connection.publish(self.nodes_topic + self.node_id, b"", qos=1, retain=True)
+        logger.info("Left the cluster")
+
+    def members(self):
+        with self.__lock:
+            return sorted(set(self.__members) | {self.node_id})
+
+    def owner(self, client_id, members=None):
+        """Rendezvous hashing, the node with the highest hash of the pair owns the device"""
+        if members is None:
+            members = self.members()
+        return max(members, key=lambda node: (hashlib.md5("{}/{}".format(node, client_id).encode("utf-8")).digest(), node))
+
+    def owns(self, client_id, members=None):
+        return self.owner(client_id, members) == self.node_id
+
+    def devices(self):
+        """The device directory, {client_id: info}"""
+        with self.__lock:
+            return dict(self.__devices)
+
+    def add_device(self, info):
+        """Records a device in the directory, published if this node owns it"""
+        client_id = info["client_id"]
+        with self.__lock:
+            known = client_id in self.__devices
+            self.__devices[client_id] = info
+        if not known and self.owns(client_id):
+            self.mqtt_connection.publish(self.devices_topic + client_id, json.dumps(info), qos=1, retain=True)
+
+    def __heartbeat(self):
+        self.mqtt_connection.publish(self.nodes_topic + self.node_id,
+                                     json.dumps({ "node": self.node_id, "ts": int(time.time()) }), qos=1, retain=True)
+        now = time.monotonic()
+        with self.__lock:
+            expired = [node for node, seen in self.__members.items() if now - seen > self.expiry]
+            for node in expired:
+                del self.__members[node]
+        for node in expired:
+            logger.warning("Cluster node '{}' not heard of for {}s, dropping it".format(node, self.expiry))
+        if expired:
+            self.__changed()
+        self.__heartbeat_timer = self.scheduler.call_later(self.heartbeat_interval, self.__heartbeat)
+
+    def __node_handler(self, client, obj, msg):
+        node = msg.topic[len(self.nodes_topic):]
+        if node == self.node_id:
+            return
+        with self.__lock:
+            known = node in self.__members
+            if msg.payload:
+                self.__members[node] = time.monotonic()
+            else:
+                self.__members.pop(node, None)
+        if msg.payload and not known:
+            logger.info("Cluster node '{}' joined".format(node))
+            self.__changed()
+        elif not msg.payload and known:
+            logger.info("Cluster node '{}' left".format(node))
+            self.__changed()
+
+    def __device_handler(self, client, obj, msg):
+        try:
+            info = json.loads(msg.payload)
+        except ValueError:
+            info = None
+        if not isinstance(info, dict) or not all(isinstance(info.get(key), str) for key in ("client_id", "account_name")):
+            logger.error("Invalid cluster device record on '{}'".format(msg.topic))
+            return
+        with self.__lock:
+            known = info["client_id"] in self.__devices
+            self.__devices[info["client_id"]] = info
+        if not known:
+            self.__changed()
+
+    def __changed(self):
+        with self.__lock:
+            self.scheduler.cancel(self.__change_timer)
+            self.__change_timer = self.scheduler.call_later(self.settle_time, self.__notify)
+
+    def __notify(self):
+        with self.__lock:
+            self.__change_timer = None
+        members = self.members()
+        logger.info("Cluster members: {}".format(", ".join(members)))
+        for callback in self.callbacks:
+            callback(members)
@@ -11,34 +11,58 @@ logger = logging.getLogger(__name__)
 
 class ConfigurationHandler(object):
 
-    def __init__(self, file="conf/configuration.json"):
+    def __init__(self, file="conf/configuration.json", watch=True):
         self.file_ = file
         self.file_path = os.path.realpath(self.file_)
         self.file_folder = os.path.dirname(self.file_path)
         self.file_name = os.path.basename(self.file_path)
         self.configuration = {}
         self.callbacks = []
+        self.__mtime = None
         self.__load_configuration()
-        self.__start_watcher()
+        if watch:
+            self.watch()
 
     def __read_configuration(self):
         with open(self.file_path, 'r') as f:
             return json.load(f)
 
     def __load_configuration(self):
+        self.__mtime = os.stat(self.file_path).st_mtime_ns
         with open(self.file_path, 'r') as f:
             self.configuration = json.load(f)
 
+    def check(self):
+        """Reloads the file if it was modified since the last check, for polling it instead of watching it"""
+        try:
+            mtime = os.stat(self.file_path).st_mtime_ns
+        except OSError as e:
+            logger.error("Unable to check the configuration file: {}".format(e))
+            return
+        if mtime != self.__mtime:
+            self.__mtime = mtime
+            self.__on_modified(self.file_path)
+
     def __save_configuration(self):
         with open(self.file_path, 'w+') as f:
             f.write(self.configuration)
 
-    def __start_watcher(self):
-        event_handler = FileModifiedHandler(self.file_folder, self.file_name, self.__on_modified)   
+    def watch(self):
+        """Watches the file for changes from a watchdog observer thread"""
+        event_handler = FileModifiedHandler(self.file_folder, self.file_name, self.__on_watched_modification)
         observer = Observer()
         observer.schedule(event_handler, self.file_folder)
         observer.start()
 
+    def __on_watched_modification(self, file_path):
+        # Also notified while the file is being written, the next notification has the whole file
+        try:
+            self.__on_modified(file_path)
+        except ValueError as e:
+            logger.error("Invalid configuration file, keeping the current configuration: {}".format(e))
+        except Exception as e:
+            logger.exception("Error applying the configuration file, keeping the current configuration: {}".format(e))
+
     def __on_modified(self, file_path):
         if file_path != self.file_path:
             logger.warn("Notification received from non-configuration file")
@@ -47,12 +71,18 @@ class ConfigurationHandler(object):
         if new_configuration == self.configuration:
             logger.debug("Configuration content has not changed")
             return
-        self.configuration = new_configuration
-        # Notify callbacks
+        changed_keys = { key for key in set(self.configuration) | set(new_configuration)
+                         if self.configuration.get(key) != new_configuration.get(key) }
+        logger.info("Configuration keys changed: {}".format(", ".join(sorted(changed_keys))))
+        # Notify callbacks, the new configuration only replaces the current one once all of them have applied it
         for callback in self.callbacks:
-            callback()
+            callback(changed_keys, new_configuration)
+        self.configuration = new_configuration
 
     def add_change_callback(self, callback):
+        """'callback(changed_keys, configuration)' is called with the set of added, removed or modified keys
+        and the new configuration, before it replaces the current one. It raises ValueError when the new
+        configuration is invalid, which is then not used"""
         self.callbacks.append(callback)
 
     def update_configuration(self, key, value):
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two 'last_seen' updates of the same device
+LAST_SEEN_RESOLUTION = 60
+
+
+class DeviceRegistry(object):
+    """Registered devices, {client_id: info}, persisted as a JSON snapshot plus
+    an append-only journal of the registrations made since.
+
+    Registrations are only buffered in memory. The journal is written and
+    fsynced at most once per 'sync_interval' seconds, through the scheduler's
+    run_blocking(), and without holding the lock the registrations take.
+    Once it holds 'compact_records' records, it is folded into the snapshot,
+    which is written to a temporary file and renamed over the old one. A crash
+    leaves either the old or the new snapshot, and at most a torn last
+    journal line, which is skipped on load.
+
+    The 'last_seen' times are only updated in memory, they get persisted with
+    the next snapshot, written at the latest on close()."""
+
+    def __init__(self, filename, scheduler, sync_interval=1.0, compact_records=1000):
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.scheduler = scheduler
+        self.sync_interval = sync_interval
+        self.compact_records = compact_records
+        self.devices = {}
+        self.__buffer = []
+        self.__journal_records = 0
+        self.__seen = False
+        self.__timer = None
+        self.__lock = threading.Lock()
+        # Held while writing the files, one flush or compaction at a time
+        self.__write_lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self.devices = json.load(f)
+        except FileNotFoundError:
+            logger.debug("'Registered devices' file not found")
+            self.devices = {}
+        except ValueError as e:
+            logger.error("Invalid 'registered devices' file, ignoring it: {}".format(e))
+            self.devices = {}
+
+        self.__journal_records = 0
+        try:
+            with open(self.journal_filename, 'r') as f:
+                for line in f:
+                    try:
+                        info = json.loads(line)
+                    except ValueError:
+                        logger.warning("Skipping torn 'registered devices' journal record")
+                        continue
+                    if info.get("removed"):
+                        self.devices.pop(info["client_id"], None)
+                    else:
+                        self.devices[info["client_id"]] = info
+                    self.__journal_records += 1
+        except FileNotFoundError:
+            pass
+
+        if self.__journal_records or not os.path.exists(self.filename):
+            self.compact()
+        return self.devices
+
+    def __contains__(self, client_id):
+        return client_id in self.devices
+
+    def register(self, client_id, info):
+        with self.__lock:
+            self.devices[client_id] = dict(info)
+            self.__append(info)
+
+    def unregister(self, client_id):
+        """Forgets the device, journaled as a 'removed' record"""
+        with self.__lock:
+            if self.devices.pop(client_id, None) is not None:
+                self.__append({ "client_id": client_id, "removed": True })
+
+    def __append(self, record):
+        self.__buffer.append(json.dumps(record) + "\n")
+        if self.__timer is None:
+            self.__timer = self.scheduler.call_later(self.sync_interval, self.scheduler.run_blocking, self.flush)
+
+    def touch(self, client_id, now=None):
+        """Records the device as seen now, in memory only, once per LAST_SEEN_RESOLUTION seconds at most"""
+        info = self.devices.get(client_id)
+        if info is None:
+            return
+        if now is None:
+            now = time.time()
+        if now - info.get("last_seen", 0) >= LAST_SEEN_RESOLUTION:
+            with self.__lock:
+                # The snapshot may be being written from another thread
+                info["last_seen"] = int(now)
+                self.__seen = True
+
+    def flush(self):
+        with self.__write_lock:
+            with self.__lock:
+                self.__timer = None
+                if not self.__buffer:
+                    return
+                lines, self.__buffer = self.__buffer, []
+            with open(self.journal_filename, 'a') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.__lock:
+                self.__journal_records += len(lines)
+                if self.__journal_records < self.compact_records:
+                    return
+        self.compact()
+
+    def compact(self):
+        with self.__write_lock:
+            with self.__lock:
+                snapshot = json.dumps(self.devices)
+                count = len(self.devices)
+                # In the snapshot, the records registered from now on are journaled after it
+                self.__buffer = []
+                self.__seen = False
+            temporary = self.filename + ".tmp"
+            with open(temporary, 'w') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.filename)
+            # Replaying the old journal after a crash right here would only repeat what the snapshot holds
+            with open(self.journal_filename, 'w') as f:
+                os.fsync(f.fileno())
+            with self.__lock:
+                self.__journal_records = 0
+        logger.debug("'Registered devices' snapshot written with {} devices".format(count))
+
+    def close(self):
+        with self.__lock:
+            self.scheduler.cancel(self.__timer)
+            self.__timer = None
+            seen = self.__seen
+        self.flush()
+        if seen:
+            self.compact()
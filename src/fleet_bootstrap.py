@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Requests sent to a device when it is queried, its assets and its asset values
+REQUESTS_PER_DEVICE = 2
+PROGRESS_INTERVAL = 10
+
+
+class FleetBootstrap(object):
+    """Queries the registered devices at startup at a bounded pace.
+
+    At most 'concurrency' devices wait for their replies at the same time and
+    no more than 'rate' requests per second are sent, with a burst of one
+    second worth of requests. A device stops counting against the concurrency
+    once it has replied or its first requests have timed out, the retries are
+    left to the device. Devices are queried in the given order, most recently
+    seen first. Runs from the scheduler thread."""
+
+    def __init__(self, scheduler, concurrency=20, rate=50):
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self.rate = rate
+        self.__queue = collections.deque()
+        self.__queued = set()
+        self.__in_flight = []
+        self.__total = 0
+        self.__done = 0
+        self.__tokens = 0
+        self.__last_tick = None
+        self.__last_progress = None
+        self.__started = None
+        self.__timer = None
+        # Bumped whenever the pending tick is replaced, a tick of an older one doesn't reschedule
+        self.__generation = 0
+        self.__lock = threading.Lock()
+
+    def start(self, devices):
+        """Queues the devices, added to the ones still queued when called again from the scheduler thread"""
+        with self.__lock:
+            if not self.__queue and not self.__in_flight:
+                self.__total = 0
+                self.__done = 0
+                self.__started = self.__last_tick = self.__last_progress = time.monotonic()
+                self.__tokens = self.__burst()
+            for device in devices:
+                self.__queue.append(device)
+                self.__queued.add(device.id)
+            self.__total += len(devices)
+            self.__schedule(0)
+        logger.info("Querying {} registered devices".format(len(devices)))
+
+    def configure(self, concurrency, rate):
+        """Applies to the devices still queued"""
+        with self.__lock:
+            self.concurrency = concurrency
+            self.rate = rate
+            self.__tokens = min(self.__tokens, self.__burst())
+
+    def stop(self):
+        with self.__lock:
+            self.scheduler.cancel(self.__timer)
+            self.__timer = None
+            self.__generation += 1
+            self.__queue.clear()
+            self.__queued.clear()
+            self.__in_flight = []
+
+    def discard(self, device):
+        """Removes a device still waiting to be queried, returns whether it was"""
+        with self.__lock:
+            if device.id not in self.__queued:
+                return False
+            self.__queued.discard(device.id)
+            self.__done += 1
+            return True
+
+    def __burst(self):
+        return max(self.rate, REQUESTS_PER_DEVICE) if self.rate else 0
+
+    def __schedule(self, delay):
+        """Replaces the pending tick, called with the lock held"""
+        self.scheduler.cancel(self.__timer)
+        self.__generation += 1
+        self.__timer = self.scheduler.call_later(delay, self.__tick, self.__generation)
+
+    def __tick(self, generation):
+        now = time.monotonic()
+        to_query = []
+        with self.__lock:
+            if generation != self.__generation:
+                return
+            if self.rate:
+                self.__tokens = min(self.__burst(), self.__tokens + (now - self.__last_tick) * self.rate)
+            self.__last_tick = now
+            self.__in_flight = [(device, deadline) for device, deadline in self.__in_flight
+                                if deadline > now and device.pending_requests()]
+            while self.__queue and (not self.concurrency or len(self.__in_flight) < self.concurrency):
+                if self.rate and self.__tokens < REQUESTS_PER_DEVICE:
+                    break
+                device = self.__queue.popleft()
+                if device.id not in self.__queued:
+                    continue
+                self.__queued.discard(device.id)
+                self.__tokens -= REQUESTS_PER_DEVICE
+                self.__in_flight.append((device, now + device.request_timeout))
+                to_query.append(device)
+            self.__done += len(to_query)
+            finished = not self.__queue and not self.__in_flight
+
+        for device in to_query:
+            try:
+                device.query()
+            except Exception as e:
+                logger.error("Error querying device '{}': {}".format(device.id, e))
+
+        if finished:
+            logger.info("{} registered devices queried in {:.1f}s".format(self.__total, now - self.__started))
+        elif now - self.__last_progress >= PROGRESS_INTERVAL:
+            self.__last_progress = now
+            logger.info("Queried {}/{} registered devices, {} waiting for their replies".format(self.__done, self.__total, len(self.__in_flight)))
+        with self.__lock:
+            # Restarted or stopped while querying, the tick of the new timer carries on
+            if generation != self.__generation:
+                return
+            if finished:
+                self.__timer = None
+            else:
+                self.__schedule(REQUESTS_PER_DEVICE / self.rate if self.rate else 0.1)
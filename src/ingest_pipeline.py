@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "drop_newest", "drop_oldest")
+# A warning is logged every time a stage has dropped this many more items
+DROP_WARNING_INTERVAL = 1000
+
+_STOP = object()
+
+
+class PipelineStage(object):
+    """Pool of worker threads, each one with its own bounded queue.
+
+    Items submitted with the same key always go to the same worker, so they
+    are handled in order. The result of 'handler(item)' is passed on to
+    'next_stage' with the same key, unless it is None. With a 'batch_size'
+    above 1, the handler is given a list of up to 'batch_size' queued items
+    and returns the list of their results instead. When a queue is full,
+    'overflow' decides what happens: "block" waits for room (backpressure),
+    "drop_newest" discards the new item and "drop_oldest" discards the oldest
+    queued one."""
+
+    def __init__(self, name, handler, workers=1, queue_size=1000, overflow="block", next_stage=None, batch_size=1):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}', expected one of {}".format(overflow, OVERFLOW_POLICIES))
+        self.name = name
+        self.handler = handler
+        self.overflow = overflow
+        self.next_stage = next_stage
+        self.batch_size = max(1, batch_size)
+        self.dropped = 0
+        self.__queues = [queue.Queue(queue_size) for _ in range(max(1, workers))]
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    def start(self):
+        for index, work_queue in enumerate(self.__queues):
+            thread = threading.Thread(target=self.__worker, args=(work_queue,), name="{}-{}".format(self.name, index))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        """Lets the workers finish the queued items and waits for them."""
+        for work_queue in self.__queues:
+            work_queue.put(_STOP)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def submit(self, key, item, block=True):
+        """Returns whether the item was queued. With the "block" policy and 'block' False, a full
+        queue returns False right away, without counting a drop"""
+        work_queue = self.__queues[hash(key) % len(self.__queues)]
+        if self.overflow == "block":
+            try:
+                work_queue.put((key, item), block)
+                return True
+            except queue.Full:
+                return False
+        while True:
+            try:
+                work_queue.put_nowait((key, item))
+                return True
+            except queue.Full:
+                if self.overflow == "drop_newest":
+                    self.__count_drop()
+                    return False
+            try:
+                work_queue.get_nowait()
+                self.__count_drop()
+            except queue.Empty:
+                pass
+
+    def __count_drop(self):
+        with self.__lock:
+            self.dropped += 1
+            dropped = self.dropped
+        if dropped % DROP_WARNING_INTERVAL == 1:
+            logger.warning("'{}' stage queue full, {} items dropped so far".format(self.name, dropped))
+
+    def __worker(self, work_queue):
+        while True:
+            entry = work_queue.get()
+            if entry is _STOP:
+                return
+            if self.batch_size > 1:
+                if not self.__handle_batch(work_queue, [entry]):
+                    return
+                continue
+            key, item = entry
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                logger.exception("Error in '{}' stage: {}".format(self.name, e))
+                continue
+            if result is not None and self.next_stage is not None:
+                self.next_stage.submit(key, result)
+
+    def __handle_batch(self, work_queue, entries):
+        """Handles the given entries plus the ones already queued. Returns False once the stop mark is found."""
+        running = True
+        while len(entries) < self.batch_size:
+            try:
+                entry = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                running = False
+                break
+            entries.append(entry)
+        try:
+            results = self.handler([item for _, item in entries])
+        except Exception as e:
+            logger.exception("Error in '{}' stage: {}".format(self.name, e))
+            return running
+        if self.next_stage is not None:
+            for (key, _), result in zip(entries, results):
+                if result is not None:
+                    self.next_stage.submit(key, result)
+        return running
+
+
+class IngestPipeline(object):
+    """Receive -> decode -> map -> uplink.
+
+    The receive stage is the MQTT network thread, which only submits the raw
+    messages. Decoding and mapping run on their own partitioned worker pools,
+    and the uplink is done by the ThingsBoard telemetry batcher thread.
+    A 'decode_batch_size' above 1 makes the decoder receive lists of items."""
+
+    def __init__(self, decoder, mapper, decode_workers=2, map_workers=1, queue_size=1000, overflow="block",
+                 decode_batch_size=1):
+        self.overflow = overflow
+        self.map_stage = PipelineStage("map", mapper, map_workers, queue_size, overflow)
+        self.decode_stage = PipelineStage("decode", decoder, decode_workers, queue_size, overflow, self.map_stage,
+                                          decode_batch_size)
+
+    def start(self):
+        self.map_stage.start()
+        self.decode_stage.start()
+
+    def stop(self):
+        self.decode_stage.stop()
+        self.map_stage.stop()
+
+    def submit(self, key, item, block=True):
+        return self.decode_stage.submit(key, item, block)
+
+    def dropped_items(self):
+        return self.decode_stage.dropped + self.map_stage.dropped
@@ -1,47 +1,161 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from asset_cache import AssetCache
+import base64
 import json
 import kura_payload_handler
 import logging
-import threading
+import metrics
+from scheduler import Backoff
 import time
 import uuid
 
 logger = logging.getLogger(__name__)
 
+# Conversion of the metric values of the channel types that can't be forwarded as they are
+VALUE_ACCESSORS = { "BYTE_ARRAY": lambda value: base64.b64encode(value).decode("ascii") }
+# Kura channel types whose values, once through their accessor, are valid ThingsBoard
+# values. Checked when the routes are compiled instead of validating every publish
+CHANNEL_TYPES = ("BOOLEAN", "BYTE_ARRAY", "DOUBLE", "FLOAT", "INTEGER", "LONG", "STRING")
+
+
+def json_value(value):
+    """Accessor of the channels of unknown types"""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    return value
+
+
+def reply_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise ValueError("not a boolean")
+
+
+def reply_integer(value):
+    if isinstance(value, bool):
+        raise ValueError("not an integer")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("not an integer")
+        return int(value)
+    if isinstance(value, (int, str)):
+        return int(value)
+    raise ValueError("not an integer")
+
+
+def reply_float(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("not a number")
+    return float(value)
+
+
+def reply_string(value):
+    if not isinstance(value, str):
+        raise ValueError("not a string")
+    return value
+
+# Conversion of the channel values of the asset values replies, JSON instead of typed
+# metrics, to the values the metrics of the channel type would have after their accessor.
+# They raise ValueError on the values that don't fit the type
+REPLY_CONVERTERS = {
+    "BOOLEAN": reply_boolean,
+    "BYTE_ARRAY": reply_string, # Already base64 encoded
+    "DOUBLE": reply_float,
+    "FLOAT": reply_float,
+    "INTEGER": reply_integer,
+    "LONG": reply_integer,
+    "STRING": reply_string,
+}
+
+REQUEST_TIMEOUTS = metrics.counter("kura_request_timeouts", "Kura device requests not answered in time", per_device=True)
+
+
+class ChannelRoute(object):
+    """Compiled routing information of a channel: where its values go, how they
+    are read, the channel state kept in KuraDevice.channels and its
+    report-by-exception state (None when every value is forwarded), and the
+    conversion of its values in the asset values replies (None for unknown types)"""
+
+    __slots__ = ("telemetry", "accessor", "asset", "channel", "report", "reply")
+
+    def __init__(self, telemetry, accessor, asset, channel, report=None, reply=None):
+        self.telemetry = telemetry
+        self.accessor = accessor
+        self.asset = asset
+        self.channel = channel
+        self.report = report
+        self.reply = reply
+
+
 class KuraDevice(object):
 
-    def __init__(self, prefix, id, account, mqtt_connection):
+    def __init__(self, prefix, id, account, mqtt_connection, scheduler, configuration=None, report_filter=None,
+                 asset_cache=None):
         self.prefix = prefix
         self.id = id
         self.account = account
-        self.telemetry_topic = "{}/{}/#".format(self.account, self.id)
         self.requester_id = "{}-{}-requester".format(self.account, self.id)
         self.assets = {}
         self.channels = {}
+        self.routes = {}
         self.callback = None
         self.mqtt_connection = mqtt_connection
+        self.scheduler = scheduler
+        self.report_filter = report_filter
+        self.asset_cache = asset_cache
+        self.configuration = configuration if configuration is not None else {}
+        self.request_timeout = self.configuration.get("KURA_REQUEST_TIMEOUT", 2)
+        self.__assets_backoff = self.__create_backoff()
+        self.__asset_values_backoff = self.__create_backoff()
         self.__assets_timer = None
         self.__asset_values_timer = None
+        self.__assets_request_id = None
+        self.__asset_values_request_id = None
+        self.__pending_requests = {}
+        self.__assets_digest = None
 
-    def start(self):
+    def start(self, query=True):
         logger.debug("Starting device '{}'".format(self.id))
-        self.mqtt_connection.message_callback_add(self.telemetry_topic, self.__telemetry_topic_handler)
-        self.mqtt_connection.subscribe("{}".format(self.telemetry_topic), 0)
+        self.__load_cached_assets()
         self.callback(self.id, "status_changed", "started")
-        self.__request_assets()
-        self.__request_asset_values()
+        if query:
+            self.query()
 
     def stop(self):
         logger.debug("Stopping device '{}'".format(self.id))
-        self.mqtt_connection.unsubscribe(self.telemetry_topic)
+        self.cancel_requests()
         self.callback(self.id, "status_changed", "stopped")
 
+    def cancel_requests(self):
+        self.scheduler.cancel(self.__assets_timer)
+        self.scheduler.cancel(self.__asset_values_timer)
+        self.__pending_requests.clear()
+
     def restart(self):
+        self.__assets_backoff.reset()
+        self.__asset_values_backoff.reset()
+        self.query()
+
+    def reconfigure(self, configuration):
+        """Applies new request and retry settings and resolves the report rules of the channels again"""
+        self.configuration = configuration
+        self.request_timeout = self.configuration.get("KURA_REQUEST_TIMEOUT", 2)
+        self.__assets_backoff = self.__create_backoff()
+        self.__asset_values_backoff = self.__create_backoff()
+        self.__compile_routes()
+
+    def query(self):
+        # With cached assets the request only refreshes them in the background
         self.__request_assets()
         self.__request_asset_values()
 
+    def pending_requests(self):
+        return len(self.__pending_requests)
+
     def register_callback(self, callback):
         if self.callback is None:
             self.callback = callback 
@@ -55,6 +169,21 @@ class KuraDevice(object):
     def set_channel_value(self, channel, value):
         pass
 
+    def handle_message(self, topic, message):
+        self.__telemetry_topic_handler(topic, message)
+
+    def handle_reply(self, request_id, message):
+        handler = self.__pending_requests.pop(request_id, None)
+        if handler is None:
+            logger.debug("Device '{}' reply to an unknown or expired request: {}".format(self.id, request_id))
+            return
+        handler(message)
+
+    def __create_backoff(self):
+        return Backoff(self.configuration.get("KURA_RETRY_INITIAL_DELAY", 1),
+                       self.configuration.get("KURA_RETRY_MAX_DELAY", 300),
+                       max_retries=self.configuration.get("KURA_RETRY_MAX_ATTEMPTS", 10))
+
     def __request_assets(self):
         logger.debug("Sending device '{}' assets request".format(self.id))
         app_id = "ASSET-V1"
@@ -62,43 +191,96 @@ class KuraDevice(object):
         request_id = uuid.uuid4().hex
 
         pub_topic = "{}/{}/{}/{}/{}".format(self.prefix, self.account, self.id, app_id, resource_id)
-        sub_topic = "{}/{}/{}/{}/REPLY/{}".format(self.prefix, self.account, self.requester_id, app_id, request_id)
-        self.mqtt_connection.message_callback_add(sub_topic, self.__assets_request_handler)
-        self.mqtt_connection.subscribe(sub_topic, 0)
+        self.scheduler.cancel(self.__assets_timer)
+        self.__pending_requests.pop(self.__assets_request_id, None)
+        self.__assets_request_id = request_id
+        self.__pending_requests[request_id] = self.__assets_request_handler
 
         metrics = { "request.id": request_id, "requester.client.id": self.requester_id}
         payload = kura_payload_handler.create_payload(metrics)
 
         # Start the timeout timer
-        self.__assets_timer = threading.Timer(2, self.__assets_timeout_handler)
-        self.__assets_timer.daemon = True
-        self.__assets_timer.start()
+        self.__assets_timer = self.scheduler.call_later(self.request_timeout, self.__assets_timeout_handler, request_id)
 
         self.mqtt_connection.publish(pub_topic, payload)
 
-    def __assets_request_handler(self, client, obj, msg):
+    def __assets_request_handler(self, message):
         logger.debug("Getting device '{}' assets response".format(self.id))
-        if self.__assets_timer.is_alive():
-            logger.debug("Stopping device '{}' assets timer".format(self.id))
-            self.__assets_timer.cancel()
-        self.mqtt_connection.unsubscribe(msg.topic)
-        message = kura_payload_handler.decode_message(msg.payload)
-        body_string = message.body.decode("utf-8")
-        body = json.loads(body_string)
-
+        self.scheduler.cancel(self.__assets_timer)
+        self.__assets_backoff.reset()
+        digest = AssetCache.digest(message.body)
+        if digest == self.__assets_digest:
+            logger.debug("Device '{}' assets unchanged".format(self.id))
+            return
+        assets = json.loads(message.body.decode("utf-8"))
+        self.__load_assets(assets)
+        self.__assets_digest = digest
+        if self.asset_cache is not None:
+            self.scheduler.run_blocking(self.asset_cache.store, self.account, self.id, digest, assets)
+
+    def __load_cached_assets(self):
+        if self.asset_cache is None or self.__assets_digest is not None:
+            return
+        cached = self.asset_cache.load(self.account, self.id)
+        if cached is None:
+            return
+        digest, assets = cached
+        try:
+            self.__load_assets(assets)
+        except (KeyError, TypeError) as e:
+            logger.error("Invalid cached assets of device '{}', ignoring them: {}".format(self.id, e))
+            return
+        self.__assets_digest = digest
+        logger.debug("Device '{}' assets loaded from the cache".format(self.id))
+
+    def __load_assets(self, body):
+        assets = {}
+        channels = {}
         for asset in body:
             asset_name = asset["name"]
-            self.assets[asset_name] = {}
+            assets[asset_name] = {}
             for channel in asset["channels"]:
                 channel_name = channel["name"]
                 channel_type = channel["type"]
                 channel_mode = channel["mode"]
-                self.assets[asset_name][channel_name] = { "type": channel_type, "mode": channel_mode, "value": None }
-                self.channels[channel_name] = { "asset": asset_name, "type": channel_type, "mode": channel_mode, "value": None }
-
-    def __assets_timeout_handler(self):
-        logger.error("Device '{}' has not responded to the assets request".format(self.id))
-        self.__request_assets()
+                # Keep the last value of the channels that are still there
+                value = self.channels[channel_name]["value"] if channel_name in self.channels else None
+                assets[asset_name][channel_name] = { "type": channel_type, "mode": channel_mode, "value": value }
+                channels[channel_name] = { "asset": asset_name, "type": channel_type, "mode": channel_mode, "value": value }
+        self.assets = assets
+        self.channels = channels
+        self.__compile_routes()
+
+    def __compile_routes(self):
+        # Replaced as a whole, the telemetry handlers might be using the previous table
+        self.routes = { name: ChannelRoute(channel["mode"] == "READ", self.__channel_accessor(name, channel["type"]),
+                                           channel["asset"], channel,
+                                           self.__channel_report(channel["asset"], name, channel["mode"] == "READ"),
+                                           REPLY_CONVERTERS.get(channel["type"]))
+                        for name, channel in self.channels.items() }
+
+    def __channel_accessor(self, name, channel_type):
+        if channel_type not in CHANNEL_TYPES:
+            logger.warning("Unknown type '{}' of channel '{}' of device '{}'".format(channel_type, name, self.id))
+            return json_value
+        return VALUE_ACCESSORS.get(channel_type)
+
+    def __channel_report(self, asset, channel, telemetry):
+        if self.report_filter is None:
+            return None
+        return self.report_filter.channel_report(self.id, asset, channel, telemetry)
+
+    def __assets_timeout_handler(self, request_id):
+        if self.__pending_requests.pop(request_id, None) is None:
+            # Answered meanwhile
+            return
+        REQUEST_TIMEOUTS.inc(device=self.id)
+        delay = self.__assets_backoff.next_delay()
+        if delay is None:
+            logger.error("Device '{}' has not responded to {} assets requests, giving up until its next BIRTH".format(self.id, self.__assets_backoff.retries + 1))
+            return
+        logger.error("Device '{}' has not responded to the assets request, retrying in {:.1f}s".format(self.id, delay))
+        self.__assets_timer = self.scheduler.call_later(delay, self.__request_assets)
 
     def __request_asset_values(self, asset=None, channels=None):
         logger.debug("Sending device '{}' assets value request".format(self.id))
@@ -107,27 +289,23 @@ class KuraDevice(object):
         request_id = uuid.uuid4().hex
 
         pub_topic = "{}/{}/{}/{}/{}".format(self.prefix, self.account, self.id, app_id, resource_id)
-        sub_topic = "{}/{}/{}/{}/REPLY/{}".format(self.prefix, self.account, self.requester_id, app_id, request_id)
-        self.mqtt_connection.message_callback_add(sub_topic, self.__asset_values_request_handler)
-        self.mqtt_connection.subscribe(sub_topic, 0)
+        self.scheduler.cancel(self.__asset_values_timer)
+        self.__pending_requests.pop(self.__asset_values_request_id, None)
+        self.__asset_values_request_id = request_id
+        self.__pending_requests[request_id] = self.__asset_values_request_handler
 
         metrics = { "request.id": request_id, "requester.client.id": self.requester_id}
         payload = kura_payload_handler.create_payload(metrics)
 
         # Start the timeout timer
-        self.__asset_values_timer = threading.Timer(2, self.__asset_values_timeout_handler)
-        self.__asset_values_timer.daemon = True
-        self.__asset_values_timer.start()
+        self.__asset_values_timer = self.scheduler.call_later(self.request_timeout, self.__asset_values_timeout_handler, request_id)
 
         self.mqtt_connection.publish(pub_topic, payload)
 
-    def __asset_values_request_handler(self, client, obj, msg):
+    def __asset_values_request_handler(self, message):
         logger.debug("Getting device '{}' asset values response".format(self.id))
-        if self.__asset_values_timer.is_alive():
-            logger.debug("Stopping device '{}' asset values timer".format(self.id))
-            self.__asset_values_timer.cancel()
-        self.mqtt_connection.unsubscribe(msg.topic)
-        message = kura_payload_handler.decode_message(msg.payload)
+        self.scheduler.cancel(self.__asset_values_timer)
+        self.__asset_values_backoff.reset()
         body_string = message.body.decode("utf-8")
         body = json.loads(body_string)
 
@@ -140,13 +318,31 @@ class KuraDevice(object):
                     continue
                 channel_name = channel["name"]
                 channel_value = channel["value"]
-                if self.channels[channel_name]["mode"] != "READ":
-                    self.channels[channel_name]["value"] = channel_value
+                route = self.routes.get(channel_name)
+                if route is not None and not route.telemetry:
+                    if route.reply is not None:
+                        try:
+                            channel_value = route.reply(channel_value)
+                        except (TypeError, ValueError) as e:
+                            logger.error("Invalid value {!r} of {} channel '{}' of device '{}': {}".format(
+                                channel_value, route.channel["type"], channel_name, self.id, e))
+                            continue
+                    route.channel["value"] = channel_value
+                    if route.report is not None and not route.report.accept(channel_value):
+                        continue
                     self.callback(self.id, "attribute_changed", { channel_name: channel_value})
 
-    def __asset_values_timeout_handler(self):
-        logger.error("Device '{}' has not responded to the asset values request".format(self.id))
-        self.__request_asset_values()
+    def __asset_values_timeout_handler(self, request_id):
+        if self.__pending_requests.pop(request_id, None) is None:
+            # Answered meanwhile
+            return
+        REQUEST_TIMEOUTS.inc(device=self.id)
+        delay = self.__asset_values_backoff.next_delay()
+        if delay is None:
+            logger.error("Device '{}' has not responded to {} asset values requests, giving up until its next BIRTH".format(self.id, self.__asset_values_backoff.retries + 1))
+            return
+        logger.error("Device '{}' has not responded to the asset values request, retrying in {:.1f}s".format(self.id, delay))
+        self.__asset_values_timer = self.scheduler.call_later(delay, self.__request_asset_values)
 
     def __write_channel_value(self, asset=None, channel=None, values=None):
         app_id = "ASSET-V1"
@@ -163,59 +359,37 @@ class KuraDevice(object):
 
         self.mqtt_connection.publish(pub_topic, payload)
 
-    def __telemetry_topic_handler(self, client, obj, msg):
-        logger.debug("New telemetry message published on '{}':".format(msg.topic))
-        message = kura_payload_handler.decode_message(msg.payload)
-        values = self.__extract_metrics_values(message)
-        try:
-            ts = message.timestamp
-        except AttributeError:
-            ts = None
-        telemetry_values = self.__filter_telemetry_values(values)
-        attribute_values = self.__filter_attribute_values(values)
+    def __telemetry_topic_handler(self, topic, message):
+        logger.debug("New telemetry message published on '{}':".format(topic))
+        telemetry_values, attribute_values = self.__extract_metrics_values(message)
         if telemetry_values:
             logger.debug("New telemetry value: '{}' ('{}')".format(telemetry_values, self.id))
-            for channel, value in telemetry_values.items():
-                self.channels[channel]["value"] = value
             self.callback(self.id, "telemetry_changed", telemetry_values)
         if attribute_values:
             logger.debug("New attribute value:'{}' ('{}')".format(attribute_values, self.id))
-            for channel, value in attribute_values.items():
-                self.channels[channel]["value"] = value
             self.callback(self.id, "attribute_changed", attribute_values)
         
     def __extract_metrics_values(self, message):
-        type_mapper = { 0: "double_value", #DOUBLE
-                        1: "float_value", #FLOAT
-                        2: "long_value", #INT64
-                        3: "int_value", #INT32
-                        4: "bool_value", #BOOL
-                        5: "string_value", #STRING
-                        6: "bytes_value" #BYTES
-                        }
-        filtered = [m for m in message.metric if m.name != "assetName"]
-        values = { m.name: getattr(m, type_mapper[m.type]) for m in filtered }
-        return values
-
-    def __filter_telemetry_values(self, values):
+        """Splits the metrics in a single pass into telemetry and attribute values, updating the channel values"""
         telemetry_values = {}
-        for key, value in values.items():
-            if key in self.channels:
-                if self.channels[key]["mode"] == "READ":
-                    telemetry_values[key] = value
-            else:
-                logger.error("'{}' not in device channels, assets should be queried again".format(key))
-        return telemetry_values
-
-    def __filter_attribute_values(self, values):
         attribute_values = {}
-        for key, value in values.items():
-            if key in self.channels:
-                if self.channels[key]["mode"] != "READ":
-                    attribute_values[key] = value
+        routes = self.routes
+        for name, value in message.metrics:
+            route = routes.get(name)
+            if route is None:
+                if name != "assetName":
+                    logger.error("'{}' not in device channels, assets should be queried again".format(name))
+                continue
+            if route.accessor is not None:
+                value = route.accessor(value)
+            route.channel["value"] = value
+            if route.report is not None and not route.report.accept(value):
+                continue
+            if route.telemetry:
+                telemetry_values[name] = value
             else:
-                logger.error("'{}' not in device channels, assets should be queried again".format(key))
-        return attribute_values
+                attribute_values[name] = value
+        return telemetry_values, attribute_values
 
     def __get_channel_asset(self, channel):
         if channel in self.channels:
@@ -1,37 +1,269 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
+from asset_cache import AssetCache
+import collections
+from device_registry import DeviceRegistry
+from fleet_bootstrap import FleetBootstrap
+from ingest_pipeline import IngestPipeline
 import kura_payload_handler
 from kura_device import KuraDevice
 import logging
+import metrics
+import os
+from paho.mqtt.client import topic_matches_sub
+from process_decoder import ProcessDecoder
+from report_filter import ReportFilter
+from scheduler import Scheduler
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Kura data messages are published on '{account}/{client_id}/{semantic topic}'
+# The data topics of the accounts of the started devices, unless KURA_DATA_TOPICS lists them
+KURA_ACCOUNT_DATA_TOPIC = "{}/+/#"
+# In a cluster, the data topics of each started device, so that the broker only sends a node its own devices' messages
+KURA_DEVICE_DATA_TOPIC = "{}/{}/#"
+# Settings of the decoding and mapping stages, changing one of them rebuilds the pipeline
+PIPELINE_KEYS = ("DECODER", "DECODE_MODE", "DECODE_PROCESSES", "DECODE_BATCH_SIZE", "INGEST_DECODE_WORKERS",
+                 "INGEST_MAP_WORKERS", "INGEST_QUEUE_SIZE", "INGEST_OVERFLOW_POLICY")
+# Settings of the report filter, changing one of them resets the report-by-exception state of the channels
+RULE_KEYS = ("REPORT_RULES", "AGGREGATION_RULES")
+
+MESSAGES_RECEIVED = metrics.counter("kura_messages_received", "Kura data messages received", per_device=True)
+MESSAGES_DECODED = metrics.counter("kura_messages_decoded", "Kura messages decoded", per_device=True)
+DECODE_ERRORS = metrics.counter("kura_decode_errors", "Kura messages that could not be decoded", per_device=True)
+DECODE_SECONDS = metrics.histogram("kura_decode_seconds", "Time spent decoding a Kura message")
+
 
 class KuraDevicesHandler(object):
+    """Starts the registered and the newly born Kura devices and feeds their messages to the
+    ingest pipeline. With a 'flow_control' (the MqttLoop of the asyncio runtime), the "block"
+    overflow policy pauses reading the Kura connection while the pipeline is full instead of
+    blocking the event loop."""
 
-    def __init__(self, kura_prefix, mqtt_connection, filename="conf/registered_devices.json"):
+    def __init__(self, kura_prefix, mqtt_connection, filename="conf/registered_devices.json", configuration=None, scheduler=None,
+                 cluster=None, flow_control=None):
         self.kura_prefix = kura_prefix
         self.kura_birth_topic = "{}/+/+/MQTT/BIRTH".format(self.kura_prefix)
+        self.kura_reply_topic = "{}/+/+/+/REPLY/+".format(self.kura_prefix)
+        # The BIRTH and REPLY topics, also matched by the data topics when the prefix doesn't start with '$'
+        self.kura_control_topics = "{}/".format(self.kura_prefix)
         self.mqtt_connection = mqtt_connection
+        # In a cluster every node only handles its own devices and keeps its own registry shard
+        self.cluster = cluster
+        if self.cluster is not None:
+            root, extension = os.path.splitext(filename)
+            filename = "{}-{}{}".format(root, self.cluster.node_id, extension)
         self.filename = filename
-        self.registered_devices = {}
+        self.configuration = configuration if configuration is not None else {}
+        # A scheduler created here is also started and stopped here
+        self.__own_scheduler = scheduler is None
+        self.scheduler = Scheduler("kura-scheduler") if scheduler is None else scheduler
+        self.report_filter = ReportFilter(self.configuration.get("REPORT_RULES"), self.configuration.get("AGGREGATION_RULES"))
+        self.asset_cache = AssetCache(self.configuration.get("ASSET_CACHE_FOLDER", "conf/asset_cache"))
+        self.registry = DeviceRegistry(self.filename, self.scheduler,
+                                       self.configuration.get("REGISTRY_SYNC_INTERVAL", 1.0),
+                                       self.configuration.get("REGISTRY_COMPACT_RECORDS", 1000))
+        self.registered_devices = self.registry.devices
+        self.bootstrap = FleetBootstrap(self.scheduler,
+                                        self.configuration.get("KURA_BOOTSTRAP_CONCURRENCY", 20),
+                                        self.configuration.get("KURA_BOOTSTRAP_RATE", 50))
         self.started_devices = {}
         self.callbacks = []
+        self.__devices_lock = threading.Lock()
+        # (account, client_id) and (account, requester_id) routing tables
+        self.__data_routes = {}
+        self.__reply_routes = {}
+        # Data topic subscriptions, {topic: number of started devices using it}
+        self.__data_topics = {}
+        self.__data_topics_lock = threading.Lock()
+        # Swapped for a new pipeline under the lock when its settings change
+        self.__pipeline_lock = threading.Lock()
+        self.__create_pipeline()
+        self.flow_control = flow_control
+        # Messages read before the reading was paused, waiting for room in the pipeline
+        self.__backlog = collections.deque()
+        self.__backlog_lock = threading.Lock()
+        self.__draining = False
+        metrics.gauge("kura_ingest_dropped_total", "Kura messages dropped by the full ingest queues",
+                      lambda: self.pipeline.dropped_items(), "counter")
+
+    def __create_pipeline(self):
+        self.process_decoder = None
+        self.fast_decoder = self.configuration.get("DECODER", "protobuf") == "wire"
+        if self.configuration.get("DECODE_MODE", "thread") == "process":
+            # One decoding thread per process, each one waiting for a batch at a time
+            self.process_decoder = ProcessDecoder(self.configuration.get("DECODE_PROCESSES"), self.fast_decoder)
+            self.pipeline = IngestPipeline(self.__decode_messages, self.__map_message,
+                                           self.process_decoder.processes,
+                                           self.configuration.get("INGEST_MAP_WORKERS", 1),
+                                           self.configuration.get("INGEST_QUEUE_SIZE", 1000),
+                                           self.configuration.get("INGEST_OVERFLOW_POLICY", "block"),
+                                           self.configuration.get("DECODE_BATCH_SIZE", 64))
+        else:
+            self.pipeline = IngestPipeline(self.__decode_message, self.__map_message,
+                                           self.configuration.get("INGEST_DECODE_WORKERS", 2),
+                                           self.configuration.get("INGEST_MAP_WORKERS", 1),
+                                           self.configuration.get("INGEST_QUEUE_SIZE", 1000),
+                                           self.configuration.get("INGEST_OVERFLOW_POLICY", "block"))
+
+    def set_flow_control(self, flow_control):
+        """Replaces the flow control, after the MQTT client is reinitialised"""
+        self.flow_control = flow_control
 
     def start(self):
-        self.__load_registered_devices()
+        if self.__own_scheduler:
+            self.scheduler.start()
+        if self.process_decoder is not None:
+            self.process_decoder.start()
+        self.pipeline.start()
+        self.subscribe()
+        if self.cluster is None:
+            self.__load_registered_devices()
+        else:
+            # The devices are started once the cluster membership is known
+            self.registered_devices = self.registry.load()
+            for info in self.registered_devices.values():
+                self.cluster.add_device(info)
+            self.cluster.register_callback(self.__rebalance)
+            self.cluster.start()
+
+    def subscribe(self):
+        """Registers the message callbacks and subscribes, again after the MQTT client is reinitialised"""
         self.mqtt_connection.message_callback_add(self.kura_birth_topic, self.__birth_handler)
-        res = self.mqtt_connection.subscribe("{}".format(self.kura_birth_topic), 0)
+        self.mqtt_connection.message_callback_add(self.kura_reply_topic, self.__reply_handler)
+        topics = [(self.kura_birth_topic, 0), (self.kura_reply_topic, 0)]
+        with self.__data_topics_lock:
+            data_topics = self.__subscribed_data_topics()
+            self.__add_data_callbacks(data_topics)
+            topics.extend((topic, 0) for topic in data_topics)
+            res = self.mqtt_connection.subscribe(topics)
         logger.debug("Subscription result: {}".format(res))
+        if self.cluster is not None:
+            self.cluster.subscribe()
+
+    def __configured_data_topics(self):
+        return self.configuration.get("KURA_DATA_TOPICS") or None
+
+    def __subscribed_data_topics(self):
+        configured = self.__configured_data_topics()
+        return list(configured) if configured is not None else list(self.__data_topics)
+
+    def __add_data_callbacks(self, topics):
+        # One per data subscription, the other subscriptions of the client don't reach the data handler.
+        # Not for the topics within another one, each callback matching a message gets it
+        if self.cluster is not None and self.__configured_data_topics() is None:
+            # The topics of different devices don't overlap, no need to compare them all with each other
+            for topic in topics:
+                self.mqtt_connection.message_callback_add(topic, self.__data_handler)
+            return
+        callback_topics = []
+        for topic in topics:
+            if any(topic_matches_sub(other, topic) for other in callback_topics):
+                continue
+            callback_topics = [other for other in callback_topics if not topic_matches_sub(topic, other)]
+            callback_topics.append(topic)
+        for topic in callback_topics:
+            self.mqtt_connection.message_callback_add(topic, self.__data_handler)
+
+    def __remove_data_callbacks(self, topics):
+        for topic in topics:
+            self.mqtt_connection.message_callback_remove(topic)
+
+    def __data_topic(self, device):
+        """The data topics of the device's account, or in a cluster of the device itself: the
+        broker doesn't send a node the messages of the devices owned by other nodes"""
+        if self.cluster is not None:
+            return KURA_DEVICE_DATA_TOPIC.format(device.account, device.id)
+        return KURA_ACCOUNT_DATA_TOPIC.format(device.account)
+
+    def __subscribe_data(self, device):
+        topic = self.__data_topic(device)
+        with self.__data_topics_lock:
+            self.__data_topics[topic] = self.__data_topics.get(topic, 0) + 1
+            if self.__data_topics[topic] == 1 and self.__configured_data_topics() is None:
+                self.__add_data_callbacks([topic])
+                self.mqtt_connection.subscribe(topic, 0)
+
+    def __unsubscribe_data(self, device):
+        topic = self.__data_topic(device)
+        with self.__data_topics_lock:
+            count = self.__data_topics.pop(topic, 0) - 1
+            if count > 0:
+                self.__data_topics[topic] = count
+            elif self.__configured_data_topics() is None:
+                self.mqtt_connection.unsubscribe(topic)
+                self.__remove_data_callbacks([topic])
+
+    def reconfigure(self, configuration):
+        """Applies new settings to the data subscriptions, the running devices, the bootstrap and
+        the registry, and replaces the report rules and rebuilds the pipeline if their settings changed"""
+        rebuild = any(self.configuration.get(key) != configuration.get(key) for key in PIPELINE_KEYS)
+        if any(self.configuration.get(key) != configuration.get(key) for key in RULE_KEYS):
+            # First, invalid rules raise ValueError before anything is changed
+            self.report_filter.set_rules(configuration.get("REPORT_RULES"), configuration.get("AGGREGATION_RULES"))
+        with self.__data_topics_lock:
+            unsubscribed = self.__subscribed_data_topics()
+            self.configuration = configuration
+            subscribed = self.__subscribed_data_topics()
+            if unsubscribed != subscribed:
+                logger.info("Data topics subscribed: {}".format(", ".join(subscribed)))
+                if unsubscribed:
+                    self.mqtt_connection.unsubscribe(unsubscribed)
+                    self.__remove_data_callbacks(unsubscribed)
+                if subscribed:
+                    self.__add_data_callbacks(subscribed)
+                    self.mqtt_connection.subscribe([(topic, 0) for topic in subscribed])
+        self.bootstrap.configure(self.configuration.get("KURA_BOOTSTRAP_CONCURRENCY", 20),
+                                 self.configuration.get("KURA_BOOTSTRAP_RATE", 50))
+        self.registry.sync_interval = self.configuration.get("REGISTRY_SYNC_INTERVAL", 1.0)
+        self.registry.compact_records = self.configuration.get("REGISTRY_COMPACT_RECORDS", 1000)
+        with self.__devices_lock:
+            devices = list(self.started_devices.values())
+        for device in devices:
+            device.reconfigure(self.configuration)
+        if rebuild:
+            self.__rebuild_pipeline()
+
+    def __rebuild_pipeline(self):
+        logger.info("Rebuilding the ingest pipeline")
+        with self.__pipeline_lock:
+            # The messages already queued are handled first, the ones of each device stay in order
+            self.pipeline.stop()
+            process_decoder = self.process_decoder
+            self.__create_pipeline()
+            if self.process_decoder is not None:
+                self.process_decoder.start()
+            self.pipeline.start()
+        if process_decoder is not None:
+            process_decoder.stop()
 
     def stop(self):
-        pass
+        if self.cluster is not None:
+            self.cluster.unregister_callback(self.__rebalance)
+            self.cluster.stop()
+        self.bootstrap.stop()
+        self.pipeline.stop()
+        for device in self.started_devices.values():
+            device.cancel_requests()
+        self.registry.close()
+        if self.process_decoder is not None:
+            self.process_decoder.stop()
+        if self.__own_scheduler:
+            self.scheduler.stop()
 
     def register_callback(self, callback):
         self.callbacks.append(callback)
 
+    def unregister_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def get_devices(self):
+        return list(self.started_devices)
+
     def get_device_data(self, device, channel):
         if not device in self.started_devices:
             logger.warn("Information requested about unknown device: '{}' ('{}')".format(device, channel))
@@ -55,42 +287,175 @@ class KuraDevicesHandler(object):
         logger.info("New client id: {}".format(client_id))
         self.__handle_device(client_id, account_name)
 
+    def __data_handler(self, client, obj, msg):
+        if msg.topic.startswith(self.kura_control_topics):
+            return
+        topic = msg.topic.split("/", 2)
+        # Devices not started here, unknown or owned by another node, are dropped before decoding
+        device = self.__data_routes.get((topic[0], topic[1])) if len(topic) > 2 else None
+        if device is None:
+            return
+        self.registry.touch(device.id)
+        MESSAGES_RECEIVED.inc(device=device.id)
+        self.__submit(device.id, (device, msg.topic, None, msg.payload))
+
+    def __reply_handler(self, client, obj, msg):
+        # {prefix}/{account}/{requester_id}/{app_id}/REPLY/{request_id}
+        topic = msg.topic.split("/")
+        device = self.__reply_routes.get((topic[1], topic[2]))
+        if device is None:
+            logger.debug("Reply received for unknown requester: {}".format(msg.topic))
+            return
+        self.__submit(device.id, (device, msg.topic, topic[5], msg.payload))
+
+    def __submit(self, key, item):
+        flow_control = self.flow_control
+        if flow_control is None or self.pipeline.overflow != "block":
+            with self.__pipeline_lock:
+                self.pipeline.submit(key, item)
+            return
+        # The event loop never waits for room, a thread does while the reading is paused
+        with self.__backlog_lock:
+            if not self.__backlog:
+                with self.__pipeline_lock:
+                    if self.pipeline.submit(key, item, block=False):
+                        return
+                logger.debug("Ingest pipeline full, pausing the Kura connection")
+                flow_control.pause_reading()
+                if not self.__draining:
+                    self.__draining = True
+                    thread = threading.Thread(target=self.__drain_backlog, args=(flow_control,), name="kura-backlog")
+                    thread.daemon = True
+                    thread.start()
+            # Behind the older ones, so the messages of each device stay in order
+            self.__backlog.append((key, item))
+
+    def __drain_backlog(self, flow_control):
+        while True:
+            with self.__backlog_lock:
+                if not self.__backlog:
+                    logger.debug("Room in the ingest pipeline, resuming the Kura connection")
+                    self.__draining = False
+                    flow_control.resume_reading()
+                    return
+                key, item = self.__backlog[0]
+            with self.__pipeline_lock:
+                self.pipeline.submit(key, item)
+            with self.__backlog_lock:
+                self.__backlog.popleft()
+
+    def __decode_message(self, item):
+        device, topic, request_id, payload = item
+        started = time.perf_counter()
+        if self.fast_decoder:
+            message = kura_payload_handler.decode_payload_fast(payload)
+        else:
+            message = kura_payload_handler.decode_payload(payload)
+        DECODE_SECONDS.observe(time.perf_counter() - started)
+        if message is None:
+            logger.error("Unable to decode message published on '{}'".format(topic))
+            DECODE_ERRORS.inc(device=device.id)
+            return None
+        MESSAGES_DECODED.inc(device=device.id)
+        return device, topic, request_id, message
+
+    def __decode_messages(self, items):
+        started = time.perf_counter()
+        messages = self.process_decoder.decode([payload for _, _, _, payload in items])
+        # Only the batch is timed, spread over its messages
+        DECODE_SECONDS.observe((time.perf_counter() - started) / max(1, len(items)), len(items))
+        results = []
+        for (device, topic, request_id, _), message in zip(items, messages):
+            if message is None:
+                logger.error("Unable to decode message published on '{}'".format(topic))
+                DECODE_ERRORS.inc(device=device.id)
+                results.append(None)
+            else:
+                MESSAGES_DECODED.inc(device=device.id)
+                results.append((device, topic, request_id, message))
+        return results
+
+    def __map_message(self, item):
+        device, topic, request_id, message = item
+        if request_id is None:
+            device.handle_message(topic, message)
+        else:
+            device.handle_reply(request_id, message)
+
     def __handle_device(self, client_id, account_name):
-        self.__register_device(client_id, account_name)
-        self.__start_device(client_id, account_name)
+        if self.cluster is not None:
+            self.cluster.add_device({ "client_id": client_id, "account_name": account_name })
+            if not self.cluster.owns(client_id):
+                logger.debug("Device '{}' handled by another cluster node".format(client_id))
+                return
+        with self.__devices_lock:
+            self.__register_device(client_id, account_name)
+            self.__start_device(client_id, account_name)
 
     def __register_device(self, client_id, account_name):
-        if client_id in self.registered_devices:
+        if client_id in self.registry:
             logger.warn("Device '{}' already registered".format(client_id))
+            self.registry.touch(client_id)
             return
 
-        self.registered_devices[client_id] = { "client_id": client_id, "account_name": account_name}
-
-        with open(self.filename, 'w') as f:
-            json.dump(self.registered_devices, f)
+        self.registry.register(client_id, { "client_id": client_id, "account_name": account_name,
+                                            "last_seen": int(time.time()) })
 
-    def __start_device(self, client_id, account_name):
+    def __start_device(self, client_id, account_name, query=True):
         if client_id not in self.started_devices:
-            device = KuraDevice(self.kura_prefix, client_id, account_name, self.mqtt_connection)
+            device = KuraDevice(self.kura_prefix, client_id, account_name, self.mqtt_connection, self.scheduler,
+                                self.configuration, self.report_filter, self.asset_cache)
             device.register_callback(self.__callback_handler)
-            device.start()
+            self.__data_routes[(account_name, client_id)] = device
+            self.__reply_routes[(account_name, device.requester_id)] = device
             self.started_devices[client_id] = device
+            self.__subscribe_data(device)
+            device.start(query)
         else:
-            self.started_devices[client_id].restart()
+            device = self.started_devices[client_id]
+            if self.bootstrap.discard(device):
+                # BIRTH received while waiting to be queried
+                device.query()
+            else:
+                device.restart()
+        return device
+
+    def __stop_device(self, client_id):
+        device = self.started_devices.pop(client_id)
+        self.__data_routes.pop((device.account, device.id), None)
+        self.__reply_routes.pop((device.account, device.requester_id), None)
+        self.bootstrap.discard(device)
+        self.__unsubscribe_data(device)
+        device.stop()
+
+    def __rebalance(self, members):
+        """Starts the devices this node owns with the given members and stops the other ones"""
+        with self.__devices_lock:
+            infos = self.cluster.devices()
+            infos.update(self.registry.devices)
+            owned = { client_id: info for client_id, info in infos.items() if self.cluster.owns(client_id, members) }
+            released = [client_id for client_id in self.started_devices if client_id not in owned]
+            for client_id in released:
+                self.__stop_device(client_id)
+                self.registry.unregister(client_id)
+            devices = []
+            for info in sorted(owned.values(), key=lambda info: info.get("last_seen", 0), reverse=True):
+                if info["client_id"] in self.started_devices:
+                    continue
+                if info["client_id"] not in self.registry:
+                    self.registry.register(info["client_id"], info)
+                devices.append(self.__start_device(info["client_id"], info["account_name"], query=False))
+            if devices:
+                self.bootstrap.start(devices)
+        logger.info("Cluster rebalanced, {} devices owned, {} started and {} released".format(len(owned), len(devices), len(released)))
 
     def __load_registered_devices(self):
-        try:
-            with open(self.filename, 'r') as f:
-                file_devices = json.load(f)
-        except FileNotFoundError:
-            logger.debug("'Registered devices' file not found")
-            file_devices = {}
-            with open(self.filename, 'w+') as f:
-                f.write("{}")
-
-        self.registered_devices = file_devices
-        for id, info in self.registered_devices.items():
-            self.__handle_device(info["client_id"], info["account_name"])
+        """Routes the registered devices right away and leaves querying them to the bootstrap"""
+        self.registered_devices = self.registry.load()
+        infos = sorted(self.registered_devices.values(), key=lambda info: info.get("last_seen", 0), reverse=True)
+        devices = [self.__start_device(info["client_id"], info["account_name"], query=False)
+                   for info in infos if info["client_id"] not in self.started_devices]
+        self.bootstrap.start(devices)
 
     def __callback_handler(self, id, event_type, value):
         [callback(id, event_type, value) for callback in self.callbacks]
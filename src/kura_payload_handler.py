@@ -1,28 +1,70 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
 import google.protobuf
 import kurapayload_pb2 as kura_payload
 import logging
+import struct
+import threading
 import zlib
 
 logger = logging.getLogger(__name__)
 
-payload_decoder = kura_payload.KuraPayload()
+# KuraMetric value field for each ValueType
+VALUE_FIELDS = ("double_value", #DOUBLE
+                "float_value", #FLOAT
+                "long_value", #INT64
+                "int_value", #INT32
+                "bool_value", #BOOL
+                "string_value", #STRING
+                "bytes_value" #BYTES
+                )
+
+# Only what the gateway forwards from a KuraPayload: the timestamp (None when
+# not set), the (name, value) pairs of the metrics and the body
+DecodedPayload = collections.namedtuple("DecodedPayload", ["timestamp", "metrics", "body"])
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# One reusable KuraPayload per thread, only used by decode_payload and decode_many
+_decoders = threading.local()
+
+# Wire format field numbers of KuraPayload and KuraMetric
+TIMESTAMP_FIELD = 1
+METRIC_FIELD = 5000
+BODY_FIELD = 5001
+METRIC_NAME_FIELD = 1
+METRIC_TYPE_FIELD = 2
+# KuraMetric value field number for each ValueType, and its default value
+WIRE_VALUE_FIELDS = (3, 4, 5, 6, 7, 8, 9)
+WIRE_VALUE_DEFAULTS = (0.0, 0.0, 0, 0, False, "", b"")
+
+_double = struct.Struct("<d")
+_float = struct.Struct("<f")
+
+
+class WireFormatError(Exception):
+    pass
 
 def decode_message(message):
+    """Returns a new KuraPayload owned by the caller, or None"""
     ungziped = decode_gzip(message)
     unprotobuffed = decode_protobuf(ungziped)
     return unprotobuffed
 
 def decode_gzip(message):
+    if message[:2] != GZIP_MAGIC:
+        return message
     try:
         message = zlib.decompress(message, 16+zlib.MAX_WBITS)
     except zlib.error:
-        logger.debug("Message is not gzip encoded")
+        logger.error("Message has a gzip header but can't be decompressed")
     return message
 
-def decode_protobuf(message):
+def decode_protobuf(message, payload_decoder=None):
+    if payload_decoder is None:
+        payload_decoder = kura_payload.KuraPayload()
     try:
         payload_decoder.ParseFromString(message)
         return payload_decoder
@@ -30,6 +72,139 @@ def decode_protobuf(message):
         logger.error("Message is not protobuffered")
     return None
 
+def decode_payload(message):
+    """Thread-safe: parses into this thread's KuraPayload and only copies out what the gateway forwards"""
+    payload_decoder = getattr(_decoders, "payload", None)
+    if payload_decoder is None:
+        payload_decoder = _decoders.payload = kura_payload.KuraPayload()
+    payload = decode_protobuf(decode_gzip(message), payload_decoder)
+    if payload is None:
+        return None
+    return DecodedPayload(payload.timestamp if payload.HasField("timestamp") else None,
+                          tuple((m.name, getattr(m, VALUE_FIELDS[m.type])) for m in payload.metric),
+                          payload.body)
+
+def decode_payload_fast(message):
+    """Same result as decode_payload, read straight from the wire format without
+    building the KuraPayload message tree. Falls back to decode_payload on any
+    payload it can't handle."""
+    message = decode_gzip(message)
+    try:
+        return decode_wire(message)
+    except (WireFormatError, IndexError, struct.error, UnicodeDecodeError) as e:
+        logger.debug("Falling back to the protobuf decoder: {}".format(e))
+    return decode_payload(message)
+
+def decode_many(messages, fast=False):
+    decoder = decode_payload_fast if fast else decode_payload
+    return [decoder(message) for message in messages]
+
+def decode_payloads(messages, fast=False):
+    """Batch entry point for the decoding processes: plain tuples are cheaper to pickle back than payload objects"""
+    return [tuple(decoded) if decoded is not None else None for decoded in decode_many(messages, fast)]
+
+def decode_wire(message):
+    """Decodes a (not gzipped) KuraPayload into a DecodedPayload. The position,
+    the extensions and any unknown field are skipped without being copied."""
+    buf = memoryview(message)
+    end = len(buf)
+    pos = 0
+    timestamp = None
+    metrics = []
+    body = b""
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if field == METRIC_FIELD and wire_type == 2:
+            size, pos = _read_varint(buf, pos)
+            metrics.append(_decode_wire_metric(buf, pos, pos + size))
+            pos += size
+        elif field == TIMESTAMP_FIELD and wire_type == 0:
+            timestamp, pos = _read_varint(buf, pos)
+            timestamp = _signed64(timestamp)
+        elif field == BODY_FIELD and wire_type == 2:
+            size, pos = _read_varint(buf, pos)
+            body = bytes(buf[pos:pos + size])
+            pos += size
+        else:
+            pos = _skip_field(buf, pos, wire_type)
+    if pos != end:
+        raise WireFormatError("Truncated payload")
+    return DecodedPayload(timestamp, tuple(metrics), body)
+
+def _decode_wire_metric(buf, pos, end):
+    name = None
+    value_type = None
+    values = {}
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value = _double.unpack_from(buf, pos)[0]
+            pos += 8
+        elif wire_type == 5:
+            value = _float.unpack_from(buf, pos)[0]
+            pos += 4
+        elif wire_type == 2:
+            size, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        else:
+            raise WireFormatError("Unsupported wire type {}".format(wire_type))
+        if field == METRIC_NAME_FIELD:
+            name = str(value, "utf-8")
+        elif field == METRIC_TYPE_FIELD:
+            value_type = value
+        else:
+            values[field] = value
+    if pos != end or name is None or value_type is None or value_type >= len(WIRE_VALUE_FIELDS):
+        raise WireFormatError("Invalid metric")
+
+    value = values.get(WIRE_VALUE_FIELDS[value_type], WIRE_VALUE_DEFAULTS[value_type])
+    if value_type == 2: #INT64
+        value = _signed64(value)
+    elif value_type == 3: #INT32
+        value = _signed64(value)
+        value = (value & 0xffffffff) - ((value & 0x80000000) << 1)
+    elif value_type == 4: #BOOL
+        value = bool(value)
+    elif value_type == 5 and isinstance(value, memoryview): #STRING
+        value = str(value, "utf-8")
+    elif value_type == 6 and isinstance(value, memoryview): #BYTES
+        value = bytes(value)
+    return name, value
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise WireFormatError("Varint too long")
+
+def _signed64(value):
+    value &= 0xffffffffffffffff
+    return value - (1 << 64) if value & (1 << 63) else value
+
+def _skip_field(buf, pos, wire_type):
+    if wire_type == 0:
+        return _read_varint(buf, pos)[1]
+    if wire_type == 1:
+        return pos + 8
+    if wire_type == 2:
+        size, pos = _read_varint(buf, pos)
+        return pos + size
+    if wire_type == 5:
+        return pos + 4
+    raise WireFormatError("Unsupported wire type {}".format(wire_type))
+
 def create_payload(metrics):
     payload = kura_payload.KuraPayload()
     for key, value in metrics.items():
@@ -1,61 +1,282 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+from cluster_membership import ClusterMembership
 from configuration_handler import ConfigurationHandler
 from kura_devices_handler import KuraDevicesHandler
 import logging
+from metrics import MetricsServer
+from mqtt_loop import MqttLoop
 import paho.mqtt.client as mqtt_client
+import report_filter
+from scheduler import LoopScheduler, Scheduler
 import signal
 from tb_gateway_handler import TbGatewayHandler
+import telemetry_aggregator
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(name)-20s  - %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# What a change of each configuration key takes, from the most to the least disruptive:
+# rebuilding all the modules, reconnecting to the Kura broker, rebuilding the TB
+# connections, or applying the new value to the running Kura or TB components
+RESTART_MODULES = "modules"
+RESTART_KURA_CLIENT = "kura_client"
+RESTART_THINGSBOARD = "thingsboard"
+RECONFIGURE_KURA = "kura"
+RECONFIGURE_THINGSBOARD = "thingsboard_settings"
+# Only read when the program starts
+STARTUP = "startup"
+
+CONFIGURATION_KEYS = {
+    "MQTT_HOST": RESTART_KURA_CLIENT,
+    "MQTT_PORT": RESTART_KURA_CLIENT,
+    "MQTT_USERNAME": RESTART_KURA_CLIENT,
+    "MQTT_PASSWORD": RESTART_KURA_CLIENT,
+    "MQTT_CLIENT_ID": RESTART_KURA_CLIENT,
+    "KURA_PREFIX": RESTART_MODULES,
+    "KURA_DATA_TOPICS": RECONFIGURE_KURA,
+    "ASSET_CACHE_FOLDER": RESTART_MODULES,
+    "CLUSTER_NODE_ID": RESTART_MODULES,
+    "CLUSTER_TOPIC": RESTART_MODULES,
+    "CLUSTER_HEARTBEAT_INTERVAL": RESTART_MODULES,
+    "CLUSTER_EXPIRY": RESTART_MODULES,
+    "CLUSTER_SETTLE_TIME": RESTART_MODULES,
+    "KURA_REQUEST_TIMEOUT": RECONFIGURE_KURA,
+    "KURA_RETRY_INITIAL_DELAY": RECONFIGURE_KURA,
+    "KURA_RETRY_MAX_DELAY": RECONFIGURE_KURA,
+    "KURA_RETRY_MAX_ATTEMPTS": RECONFIGURE_KURA,
+    "KURA_BOOTSTRAP_CONCURRENCY": RECONFIGURE_KURA,
+    "KURA_BOOTSTRAP_RATE": RECONFIGURE_KURA,
+    "REGISTRY_SYNC_INTERVAL": RECONFIGURE_KURA,
+    "REGISTRY_COMPACT_RECORDS": RECONFIGURE_KURA,
+    "REPORT_RULES": RECONFIGURE_KURA,
+    "INGEST_DECODE_WORKERS": RECONFIGURE_KURA,
+    "INGEST_MAP_WORKERS": RECONFIGURE_KURA,
+    "INGEST_QUEUE_SIZE": RECONFIGURE_KURA,
+    "INGEST_OVERFLOW_POLICY": RECONFIGURE_KURA,
+    "DECODER": RECONFIGURE_KURA,
+    "DECODE_MODE": RECONFIGURE_KURA,
+    "DECODE_PROCESSES": RECONFIGURE_KURA,
+    "DECODE_BATCH_SIZE": RECONFIGURE_KURA,
+    "THINGSBOARD_HOST": RESTART_THINGSBOARD,
+    "THINGSBOARD_PORT": RESTART_THINGSBOARD,
+    "THINGSBOARD_KEY": RESTART_THINGSBOARD,
+    "THINGSBOARD_CONNECTIONS": RESTART_THINGSBOARD,
+    "THINGSBOARD_CODEC": RESTART_THINGSBOARD,
+    "THINGSBOARD_JSON_BACKEND": RESTART_THINGSBOARD,
+    "THINGSBOARD_QUEUE_FOLDER": RESTART_THINGSBOARD,
+    "THINGSBOARD_QUEUE_SEGMENT_BYTES": RESTART_THINGSBOARD,
+    "THINGSBOARD_QUEUE_MAX_SEGMENTS": RESTART_THINGSBOARD,
+    "THINGSBOARD_ATTRIBUTE_REQUEST_TIMEOUT": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_RPC_REQUEST_TIMEOUT": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_VALIDATION": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_MAX_INFLIGHT": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_MAX_QUEUED": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_MIN_RECONNECT_DELAY": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_MAX_RECONNECT_DELAY": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_SHARD_SETTINGS": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_BATCH_WINDOW": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_BATCH_MAX_WINDOW": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_BATCH_MAX_SAMPLES": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_BATCH_MAX_BYTES": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_QUEUE_REPLAY_RATE": RECONFIGURE_THINGSBOARD,
+    "THINGSBOARD_QUEUE_MAX_ATTEMPTS": RECONFIGURE_THINGSBOARD,
+    "AGGREGATION_WINDOW": RECONFIGURE_THINGSBOARD,
+    # Both, the report filter leaves the aggregated channels alone
+    "AGGREGATION_RULES": (RECONFIGURE_KURA, RECONFIGURE_THINGSBOARD),
+    "METRICS_PORT": STARTUP,
+    "METRICS_HOST": STARTUP,
+    "RUNTIME": STARTUP,
+    "CONFIGURATION_POLL_INTERVAL": STARTUP,
+}
+
+# "thread": paho network threads and a scheduler thread, "asyncio": all of them on one event loop
+RUNTIMES = ("thread", "asyncio")
+
 
 def signal_handler(sig, frame):
-    client.loop_stop()
+    shutdown()
+
+def shutdown():
+    stop_kura_loop()
     tb_gateway.stop()
     kura_devices_handler.stop()
+    scheduler.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+
+def check_settings(configuration):
+    """Raises ValueError when a setting parsed by the components is invalid, before any of them is changed"""
+    report_filter.parse_rules(configuration.get("REPORT_RULES"))
+    telemetry_aggregator.parse_rules(configuration.get("AGGREGATION_RULES"))
+
+def on_configuration_changed(changed_keys, configuration):
+    check_settings(configuration)
+    actions = set()
+    for key in sorted(changed_keys):
+        action = CONFIGURATION_KEYS.get(key)
+        if action is None:
+            logger.warning("Unknown configuration key '{}'".format(key))
+        elif action == STARTUP:
+            logger.warning("'{}' changed, the new value is used at the next start".format(key))
+        elif isinstance(action, tuple):
+            actions.update(action)
+        else:
+            actions.add(action)
+    if RESTART_MODULES in actions:
+        logger.debug("We need to restart the modules")
+        restart_modules(configuration)
+        return
+    if RESTART_KURA_CLIENT in actions:
+        restart_kura_client(configuration)
+    if RECONFIGURE_KURA in actions:
+        logger.debug("Applying the new Kura settings")
+        kura_devices_handler.reconfigure(configuration)
+    if RESTART_THINGSBOARD in actions:
+        restart_thingsboard(configuration)
+    elif RECONFIGURE_THINGSBOARD in actions:
+        logger.debug("Applying the new TB settings")
+        tb_gateway.reconfigure(configuration)
 
-def on_configuration_changed():
-    logger.debug("We need to restart the modules")
-    restart_modules()
+def restart_kura_client(configuration):
+    logger.debug("Reconnecting the Kura MQTT client")
+    client.disconnect()
+    stop_kura_loop()
+    connect_kura_client(configuration)
+    kura_devices_handler.set_flow_control(kura_loop)
+    # Reinitialising drops the message callbacks and the subscriptions, not the devices
+    kura_devices_handler.subscribe()
 
-def restart_modules():
-    global client, tb_gateway, kura_devices_handler
-    client.loop_stop()
+def restart_thingsboard(configuration):
+    global tb_gateway
+    logger.debug("Rebuilding the TB gateway connection")
+    tb_gateway.stop()
+    tb_gateway = create_tb_gateway(configuration)
+    tb_gateway.start()
+
+def connect_kura_client(configuration):
+    global kura_loop
+    client.reinitialise(configuration["MQTT_CLIENT_ID"])
+    client.username_pw_set(configuration["MQTT_USERNAME"], configuration["MQTT_PASSWORD"])
+    if cluster is not None:
+        cluster.set_will(client)
+    if loop is not None:
+        # Set before connecting, reinitialising drops its socket callbacks
+        kura_loop = MqttLoop(loop, client)
+    client.connect(configuration["MQTT_HOST"], configuration["MQTT_PORT"], 60)
+    if kura_loop is not None:
+        kura_loop.start()
+    else:
+        client.loop_start()
+
+def stop_kura_loop():
+    if kura_loop is not None:
+        kura_loop.stop()
+    else:
+        client.loop_stop()
+
+def create_cluster(configuration):
+    """The cluster membership of this process, None when it runs alone"""
+    if not configuration.get("CLUSTER_NODE_ID"):
+        return None
+    return ClusterMembership(configuration["CLUSTER_NODE_ID"], client, scheduler,
+                             configuration.get("CLUSTER_TOPIC", "kura-tb-gateway/cluster"),
+                             configuration.get("CLUSTER_HEARTBEAT_INTERVAL", 5),
+                             configuration.get("CLUSTER_EXPIRY", 15),
+                             configuration.get("CLUSTER_SETTLE_TIME", 2))
+
+def create_tb_gateway(configuration):
+    return TbGatewayHandler(configuration["THINGSBOARD_HOST"], configuration["THINGSBOARD_KEY"], 
+                            kura_devices_handler, configuration["THINGSBOARD_PORT"], configuration, scheduler,
+                            loop)
+
+def restart_modules(configuration):
+    global client, cluster, tb_gateway, kura_devices_handler
+    stop_kura_loop()
     tb_gateway.stop()
     kura_devices_handler.stop()
 
-    client.reinitialise(configuration_handler.configuration["MQTT_CLIENT_ID"])
-    client.username_pw_set(configuration_handler.configuration["MQTT_USERNAME"], configuration_handler.configuration["MQTT_PASSWORD"])
-    client.connect(configuration_handler.configuration["MQTT_HOST"], configuration_handler.configuration["MQTT_PORT"], 60)
-    client.loop_start()
+    cluster = create_cluster(configuration)
+    connect_kura_client(configuration)
+
+    kura_devices_handler = KuraDevicesHandler(configuration["KURA_PREFIX"], client,
+                                              configuration=configuration, scheduler=scheduler, cluster=cluster, flow_control=kura_loop)
+    tb_gateway = create_tb_gateway(configuration)
 
-    kura_devices_handler = KuraDevicesHandler(configuration_handler.configuration["KURA_PREFIX"], client)
-    tb_gateway = TbGatewayHandler(configuration_handler.configuration["THINGSBOARD_HOST"], configuration_handler.configuration["THINGSBOARD_KEY"], kura_devices_handler)
+    start_modules()
 
+def start_modules():
     tb_gateway.start()
     kura_devices_handler.start()
 
+def check_configuration():
+    try:
+        configuration_handler.check()
+    except ValueError as e:
+        logger.error("Invalid configuration file, keeping the current configuration: {}".format(e))
+    except Exception as e:
+        logger.exception("Error applying the configuration file, keeping the current configuration: {}".format(e))
+
+async def run_event_loop():
+    """Runs the gateway until SIGINT, what blocks is done in the default executor while the loop runs"""
+    stopped = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stopped.set)
+    # Starting and stopping the components joins threads and writes files
+    await loop.run_in_executor(None, start_modules)
+    interval = configuration_handler.configuration.get("CONFIGURATION_POLL_INTERVAL", 2)
+    while not stopped.is_set():
+        try:
+            await asyncio.wait_for(stopped.wait(), interval)
+        except asyncio.TimeoutError:
+            # The restarts triggered by the changes block as well
+            await loop.run_in_executor(None, check_configuration)
+    await loop.run_in_executor(None, shutdown)
+
 
 if __name__ == "__main__":
     logger.debug("Starting program...")
 
-    configuration_handler = ConfigurationHandler()
+    configuration_handler = ConfigurationHandler(watch=False)
     configuration_handler.add_change_callback(on_configuration_changed)
+
+    runtime = configuration_handler.configuration.get("RUNTIME", "thread")
+    if runtime not in RUNTIMES:
+        raise ValueError("Unknown runtime '{}', expected one of {}".format(runtime, RUNTIMES))
+    loop = None
+    kura_loop = None
+    if runtime == "asyncio":
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Shared by all the request timeouts and retries
+        scheduler = LoopScheduler(loop)
+    else:
+        # The file is polled from the loop in the asyncio runtime
+        configuration_handler.watch()
+        # Shared by all the request timeouts and retries
+        scheduler = Scheduler()
+    scheduler.start()
+
+    metrics_server = None
+    if configuration_handler.configuration.get("METRICS_PORT"):
+        metrics_server = MetricsServer(configuration_handler.configuration["METRICS_PORT"],
+                                       configuration_handler.configuration.get("METRICS_HOST", "127.0.0.1"))
+        metrics_server.start()
     
     client = mqtt_client.Client(configuration_handler.configuration["MQTT_CLIENT_ID"])
-    client.username_pw_set(configuration_handler.configuration["MQTT_USERNAME"], configuration_handler.configuration["MQTT_PASSWORD"])
-    client.connect(configuration_handler.configuration["MQTT_HOST"], configuration_handler.configuration["MQTT_PORT"], 60)
-    client.loop_start()
+    # Each process of a cluster needs its own CLUSTER_NODE_ID and MQTT_CLIENT_ID
+    cluster = create_cluster(configuration_handler.configuration)
+    connect_kura_client(configuration_handler.configuration)
 
-    kura_devices_handler = KuraDevicesHandler(configuration_handler.configuration["KURA_PREFIX"], client)
-    tb_gateway = TbGatewayHandler(configuration_handler.configuration["THINGSBOARD_HOST"], configuration_handler.configuration["THINGSBOARD_KEY"], 
-                                    kura_devices_handler, configuration_handler.configuration["THINGSBOARD_PORT"])
-    
-    tb_gateway.start()
-    kura_devices_handler.start()
+    kura_devices_handler = KuraDevicesHandler(configuration_handler.configuration["KURA_PREFIX"], client,
+                                              configuration=configuration_handler.configuration, scheduler=scheduler, cluster=cluster,
+                                              flow_control=kura_loop)
+    tb_gateway = create_tb_gateway(configuration_handler.configuration)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.pause()
\ No newline at end of file
+    if loop is not None:
+        loop.run_until_complete(run_event_loop())
+    else:
+        start_modules()
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.pause()
\ No newline at end of file
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from sub-millisecond decodes to slow acknowledgements
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Monotonic count, optionally kept per device as well as overall.
+
+    A per device counter 'name' is exposed as 'name_total' and
+    'name_by_device_total{device="..."}'."""
+
+    def __init__(self, name, help, per_device=False):
+        self.name = name
+        self.help = help
+        self.per_device = per_device
+        self.value = 0
+        self.devices = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1, device=None):
+        with self.__lock:
+            self.value += amount
+            if self.per_device and device is not None:
+                self.devices[device] = self.devices.get(device, 0) + amount
+
+    def render(self):
+        with self.__lock:
+            value = self.value
+            devices = dict(self.devices)
+        lines = ["# HELP {}_total {}".format(self.name, self.help),
+                 "# TYPE {}_total counter".format(self.name),
+                 "{}_total {}".format(self.name, _format(value))]
+        if self.per_device:
+            lines.append("# HELP {}_by_device_total {}, per device".format(self.name, self.help))
+            lines.append("# TYPE {}_by_device_total counter".format(self.name))
+            lines.extend('{}_by_device_total{{device="{}"}} {}'.format(self.name, _escape(device), _format(count))
+                         for device, count in sorted(devices.items()))
+        return lines
+
+
+class Histogram(object):
+    """Distribution of observed values, in cumulative buckets"""
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value, count=1):
+        """Records 'count' observations of 'value'"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += count
+            self.sum += value * count
+
+    def render(self):
+        with self.__lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append("{}_sum {}".format(self.name, _format(total)))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+
+class Gauge(object):
+    """Value read from 'function()' when the metrics are rendered"""
+
+    def __init__(self, name, help, function, type="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+
+    def render(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.error("Error reading metric '{}': {}".format(self.name, e))
+            return []
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type),
+                "{} {}".format(self.name, _format(value))]
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        """Returns the metric already registered with the same name, if any"""
+        with self.__lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def unregister(self, name):
+        with self.__lock:
+            self.metrics.pop(name, None)
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help, per_device=False):
+    return REGISTRY.register(Counter(name, help, per_device))
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, buckets))
+
+
+def gauge(name, help, function, type="gauge"):
+    """Registered again on every call, the last function wins"""
+    metric = Gauge(name, help, function, type)
+    REGISTRY.unregister(name)
+    return REGISTRY.register(metric)
+
+
+class MetricsServer(object):
+    """Serves the registry in the Prometheus text format on GET /metrics"""
+
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self.__server = None
+        self.__thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("{} - {}".format(self.address_string(), format % args))
+
+        self.__server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="metrics-server")
+        self.__thread.daemon = True
+        self.__thread.start()
+        logger.info("Serving metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+    def stop(self):
+        if self.__server is None:
+            return
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+        self.__server = None
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+from scheduler import Backoff
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two loop_misc() calls, which send the keepalives and detect dead connections
+MISC_INTERVAL = 1
+
+
+class MqttLoop(object):
+    """Drives a paho client from an asyncio event loop instead of its network thread.
+
+    Replaces loop_start(): it must be created before connect() as it sets the
+    socket callbacks of the client. The socket is watched with the loop's
+    add_reader() and add_writer(), so the message callbacks of the client run
+    on the loop. paho calls the socket callbacks from whichever thread
+    publishes, so they only post a call to the loop, which looks at the socket
+    and want_write() of the client itself when it runs. Lost connections are
+    retried from the default executor with an exponential backoff, reset once
+    a connection is accepted, until stop() is called, which is done before
+    disconnecting. Reading can be paused for backpressure, the broker's messages
+    then wait in the socket buffers. The methods can be called from any thread."""
+
+    def __init__(self, loop, client, min_reconnect_delay=1, max_reconnect_delay=120):
+        self.loop = loop
+        self.client = client
+        self.backoff = Backoff(min_reconnect_delay, max_reconnect_delay)
+        self.__sock = None
+        self.__writing = False
+        self.__paused = False
+        self.__misc_handle = None
+        self.__reconnect_handle = None
+        self.__connecting = False
+        self.__running = False
+        self.__on_connect = client.on_connect
+        client.on_connect = self.__on_connect_handler
+        client.on_socket_open = self.__on_socket_open
+        client.on_socket_close = self.__on_socket_close
+        client.on_socket_register_write = self.__on_socket_write_changed
+        client.on_socket_unregister_write = self.__on_socket_write_changed
+
+    def start(self, connect=False):
+        """With 'connect', makes the first connection of a client set up with connect_async()"""
+        self.__running = True
+        self.__call(self.__misc)
+        if connect:
+            self.__call(self.__reconnect)
+
+    def stop(self):
+        self.__running = False
+        self.__call(self.__cancel)
+
+    def pause_reading(self):
+        """Stops reading the socket, the messages already read are still handled"""
+        self.__call(self.__set_paused, True)
+
+    def resume_reading(self):
+        self.__call(self.__set_paused, False)
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        """Applies to the next connection loss"""
+        self.backoff = Backoff(min_delay, max_delay)
+
+    def __call(self, callback, *args):
+        # Always through the loop's queue, so the calls run in the order they are made
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def __cancel(self):
+        for handle in (self.__misc_handle, self.__reconnect_handle):
+            if handle is not None:
+                handle.cancel()
+        self.__misc_handle = None
+        self.__reconnect_handle = None
+
+    def __on_connect_handler(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            # Accepted by the broker, not only connected
+            self.backoff.reset()
+        if self.__on_connect is not None:
+            self.__on_connect(client, userdata, flags, rc, *args)
+
+    def __on_socket_open(self, client, userdata, sock):
+        self.__call(self.__add_socket, sock)
+
+    def __on_socket_close(self, client, userdata, sock):
+        self.__call(self.__remove_socket, sock)
+        if self.__running:
+            self.__call(self.__schedule_reconnect)
+
+    def __on_socket_write_changed(self, client, userdata, sock):
+        self.__call(self.__update_writer)
+
+    def __add_socket(self, sock):
+        # The socket object rather than its number, which a new socket may already reuse
+        if sock.fileno() < 0:
+            return
+        self.__sock = sock
+        self.__writing = False
+        if not self.__paused:
+            self.loop.add_reader(sock, self.__read)
+        self.__update_writer()
+
+    def __remove_socket(self, sock):
+        if sock is not self.__sock:
+            return
+        # The writer first, a closed socket can only be found while it is still registered
+        if self.__writing:
+            self.loop.remove_writer(sock)
+        self.loop.remove_reader(sock)
+        self.__sock = None
+        self.__writing = False
+
+    def __set_paused(self, paused):
+        if paused == self.__paused:
+            return
+        self.__paused = paused
+        if self.__sock is None or self.__sock.fileno() < 0:
+            # Watched or not once the next socket is added
+            return
+        if paused:
+            self.loop.remove_reader(self.__sock)
+        else:
+            self.loop.add_reader(self.__sock, self.__read)
+
+    def __update_writer(self):
+        """Watches the socket for writing while the client has packets to send"""
+        if self.__sock is None or self.__sock.fileno() < 0:
+            # Closed, its removal is on its way
+            return
+        want_write = self.client.want_write()
+        if want_write and not self.__writing:
+            self.loop.add_writer(self.__sock, self.__write)
+        elif not want_write and self.__writing:
+            self.loop.remove_writer(self.__sock)
+        self.__writing = want_write
+
+    def __read(self):
+        self.client.loop_read()
+        self.__update_writer()
+
+    def __write(self):
+        self.client.loop_write()
+        self.__update_writer()
+
+    def __misc(self):
+        self.client.loop_misc()
+        self.__update_writer()
+        if self.__running:
+            self.__misc_handle = self.loop.call_later(MISC_INTERVAL, self.__misc)
+
+    def __schedule_reconnect(self):
+        if self.__reconnect_handle is not None or self.__connecting or not self.__running:
+            return
+        delay = self.backoff.next_delay()
+        logger.debug("Reconnecting in {:.1f}s".format(delay))
+        self.__reconnect_handle = self.loop.call_later(delay, self.__reconnect)
+
+    def __reconnect(self):
+        self.__reconnect_handle = None
+        if not self.__running or self.__connecting:
+            return
+        # Name resolution and the TCP connection block, the loop keeps running meanwhile
+        self.__connecting = True
+        future = self.loop.run_in_executor(None, self.client.reconnect)
+        future.add_done_callback(self.__reconnected)
+
+    def __reconnected(self, future):
+        self.__connecting = False
+        error = future.exception()
+        if error is None:
+            if not self.__running:
+                # Stopped meanwhile
+                self.client.disconnect()
+            return
+        if isinstance(error, OSError):
+            logger.warning("Unable to reconnect: {}".format(error))
+        else:
+            logger.error("Unable to reconnect: {}".format(error))
+        self.__schedule_reconnect()
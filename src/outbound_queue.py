@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+from scheduler import Backoff
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_EXTENSION = ".seg"
+CURSOR_FILE = "cursor"
+# Records the publisher keeps failing on are moved here instead of blocking the ones behind them
+DEAD_LETTER_FILE = "dead_letter.jsonl"
+# The replay position is persisted after this many acknowledged records
+CURSOR_SYNC_RECORDS = 100
+
+
+class OutboundQueue(object):
+    """Disk-backed FIFO for the messages that can't be published to ThingsBoard.
+
+    Records are appended as JSON lines to capped segment files. Appends are
+    buffered and written by a single thread with one fsync per group. Once
+    'is_connected()' returns True, the records are replayed oldest first
+    through 'publisher(kind, data)' at no more than 'replay_rate' messages per
+    second. Each record keeps the original 'ts' of its samples. Delivery is
+    at-least-once: a record is only consumed when its PUBACK arrives, or
+    right away when the publisher returns None as it had nothing to send.
+    The PUBACKs are reported through acknowledge(mid). While
+    'is_in_flight(mid)' returns True the MQTT client still holds the message
+    and sends it again on its own, so it is waited for instead of published again.
+
+    A record that isn't acknowledged is retried with an exponential backoff
+    for as long as it takes. One the publisher raises on can't be sent as it
+    is: after 'max_attempts' it is appended to the dead letter file of the
+    folder and skipped."""
+
+    def __init__(self, folder, publisher, is_connected, segment_bytes=4194304, max_segments=64,
+                 sync_interval=0.5, sync_batch=100, replay_rate=50, ack_timeout=10, max_attempts=3, is_in_flight=None):
+        self.folder = folder
+        self.publisher = publisher
+        self.is_connected = is_connected
+        self.is_in_flight = is_in_flight
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(2, max_segments)
+        self.sync_interval = sync_interval
+        self.sync_batch = sync_batch
+        self.replay_interval = 1.0 / replay_rate if replay_rate > 0 else 0
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.__retry_backoff = Backoff(1, 30)
+        self.__condition = threading.Condition()
+        # Apart from the queue one, the PUBACKs come from the network thread and mustn't wait for the disk
+        self.__ack_condition = threading.Condition()
+        self.__acks = set()
+        self.__awaiting_acks = False
+        self.__buffer = []
+        self.__segments = {}
+        self.__available = 0
+        self.__write_seq = 0
+        self.__write_file = None
+        self.__write_size = 0
+        self.__read_seq = 0
+        self.__read_offset = 0
+        self.__read_count = 0
+        self.__read_file = None
+        self.__uncommitted = 0
+        self.__running = False
+        self.__writer_thread = None
+        self.__replay_thread = None
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.__load()
+        self.__running = True
+        self.__writer_thread = threading.Thread(target=self.__writer_loop, name="outbound-queue-writer")
+        self.__writer_thread.daemon = True
+        self.__writer_thread.start()
+        self.__replay_thread = threading.Thread(target=self.__replay_loop, name="outbound-queue-replay")
+        self.__replay_thread.daemon = True
+        self.__replay_thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        with self.__ack_condition:
+            self.__ack_condition.notify_all()
+        for thread in (self.__writer_thread, self.__replay_thread):
+            if thread is not None:
+                thread.join()
+        self.__writer_thread = None
+        self.__replay_thread = None
+        with self.__condition:
+            self.__write_buffer()
+            self.__save_cursor()
+            for f in (self.__write_file, self.__read_file):
+                if f is not None:
+                    f.close()
+            self.__write_file = None
+            self.__read_file = None
+
+    def configure(self, replay_rate, max_attempts):
+        self.replay_interval = 1.0 / replay_rate if replay_rate > 0 else 0
+        self.max_attempts = max(1, max_attempts)
+
+    def put(self, kind, data):
+        line = (json.dumps({ "kind": kind, "data": data }) + "\n").encode("utf-8")
+        with self.__condition:
+            self.__buffer.append(line)
+            if len(self.__buffer) >= self.sync_batch:
+                self.__condition.notify_all()
+
+    def acknowledge(self, mid):
+        """Wakes up the replay when 'mid' is the message it waits for"""
+        with self.__ack_condition:
+            if self.__awaiting_acks:
+                self.__acks.add(mid)
+                self.__ack_condition.notify_all()
+
+    def sync(self):
+        """Writes the records put so far to disk now"""
+        with self.__condition:
+            self.__write_buffer()
+
+    def drain(self, handler):
+        """Hands the pending records of a queue that is not started to 'handler(kind, data)',
+        oldest first, and returns their number. The files are left for delete()."""
+        with self.__condition:
+            self.__load()
+            count = 0
+            try:
+                while True:
+                    record = self.__read_record()
+                    if record is None:
+                        break
+                    (kind, data), offset = record
+                    handler(kind, data)
+                    self.__commit(offset)
+                    count += 1
+            finally:
+                for f in (self.__write_file, self.__read_file):
+                    if f is not None:
+                        f.close()
+                self.__write_file = None
+                self.__read_file = None
+            return count
+
+    def move(self, folder):
+        """Moves the segments and the cursor of a queue that is not started to 'folder', the
+        other files, like the dead letter file, stay where they are. Returns False when there
+        was no segment to move."""
+        names = [name for name in os.listdir(self.folder) if name.endswith(SEGMENT_EXTENSION) or name.startswith(CURSOR_FILE)]
+        if not any(name.endswith(SEGMENT_EXTENSION) for name in names):
+            return False
+        os.makedirs(folder, exist_ok=True)
+        for name in names:
+            os.replace(os.path.join(self.folder, name), os.path.join(folder, name))
+        return True
+
+    def delete(self):
+        """Removes the segments and the cursor of a queue that is not started, and its folder
+        unless something else is left in it, like the dead letter file"""
+        for name in os.listdir(self.folder):
+            if name.endswith(SEGMENT_EXTENSION) or name.startswith(CURSOR_FILE):
+                os.remove(os.path.join(self.folder, name))
+        try:
+            os.rmdir(self.folder)
+        except OSError:
+            logger.info("Outbound queue folder '{}' kept, it isn't empty".format(self.folder))
+
+    def is_empty(self):
+        with self.__condition:
+            return not self.__buffer and self.__available == 0
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__buffer) + self.__available
+
+    def __segment_path(self, seq):
+        return os.path.join(self.folder, "{:012d}{}".format(seq, SEGMENT_EXTENSION))
+
+    def __load(self):
+        for name in sorted(os.listdir(self.folder)):
+            if not name.endswith(SEGMENT_EXTENSION):
+                continue
+            seq = int(name[:-len(SEGMENT_EXTENSION)])
+            with open(self.__segment_path(seq), 'rb') as f:
+                self.__segments[seq] = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(65536), b""))
+
+        seq, offset = self.__load_cursor()
+        if seq not in self.__segments:
+            seq = next((s for s in sorted(self.__segments) if s > seq), None)
+            offset = 0
+        if seq is not None:
+            with open(self.__segment_path(seq), 'rb') as f:
+                consumed = f.read(offset).count(b"\n")
+            self.__read_seq, self.__read_offset, self.__read_count = seq, offset, consumed
+            self.__available = sum(count for s, count in self.__segments.items() if s > seq)
+            self.__available += self.__segments[seq] - consumed
+
+        # A new segment is always opened so that a torn record left by a crash
+        # can only be found at the end of a segment that is not written anymore
+        self.__write_seq = max(self.__segments) + 1 if self.__segments else 0
+        self.__open_write_segment()
+        if seq is None:
+            self.__read_seq, self.__read_offset, self.__read_count = self.__write_seq, 0, 0
+        if self.__available:
+            logger.info("{} records pending in the outbound queue".format(self.__available))
+
+    def __load_cursor(self):
+        try:
+            with open(os.path.join(self.folder, CURSOR_FILE), 'r') as f:
+                cursor = json.load(f)
+            return cursor["segment"], cursor["offset"]
+        except FileNotFoundError:
+            return -1, 0
+        except (ValueError, KeyError) as e:
+            logger.error("Invalid outbound queue cursor, replaying from the oldest segment: {}".format(e))
+            return -1, 0
+
+    def __save_cursor(self):
+        path = os.path.join(self.folder, CURSOR_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({ "segment": self.__read_seq, "offset": self.__read_offset }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.__uncommitted = 0
+
+    def __open_write_segment(self):
+        self.__write_file = open(self.__segment_path(self.__write_seq), 'ab')
+        self.__write_size = self.__write_file.tell()
+        self.__segments.setdefault(self.__write_seq, 0)
+
+    def __rotate(self):
+        self.__write_file.flush()
+        os.fsync(self.__write_file.fileno())
+        self.__write_file.close()
+        self.__write_seq += 1
+        self.__open_write_segment()
+        while len(self.__segments) > self.max_segments:
+            self.__drop_oldest_segment()
+
+    def __drop_oldest_segment(self):
+        seq = min(self.__segments)
+        lost = self.__segments.pop(seq)
+        if seq == self.__read_seq:
+            lost -= self.__read_count
+            self.__advance_read_segment()
+        self.__available -= lost
+        os.remove(self.__segment_path(seq))
+        logger.warning("Outbound queue full, {} records dropped".format(lost))
+
+    def __advance_read_segment(self):
+        if self.__read_file is not None:
+            self.__read_file.close()
+            self.__read_file = None
+        self.__read_seq = min(s for s in self.__segments if s > self.__read_seq)
+        self.__read_offset = 0
+        self.__read_count = 0
+
+    def __write_buffer(self):
+        if not self.__buffer or self.__write_file is None:
+            return
+        lines, self.__buffer = self.__buffer, []
+        for line in lines:
+            if self.__write_size >= self.segment_bytes:
+                self.__rotate()
+            self.__write_file.write(line)
+            self.__write_size += len(line)
+            self.__segments[self.__write_seq] += 1
+        self.__write_file.flush()
+        os.fsync(self.__write_file.fileno())
+        self.__available += len(lines)
+
+    def __writer_loop(self):
+        with self.__condition:
+            while self.__running:
+                self.__condition.wait(self.sync_interval)
+                try:
+                    self.__write_buffer()
+                except OSError as e:
+                    logger.error("Error writing the outbound queue: {}".format(e))
+                self.__condition.notify_all()
+
+    def __read_record(self):
+        """Returns the next (kind, data) record and the offset after it, or None when the segment has been consumed."""
+        while True:
+            if self.__read_file is None:
+                self.__read_file = open(self.__segment_path(self.__read_seq), 'rb')
+            self.__read_file.seek(self.__read_offset)
+            line = self.__read_file.readline()
+            if line.endswith(b"\n"):
+                offset = self.__read_file.tell()
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                    return (record["kind"], record["data"]), offset
+                except (ValueError, KeyError) as e:
+                    logger.error("Skipping corrupted outbound queue record: {}".format(e))
+                    self.__commit(offset)
+                    continue
+            if self.__read_seq == self.__write_seq:
+                return None
+            # Consumed (or torn by a crash) segment
+            seq = self.__read_seq
+            self.__segments.pop(seq)
+            self.__advance_read_segment()
+            os.remove(self.__segment_path(seq))
+            self.__save_cursor()
+
+    def __commit(self, offset):
+        self.__read_offset = offset
+        self.__read_count += 1
+        self.__available -= 1
+        self.__uncommitted += 1
+        if self.__uncommitted >= CURSOR_SYNC_RECORDS:
+            self.__save_cursor()
+
+    def __wait_for_ack(self, info):
+        mid = info.mid()
+        deadline = time.monotonic() + self.ack_timeout
+        while True:
+            with self.__ack_condition:
+                while mid not in self.__acks and not info.is_published():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.__running:
+                        break
+                    self.__ack_condition.wait(remaining)
+                else:
+                    return True
+            # Outside the lock, the MQTT client reports the PUBACKs holding its own
+            if not self.__running or self.is_in_flight is None or not self.is_in_flight(mid):
+                return False
+            # Sent again on reconnection, publishing it again would only duplicate it
+            logger.debug("Outbound queue record {} still in flight, waiting for its PUBACK".format(mid))
+            deadline = time.monotonic() + self.ack_timeout
+
+    def __pause(self, delay):
+        """Waits 'delay' seconds or until stopped, the writer notifications don't cut it short"""
+        deadline = time.monotonic() + delay
+        while self.__running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.__condition.wait(remaining)
+
+    def __dead_letter(self, kind, data, error):
+        try:
+            with open(os.path.join(self.folder, DEAD_LETTER_FILE), 'a') as f:
+                f.write(json.dumps({ "kind": kind, "data": data, "error": str(error) }) + "\n")
+        except (OSError, TypeError, ValueError) as e:
+            logger.error("Unable to write the outbound queue dead letter file: {}".format(e))
+
+    def __replay_loop(self):
+        attempts = 0
+        while True:
+            with self.__condition:
+                while self.__running and (self.__available == 0 or not self.is_connected()):
+                    self.__condition.wait(1.0)
+                if not self.__running:
+                    return
+                record = self.__read_record()
+                if record is None:
+                    self.__condition.wait(self.sync_interval)
+                    continue
+                seq = self.__read_seq
+
+            started = time.monotonic()
+            (kind, data), offset = record
+            error = None
+            with self.__ack_condition:
+                # The PUBACK may arrive before the publisher returns the mid
+                self.__acks.clear()
+                self.__awaiting_acks = True
+            try:
+                info = self.publisher(kind, data)
+                # None when nothing in the record was worth sending
+                acked = info is None or self.__wait_for_ack(info)
+            except Exception as e:
+                # Encoding or validation errors, sending the record again won't help
+                error = e
+                acked = False
+            finally:
+                with self.__ack_condition:
+                    self.__awaiting_acks = False
+
+            with self.__condition:
+                if error is not None:
+                    attempts += 1
+                    if attempts < self.max_attempts:
+                        logger.error("Error replaying outbound queue record, attempt {}/{}: {}".format(attempts, self.max_attempts, error))
+                        self.__pause(self.__retry_backoff.next_delay())
+                        continue
+                    logger.error("Moving outbound queue record to '{}' after {} attempts: {}".format(DEAD_LETTER_FILE, attempts, error))
+                    self.__dead_letter(kind, data, error)
+                elif not acked:
+                    # Lost connection or broker not answering, retry the same record, it might be delivered twice
+                    self.__pause(self.__retry_backoff.next_delay())
+                    continue
+                attempts = 0
+                self.__retry_backoff.reset()
+                if seq == self.__read_seq:
+                    self.__commit(offset)
+                if self.__available == 0:
+                    logger.info("Outbound queue replayed")
+                    self.__save_cursor()
+
+            elapsed = time.monotonic() - started
+            if elapsed < self.replay_interval:
+                time.sleep(self.replay_interval - elapsed)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import kura_payload_handler
+from kura_payload_handler import DecodedPayload
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessDecoder(object):
+    """Decodes batches of raw Kura payloads (gzip + protobuf) in a pool of
+    worker processes, so that decoding is not limited by the GIL."""
+
+    def __init__(self, processes=None, fast=False):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.fast = fast
+        self.__pool = None
+
+    def start(self):
+        logger.debug("Starting {} decoding processes".format(self.processes))
+        # The gateway runs several threads, which can't be safely forked
+        self.__pool = multiprocessing.get_context("spawn").Pool(self.processes)
+
+    def stop(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def decode(self, payloads):
+        results = self.__pool.apply(kura_payload_handler.decode_payloads, (payloads, self.fast))
+        return [DecodedPayload(*result) if result is not None else None for result in results]
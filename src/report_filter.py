@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import logging
+import telemetry_aggregator
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReportRule(object):
+    """Report-by-exception settings of the channels matching the device, asset and channel patterns.
+
+    A value is only forwarded when it differs from the last forwarded one by
+    more than 'deadband' (absolute) or 'deadband_percent' (relative to the
+    last forwarded value), or by anything at all for non numeric values or
+    when no deadband is set. 'min_interval' seconds must have passed since the
+    last forwarded value. A value is forwarded anyway once 'max_silence'
+    seconds have passed since the last forwarded one."""
+
+    __slots__ = ("device", "asset", "channel", "deadband", "deadband_percent", "min_interval", "max_silence")
+
+    def __init__(self, device="*", asset="*", channel="*", deadband=None, deadband_percent=None, min_interval=0,
+                 max_silence=None):
+        for name, pattern in (("device", device), ("asset", asset), ("channel", channel)):
+            if not isinstance(pattern, str):
+                raise ValueError("'{}' of a report rule must be a pattern string, not {!r}".format(name, pattern))
+        for name, value in (("deadband", deadband), ("deadband_percent", deadband_percent), ("min_interval", min_interval),
+                            ("max_silence", max_silence)):
+            if value is None and name != "min_interval":
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError("'{}' of a report rule must be a non negative number, not {!r}".format(name, value))
+        self.device = device
+        self.asset = asset
+        self.channel = channel
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.min_interval = min_interval
+        self.max_silence = max_silence
+
+    def matches(self, device, asset, channel):
+        return (fnmatch.fnmatchcase(device, self.device) and fnmatch.fnmatchcase(asset or "", self.asset)
+                and fnmatch.fnmatchcase(channel, self.channel))
+
+
+def parse_rules(rules):
+    """Builds the ReportRules of a REPORT_RULES setting, raises ValueError when one of them is invalid"""
+    parsed = []
+    for rule in rules or []:
+        if not isinstance(rule, dict):
+            raise ValueError("Invalid report rule {!r}, expected an object".format(rule))
+        try:
+            parsed.append(ReportRule(**rule))
+        except TypeError as e:
+            # Misspelled or unknown keys
+            raise ValueError("Invalid report rule {!r}: {}".format(rule, e))
+    return parsed
+
+
+class ChannelReport(object):
+    """Report-by-exception state of a single channel"""
+
+    __slots__ = ("rule", "last_value", "last_sent")
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.last_value = None
+        self.last_sent = None
+
+    def accept(self, value, now=None):
+        """Returns whether the value must be forwarded, and if so records it as the last forwarded one"""
+        if now is None:
+            now = time.monotonic()
+        if self.last_sent is not None:
+            elapsed = now - self.last_sent
+            rule = self.rule
+            if elapsed < rule.min_interval:
+                return False
+            if rule.max_silence is None or elapsed < rule.max_silence:
+                if not self.__changed(value):
+                    return False
+        self.last_value = value
+        self.last_sent = now
+        return True
+
+    def __changed(self, value):
+        last = self.last_value
+        numeric = (isinstance(value, (int, float)) and isinstance(last, (int, float))
+                   and not isinstance(value, bool) and not isinstance(last, bool))
+        rule = self.rule
+        if not numeric or (rule.deadband is None and rule.deadband_percent is None):
+            return value != last
+        delta = abs(value - last)
+        if rule.deadband is not None and delta > rule.deadband:
+            return True
+        if rule.deadband_percent is not None and delta > abs(last) * rule.deadband_percent / 100.0:
+            return True
+        return False
+
+
+class ReportFilter(object):
+    """Resolves the report-by-exception rule of every channel, the first matching rule wins.
+
+    Rules are configured as a list of dicts with the ReportRule arguments. The
+    heartbeat after 'max_silence' is sent with the next value received, a
+    channel that doesn't publish anything is not reported. The telemetry
+    channels matching one of the 'aggregated' rules (the AggregationRule
+    arguments) are not filtered, their aggregates need every sample."""
+
+    def __init__(self, rules=None, aggregated=None):
+        self.rules = parse_rules(rules)
+        self.aggregated = telemetry_aggregator.parse_rules(aggregated)
+        self.__reports = {}
+        self.__lock = threading.Lock()
+
+    def set_rules(self, rules, aggregated=None):
+        """Replaces the rules, the channels get a new ChannelReport when they resolve theirs again.
+        Raises ValueError, leaving the current rules in place, when one of them is invalid"""
+        rules = parse_rules(rules)
+        aggregated = telemetry_aggregator.parse_rules(aggregated)
+        with self.__lock:
+            self.rules = rules
+            self.aggregated = aggregated
+            self.__reports = {}
+
+    def channel_report(self, device, asset, channel, telemetry=True):
+        """Returns the ChannelReport of a channel, or None when no rule applies to it"""
+        key = (device, asset, channel, telemetry)
+        with self.__lock:
+            if key not in self.__reports:
+                if telemetry and any(rule.matches(device, channel) for rule in self.aggregated):
+                    self.__reports[key] = None
+                    return None
+                rule = next((rule for rule in self.rules if rule.matches(device, asset, channel)), None)
+                self.__reports[key] = ChannelReport(rule) if rule is not None else None
+            return self.__reports[key]
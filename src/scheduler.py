@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The heap is rebuilt without the cancelled calls once they are more than half of it
+COMPACT_MIN_SIZE = 64
+
+
+class ScheduledCall(object):
+    """Handle of a call registered in a Scheduler"""
+
+    __slots__ = ("deadline", "callback", "args", "cancelled", "handle")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        # The asyncio TimerHandle of the call, with a LoopScheduler
+        self.handle = None
+
+    def cancel(self):
+        """O(1): the call is only marked, it is discarded when it reaches the top of the heap"""
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """Runs callbacks at given times from a single thread.
+
+    The calls are kept in a heap ordered by deadline and the thread sleeps on a
+    condition variable until the earliest one is due, so it doesn't wake up
+    while nothing is pending. Callbacks must be short, they delay the calls
+    due after them, the blocking ones go through run_blocking()."""
+
+    def __init__(self, name="scheduler"):
+        self.name = name
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__cancelled = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__executor = None
+        self.__running = False
+
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+            # A single worker keeps the writes in the order they were requested
+            self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name + "-io")
+        self.__thread = threading.Thread(target=self.__run, name=self.name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+            executor, self.__executor = self.__executor, None
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+        if executor is not None:
+            # The pending writes are completed
+            executor.shutdown(wait=True)
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """Calls 'callback(*args)' once time.monotonic() reaches 'deadline'"""
+        call = ScheduledCall(deadline, callback, args)
+        with self.__condition:
+            heapq.heappush(self.__heap, (deadline, next(self.__counter), call))
+            if self.__heap[0][2] is call:
+                self.__condition.notify()
+        return call
+
+    def cancel(self, call):
+        if call is None or call.cancelled:
+            return
+        call.cancel()
+        with self.__condition:
+            self.__cancelled += 1
+            if self.__cancelled > COMPACT_MIN_SIZE and self.__cancelled * 2 > len(self.__heap):
+                self.__heap = [entry for entry in self.__heap if not entry[2].cancelled]
+                heapq.heapify(self.__heap)
+                self.__cancelled = 0
+
+    def run_blocking(self, callback, *args):
+        """Runs a callback doing disk or network I/O from the executor, right away on the
+        calling thread when the scheduler isn't running"""
+        with self.__condition:
+            executor = self.__executor
+        if executor is not None:
+            try:
+                future = executor.submit(callback, *args)
+                future.add_done_callback(self.__log_error)
+                return
+            except RuntimeError:
+                # Stopped meanwhile
+                pass
+        callback(*args)
+
+    @staticmethod
+    def __log_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Error in blocking call: {}".format(future.exception()))
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__heap) - self.__cancelled
+
+    def __next_due(self):
+        """Waits for the next call due, returns None when stopped"""
+        with self.__condition:
+            while self.__running:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                deadline, _, call = self.__heap[0]
+                if call.cancelled:
+                    heapq.heappop(self.__heap)
+                    self.__cancelled = max(0, self.__cancelled - 1)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.__condition.wait(remaining)
+                    continue
+                heapq.heappop(self.__heap)
+                # Cancelling from now on has no effect
+                call.cancelled = True
+                return call
+        return None
+
+    def __run(self):
+        while True:
+            call = self.__next_due()
+            if call is None:
+                return
+            try:
+                call.callback(*call.args)
+            except Exception as e:
+                logger.exception("Error in scheduled call {}: {}".format(call.callback, e))
+
+
+class LoopScheduler(object):
+    """Scheduler running its callbacks on an asyncio event loop, for the asyncio runtime.
+
+    The loop is run by its owner, stop() only cancels the pending calls. call_at(), call_later() and cancel() can be used from any
+    thread. Cancelling a call cancels its timer in the loop too, so that asyncio
+    drops it from its heap instead of keeping it until its deadline."""
+
+    def __init__(self, loop, name="scheduler"):
+        self.loop = loop
+        self.name = name
+        self.__pending = set()
+        self.__lock = threading.Lock()
+        self.__stopped = False
+
+    def start(self):
+        self.__stopped = False
+
+    def stop(self):
+        with self.__lock:
+            self.__stopped = True
+            calls = list(self.__pending)
+            for call in calls:
+                call.cancel()
+            self.__pending.clear()
+        self.__in_loop_call(self.__cancel_timers, calls)
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """Calls 'callback(*args)' from the loop once time.monotonic() reaches 'deadline'"""
+        call = ScheduledCall(deadline, callback, args)
+        with self.__lock:
+            self.__pending.add(call)
+        self.__in_loop_call(self.__schedule, call)
+        return call
+
+    def cancel(self, call):
+        if call is None or call.cancelled:
+            return
+        call.cancel()
+        with self.__lock:
+            self.__pending.discard(call)
+        self.__in_loop_call(self.__cancel_timers, [call])
+
+    def run_blocking(self, callback, *args):
+        """Runs a callback doing disk or network I/O from the default executor when called
+        on the loop, right away from any other thread"""
+        if not self.__in_loop():
+            callback(*args)
+            return
+        future = self.loop.run_in_executor(None, callback, *args)
+        future.add_done_callback(self.__log_error)
+
+    @staticmethod
+    def __log_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Error in blocking call: {}".format(future.exception()))
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__pending)
+
+    def __in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def __in_loop_call(self, callback, *args):
+        """Calls 'callback(*args)' right away on the loop, from the loop otherwise. The
+        asyncio handles aren't thread-safe, and in the order of the requests, a timer is
+        created before it is cancelled."""
+        if self.__in_loop():
+            callback(*args)
+            return
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Loop closed, its timers are gone with it
+            pass
+
+    def __schedule(self, call):
+        if not call.cancelled:
+            # The loop clock is time.monotonic() too, but not necessarily
+            call.handle = self.loop.call_later(max(0, call.deadline - time.monotonic()), self.__run, call)
+
+    @staticmethod
+    def __cancel_timers(calls):
+        for call in calls:
+            if call.handle is not None:
+                call.handle.cancel()
+                call.handle = None
+
+    def __run(self, call):
+        call.handle = None
+        with self.__lock:
+            if call.cancelled or self.__stopped:
+                return
+            self.__pending.discard(call)
+            # Cancelling from now on has no effect
+            call.cancelled = True
+        try:
+            call.callback(*call.args)
+        except Exception as e:
+            logger.exception("Error in scheduled call {}: {}".format(call.callback, e))
+
+
+class Backoff(object):
+    """Exponential backoff with jitter and an optional cap on the number of retries"""
+
+    def __init__(self, initial=1, maximum=300, factor=2, jitter=0.5, max_retries=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.max_retries = max_retries
+        self.retries = 0
+
+    def reset(self):
+        self.retries = 0
+
+    def next_delay(self):
+        """Returns the delay before the next retry, or None when no retries are left"""
+        if self.max_retries is not None and self.retries >= self.max_retries:
+            return None
+        delay = min(self.maximum, self.initial * self.factor ** self.retries)
+        self.retries += 1
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -2,42 +2,265 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import metrics
+from mqtt_loop import MqttLoop
+import os
+from outbound_queue import OutboundQueue
+import re
+from scheduler import Scheduler
 from tb_mqtt_client.tb_gateway_mqtt import TBGatewayMqttClient
+from telemetry_aggregator import TelemetryAggregator
+from telemetry_batcher import SAMPLES_DROPPED, TelemetryBatcher
 import time
 import threading
+import zlib
 
 logger = logging.getLogger(__name__)
 
+# Acknowledgements of messages not sent by the batcher (connects, RPC replies...)
+# also reach the publish callback, so unmatched ones are only kept up to this amount
+MAX_EARLY_ACKS = 1000
+# Settings of the aggregator, changing one of them ends the current window early
+AGGREGATION_KEYS = ("AGGREGATION_WINDOW", "AGGREGATION_RULES")
+# Number of connections the outbound queues were split over, in the queue folder
+CONNECTIONS_FILE = "connections"
+# Queues whose records are moved to other connections after a change of their number
+STAGING_FOLDER = "resharding"
+
+MESSAGES_PUBLISHED = metrics.counter("thingsboard_messages_published", "Device messages published to ThingsBoard", per_device=True)
+BATCHES_PUBLISHED = metrics.counter("thingsboard_batches_published", "Batches published to ThingsBoard")
+HANDLER_SECONDS = metrics.histogram("thingsboard_handler_seconds", "Time spent handling a device event in the TB gateway handler")
+PUBACK_SECONDS = metrics.histogram("thingsboard_puback_seconds", "Latency from publishing a batch to its PUBACK")
+REQUEST_TIMEOUTS = metrics.counter("thingsboard_request_timeouts", "ThingsBoard attribute and RPC requests not answered in time")
+
+class UplinkShard(object):
+    """One of the gateway connections to ThingsBoard, with its own outbound queue.
+
+    Shard 0 keeps the queue folder of the single connection setup, the other
+    ones use a 'shard-<index>' subfolder of it."""
+
+    def __init__(self, index, hostname, key, port, configuration, scheduler, report_latency, loop=None):
+        self.index = index
+        self.port = port
+        self.loop = loop
+        settings = self.__settings(configuration)
+        self.connection = TBGatewayMqttClient(hostname, key, scheduler,
+                                              configuration.get("THINGSBOARD_ATTRIBUTE_REQUEST_TIMEOUT", 30),
+                                              configuration.get("THINGSBOARD_RPC_REQUEST_TIMEOUT", 30),
+                                              # The values are checked against the channel types of the devices instead
+                                              configuration.get("THINGSBOARD_VALIDATION", "off"),
+                                              configuration.get("THINGSBOARD_CODEC", "json"),
+                                              configuration.get("THINGSBOARD_JSON_BACKEND", "auto"))
+        self.connection.set_publish_callback(self.__publish_ack_handler)
+        self.connection.set_request_timeout_callback(REQUEST_TIMEOUTS.inc)
+        self.connection.max_inflight_messages_set(settings.get("max_inflight", configuration.get("THINGSBOARD_MAX_INFLIGHT", 20)))
+        self.connection.max_queued_messages_set(settings.get("max_queued", configuration.get("THINGSBOARD_MAX_QUEUED", 0)))
+        self.min_reconnect_delay = settings.get("min_reconnect_delay", configuration.get("THINGSBOARD_MIN_RECONNECT_DELAY", 1))
+        self.max_reconnect_delay = settings.get("max_reconnect_delay", configuration.get("THINGSBOARD_MAX_RECONNECT_DELAY", 120))
+        folder = configuration.get("THINGSBOARD_QUEUE_FOLDER", "conf/outbound_queue")
+        if index > 0:
+            folder = os.path.join(folder, "shard-{}".format(index))
+        self.outbound_queue = OutboundQueue(folder, self.publish, self.is_connected,
+                                            configuration.get("THINGSBOARD_QUEUE_SEGMENT_BYTES", 4194304),
+                                            configuration.get("THINGSBOARD_QUEUE_MAX_SEGMENTS", 64),
+                                            replay_rate=settings.get("queue_replay_rate",
+                                                                     configuration.get("THINGSBOARD_QUEUE_REPLAY_RATE", 50)),
+                                            max_attempts=configuration.get("THINGSBOARD_QUEUE_MAX_ATTEMPTS", 3),
+                                            is_in_flight=self.connection.is_in_flight)
+        self.report_latency = report_latency
+        self.__pending_publishes = {}
+        self.__early_acks = {}
+        self.__publish_lock = threading.Lock()
+
+    def __settings(self, configuration):
+        shard_settings = configuration.get("THINGSBOARD_SHARD_SETTINGS") or []
+        return shard_settings[self.index] if self.index < len(shard_settings) else {}
+
+    def reconfigure(self, configuration):
+        """Applies the settings that don't need a new connection"""
+        settings = self.__settings(configuration)
+        self.connection.validation_set(configuration.get("THINGSBOARD_VALIDATION", "off"))
+        self.connection.attr_request_timeout = configuration.get("THINGSBOARD_ATTRIBUTE_REQUEST_TIMEOUT", 30)
+        self.connection.rpc_request_timeout = configuration.get("THINGSBOARD_RPC_REQUEST_TIMEOUT", 30)
+        self.connection.max_inflight_messages_set(settings.get("max_inflight", configuration.get("THINGSBOARD_MAX_INFLIGHT", 20)))
+        self.connection.max_queued_messages_set(settings.get("max_queued", configuration.get("THINGSBOARD_MAX_QUEUED", 0)))
+        self.min_reconnect_delay = settings.get("min_reconnect_delay", configuration.get("THINGSBOARD_MIN_RECONNECT_DELAY", 1))
+        self.max_reconnect_delay = settings.get("max_reconnect_delay", configuration.get("THINGSBOARD_MAX_RECONNECT_DELAY", 120))
+        self.connection.reconnect_delay_set(self.min_reconnect_delay, self.max_reconnect_delay)
+        self.outbound_queue.configure(settings.get("queue_replay_rate", configuration.get("THINGSBOARD_QUEUE_REPLAY_RATE", 50)),
+                                      configuration.get("THINGSBOARD_QUEUE_MAX_ATTEMPTS", 3))
+
+    def is_connected(self):
+        return self.connection._TBDeviceMqttClient__is_connected
+
+    def connect(self):
+        logger.debug("Connecting TB gateway connection {}".format(self.index))
+        # paho reconnects on its own, each connection with its own backoff
+        self.connection.connect(min_reconnect_delay=self.min_reconnect_delay, timeout=self.max_reconnect_delay, port=self.port,
+                                loop_adapter=self.__loop_adapter if self.loop is not None else None)
+
+    def __loop_adapter(self, client, min_reconnect_delay, max_reconnect_delay):
+        return MqttLoop(self.loop, client, min_reconnect_delay, max_reconnect_delay)
+
+    def start(self):
+        self.outbound_queue.start()
+
+    def stop(self, devices):
+        self.outbound_queue.stop()
+        if self.is_connected():
+            for device in devices:
+                self.connection.gw_disconnect_device(device)
+        self.connection.disconnect()
+
+    def send(self, kind, data):
+        # Keep the order: while older data is waiting on disk, new data waits behind it
+        if self.is_connected() and self.outbound_queue.is_empty():
+            logger.debug("Sending {} batch of {} devices through connection {}".format(kind, len(data), self.index))
+            try:
+                self.publish(kind, data)
+                return
+            except Exception as e:
+                # The queue retries it and sets it aside in its dead letter file if it keeps failing
+                logger.error("Error publishing {} batch through connection {}, storing it: {}".format(kind, self.index, e))
+        else:
+            logger.debug("Storing {} batch of {} devices of connection {}".format(kind, len(data), self.index))
+        self.outbound_queue.put(kind, data)
+
+    def store_each(self, kind, data):
+        """Stores the data of each device on its own, so only the devices whose data can't be stored are dropped"""
+        for device, values in data.items():
+            try:
+                self.outbound_queue.put(kind, {device: values})
+            except Exception as e:
+                SAMPLES_DROPPED.inc(len(values) if kind == "telemetry" else 1, device)
+                logger.error("Dropping the {} of device '{}', they can't be stored: {}".format(kind, device, e))
+
+    def publish(self, kind, data):
+        if kind == "telemetry":
+            info = self.connection.gw_send_telemetry_batch(data)
+        else:
+            info = self.connection.gw_send_attributes_batch(data)
+        if info is None:
+            # Nothing valid in the batch
+            return None
+        BATCHES_PUBLISHED.inc()
+        for device, records in data.items():
+            MESSAGES_PUBLISHED.inc(len(records) if kind == "telemetry" else 1, device)
+        self.__track_publish(info)
+        return info
+
+    def __track_publish(self, info):
+        sent = time.monotonic()
+        with self.__publish_lock:
+            acked = self.__early_acks.pop(info.mid(), None)
+            if acked is None:
+                self.__pending_publishes[info.mid()] = sent
+        if acked is not None:
+            PUBACK_SECONDS.observe(max(0, acked - sent))
+            self.report_latency(max(0, acked - sent))
+
+    def __publish_ack_handler(self, mid):
+        acked = time.monotonic()
+        self.outbound_queue.acknowledge(mid)
+        with self.__publish_lock:
+            sent = self.__pending_publishes.pop(mid, None)
+            if sent is None:
+                # PUBACK processed before the publish call returned
+                if len(self.__early_acks) >= MAX_EARLY_ACKS:
+                    self.__early_acks.clear()
+                self.__early_acks[mid] = acked
+                return
+        PUBACK_SECONDS.observe(acked - sent)
+        self.report_latency(acked - sent)
+
+
 class TbGatewayHandler(object):
+    """Forwards the Kura devices to ThingsBoard through THINGSBOARD_CONNECTIONS
+    gateway connections. Each device always goes through the same connection,
+    picked by a stable hash of its name, so the order of its messages is kept.
+    The number of connections is stored next to the queues. When it changed
+    since the last run, the devices don't all map to the same connections
+    anymore, so at start the records of every queue are moved to the queues
+    of their devices' current connections, before any of them connects. With
+    an asyncio 'loop', the connections are driven from it."""
 
-    def __init__(self, hostname, key, data_provider, port=1883):
+    def __init__(self, hostname, key, data_provider, port=1883, configuration=None, scheduler=None, loop=None):
         self.hostname = hostname
         self.port = port
         self.key = key
-        self.tb_connection = TBGatewayMqttClient(self.hostname, self.key)
+        self.configuration = configuration if configuration is not None else {}
         self.data_provider = data_provider
         self.tb_devices = []
+        self.batcher = TelemetryBatcher(self.__send_batch,
+                                        self.configuration.get("THINGSBOARD_BATCH_WINDOW", 0.2),
+                                        self.configuration.get("THINGSBOARD_BATCH_MAX_WINDOW", 2.0),
+                                        self.configuration.get("THINGSBOARD_BATCH_MAX_SAMPLES", 500),
+                                        self.configuration.get("THINGSBOARD_BATCH_MAX_BYTES", 65536))
+        # A scheduler created here is also started and stopped here, shared by the connections
+        self.__own_scheduler = scheduler is None
+        self.scheduler = Scheduler("tb-scheduler") if scheduler is None else scheduler
+        self.shards = [UplinkShard(index, self.hostname, self.key, self.port, self.configuration,
+                                   self.scheduler, self.batcher.report_latency, loop)
+                       for index in range(max(1, self.configuration.get("THINGSBOARD_CONNECTIONS", 1)))]
+        self.tb_connection = self.shards[0].connection
+        self.aggregator = TelemetryAggregator(self.__send_telemetry_data,
+                                              self.configuration.get("AGGREGATION_WINDOW", 10),
+                                              self.configuration.get("AGGREGATION_RULES"))
+
+    def reconfigure(self, configuration):
+        """Applies the settings that don't need new connections: batching, aggregation,
+        validation, request timeouts, flow control, reconnection delays and queue replay"""
+        if any(self.configuration.get(key) != configuration.get(key) for key in AGGREGATION_KEYS):
+            self.aggregator.configure(configuration.get("AGGREGATION_WINDOW", 10), configuration.get("AGGREGATION_RULES"))
+        self.configuration = configuration
+        self.batcher.configure(self.configuration.get("THINGSBOARD_BATCH_WINDOW", 0.2),
+                               self.configuration.get("THINGSBOARD_BATCH_MAX_WINDOW", 2.0),
+                               self.configuration.get("THINGSBOARD_BATCH_MAX_SAMPLES", 500),
+                               self.configuration.get("THINGSBOARD_BATCH_MAX_BYTES", 65536))
+        for shard in self.shards:
+            shard.reconfigure(self.configuration)
 
     def is_connected(self):
-        return self.tb_connection._TBDeviceMqttClient__is_connected
+        return all(shard.is_connected() for shard in self.shards)
 
     def start(self):
         logger.debug("Starting TB gateway connection")
+        if self.__own_scheduler:
+            self.scheduler.start()
         self.data_provider.register_callback(self.__data_update_handler)
-        self.tb_connection.connect(port=self.port)
-        while not self.is_connected():
-            time.sleep(0.1)
-        self.tb_connection.gw_set_server_side_rpc_request_handler(self.__rpc_request_handler)
-        logger.debug("TB gateway connected")
+        staged = self.__stage_queues()
+        # Not waiting for the connections: until they are up, the data is stored in the outbound queues
+        for shard in self.shards:
+            shard.connection.gw_set_server_side_rpc_request_handler(self.__rpc_request_handler)
+            shard.start()
+        self.__requeue_staged(staged)
+        for shard in self.shards:
+            shard.connect()
+        self.batcher.start()
+        self.aggregator.start(self.scheduler)
+        # Devices already running when the connection is rebuilt
+        for device_id in self.data_provider.get_devices():
+            self.__connect_device(device_id)
+        logger.debug("TB gateway started")
         
     def stop(self):
         logger.debug("Stopping TB gateway connection")
-        if self.is_connected():
-            for device in self.tb_devices:
-                self.tb_connection.gw_disconnect_device(device)
-        self.tb_connection.disconnect()
+        self.data_provider.unregister_callback(self.__data_update_handler)
+        self.aggregator.stop()
+        self.batcher.stop()
+        for shard in self.shards:
+            shard.stop([device for device in self.tb_devices if self.__shard(device) is shard])
+        if self.__own_scheduler:
+            self.scheduler.stop()
 
     def __data_update_handler(self, device_id, event_type, value):
+        started = time.perf_counter()
+        try:
+            self.__handle_data_update(device_id, event_type, value)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started)
+
+    def __handle_data_update(self, device_id, event_type, value):
         logger.debug("New value for event '{}' from '{}': {}".format(event_type, device_id, value))
         if event_type == "status_changed":
             if value == "started":
@@ -49,18 +272,20 @@ class TbGatewayHandler(object):
         elif event_type == "attribute_changed":
             self.__send_attribute_data(device_id, value)
         elif event_type == "telemetry_changed":
-            self.__send_telemetry_data(device_id, value)
+            value = self.aggregator.add(device_id, value)
+            if value:
+                self.__send_telemetry_data(device_id, value)
 
     def __connect_device(self, name):
         if name not in self.tb_devices:
-            self.tb_connection.gw_connect_device(name)
+            self.__shard(name).connection.gw_connect_device(name)
             self.tb_devices.append(name)
         else:
             logger.warning("Device '{}' already connected".format(name))
 
     def __disconnect_device(self, name):
         if name in self.tb_devices:
-            self.tb_connection.gw_disconnect_device(name)
+            self.__shard(name).connection.gw_disconnect_device(name)
             self.tb_devices.remove(name)
         else:
             logger.warning("Device '{}' not connected".format(name))
@@ -71,13 +296,105 @@ class TbGatewayHandler(object):
             return
         if ts is None:
             ts = int(round(time.time() * 1000))
-        self.tb_connection.gw_send_telemetry(name, { "ts": ts, "values": values})
+        self.batcher.add_telemetry(name, ts, values)
 
     def __send_attribute_data(self, name, values):
         if name not in self.tb_devices:
             logger.warning("Device '{}' not connected".format(name))
             return
-        self.tb_connection.gw_send_attributes(name, values)
+        self.batcher.add_attributes(name, values)
+
+    def __stage_queues(self):
+        """Moves the records of every queue aside when the number of connections changed since
+        the last run, and returns the staged queue folders, oldest first. The folders staged
+        by a run that stopped before requeuing them are returned too, before the new ones."""
+        folder = self.configuration.get("THINGSBOARD_QUEUE_FOLDER", "conf/outbound_queue")
+        staging = os.path.join(folder, STAGING_FOLDER)
+        os.makedirs(staging, exist_ok=True)
+        staged = sorted(os.listdir(staging))
+        if self.__stored_connections(folder) != len(self.shards):
+            queues = [(0, folder)]
+            for name in os.listdir(folder):
+                match = re.match(r"shard-(\d+)$", name)
+                if match is not None:
+                    queues.append((int(match.group(1)), os.path.join(folder, name)))
+            # Numbered after the ones already staged, the folders are requeued in the order of their names
+            number = int(staged[-1].split("-")[0]) + 1 if staged else 0
+            for index, queue_folder in sorted(queues):
+                name = "{:06d}-shard-{}".format(number, index)
+                if OutboundQueue(queue_folder, None, None).move(os.path.join(staging, name)):
+                    staged.append(name)
+                if index >= len(self.shards):
+                    try:
+                        os.rmdir(queue_folder)
+                    except OSError:
+                        logger.info("Outbound queue folder '{}' kept, it isn't empty".format(queue_folder))
+            # Once the records are staged, they are requeued at the next start if this one stops halfway
+            self.__store_connections(folder)
+        return [os.path.join(staging, name) for name in staged]
+
+    def __stored_connections(self, folder):
+        try:
+            with open(os.path.join(folder, CONNECTIONS_FILE), 'r') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.error("Invalid number of connections stored with the outbound queues: {}".format(e))
+            return None
+
+    def __store_connections(self, folder):
+        path = os.path.join(folder, CONNECTIONS_FILE)
+        with open(path + ".tmp", 'w') as f:
+            f.write(str(len(self.shards)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def __requeue_staged(self, staged):
+        """Moves the records of the staged queues to the queues of their devices' connections"""
+        for queue_folder in staged:
+            queue = OutboundQueue(queue_folder, None, None)
+            try:
+                count = queue.drain(self.__requeue)
+                # On disk in the current queues before being removed from the staged one
+                for shard in self.shards:
+                    shard.outbound_queue.sync()
+                queue.delete()
+            except OSError as e:
+                logger.error("Unable to requeue the outbound queue '{}': {}".format(queue_folder, e))
+                continue
+            if count:
+                logger.info("{} records of '{}' moved to the queues of {} connections".format(count, queue_folder, len(self.shards)))
+
+    def __requeue(self, kind, data):
+        parts = {}
+        for device, values in data.items():
+            parts.setdefault(self.__shard(device), {})[device] = values
+        for shard, part in parts.items():
+            shard.outbound_queue.put(kind, part)
+
+    def __shard(self, name):
+        # crc32 rather than hash(), which changes between runs for strings
+        return self.shards[zlib.crc32(name.encode("utf-8")) % len(self.shards)]
+
+    def __send_batch(self, telemetry, attributes):
+        for kind, data in (("telemetry", telemetry), ("attributes", attributes)):
+            if not data:
+                continue
+            if len(self.shards) == 1:
+                parts = {self.shards[0]: data}
+            else:
+                parts = {}
+                for device, values in data.items():
+                    parts.setdefault(self.__shard(device), {})[device] = values
+            for shard, part in parts.items():
+                try:
+                    shard.send(kind, part)
+                except Exception as e:
+                    # Not even storable, like values the serializer can't encode
+                    logger.error("Unable to send or store {} batch of connection {}: {}".format(kind, shard.index, e))
+                    shard.store_each(kind, part)
 
     def __rpc_request_handler(self, content):
         req_id = content["data"]["id"]
@@ -93,6 +410,6 @@ class TbGatewayHandler(object):
             logger.debug("We need to write the vale '{}' in the '{}' channel of '{}' device".format(new_value, channel, device_id))
         elif action == "getValue":
             data = self.data_provider.get_device_data(device_id, channel)
-            self.tb_connection.gw_send_rpc_reply(device_id, req_id, data)
+            self.__shard(device_id).connection.gw_send_rpc_reply(device_id, req_id, data)
         else:
             logger.warn("Unknown action received")
\ No newline at end of file
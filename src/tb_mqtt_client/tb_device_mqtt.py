@@ -1,12 +1,13 @@
 import paho.mqtt.client as paho
 import logging
+import re
 import time
-import queue
-from json import loads, dumps
 from jsonschema import Draft7Validator
 import ssl
 from jsonschema import ValidationError
 import threading
+from .tb_json import JsonSerializer
+from .tb_scheduler import Scheduler
 
 KV_SCHEMA = {
     "type": "object",
@@ -60,6 +61,75 @@ TS_KV_VALIDATOR = Draft7Validator(TS_KV_SCHEMA)
 DEVICE_TS_KV_VALIDATOR = Draft7Validator(DEVICE_TS_KV_SCHEMA)
 DEVICE_TS_OR_KV_VALIDATOR = Draft7Validator(DEVICE_TS_OR_KV_SCHEMA)
 
+# "jsonschema" runs the validators above, "structural" the equivalent hand written
+# type checks below and "off" trusts the caller
+VALIDATION_MODES = ("jsonschema", "structural", "off")
+KV_TYPES = (int, float, str, bool)
+# The "patternProperties" pattern of the schemas, the keys it doesn't match (an empty one) aren't checked
+KV_KEY_PATTERN = re.compile(".")
+
+
+def _check_kv(data, min_properties=1):
+    if not isinstance(data, dict):
+        raise ValidationError("{!r} is not of type 'object'".format(data))
+    if len(data) < min_properties:
+        raise ValidationError("{!r} does not have enough properties".format(data))
+    for key, value in data.items():
+        if not isinstance(value, KV_TYPES) and KV_KEY_PATTERN.search(key):
+            raise ValidationError("{!r} of '{}' is not of type 'integer', 'string', 'boolean', 'number'".format(value, key))
+
+
+def _check_ts_kv(data):
+    if not isinstance(data, dict):
+        raise ValidationError("{!r} is not of type 'object'".format(data))
+    for key, value in data.items():
+        if key == "ts":
+            if not (type(value) is int or type(value) is float and value.is_integer()):
+                raise ValidationError("{!r} is not of type 'integer'".format(value))
+        elif key == "values":
+            _check_kv(value)
+        else:
+            raise ValidationError("Additional properties are not allowed ('{}' was unexpected)".format(key))
+
+
+def _check_device_ts_kv(data):
+    if not isinstance(data, list):
+        raise ValidationError("{!r} is not of type 'array'".format(data))
+    for item in data:
+        _check_ts_kv(item)
+
+
+def _check_device_ts_or_kv(data):
+    if not isinstance(data, list):
+        raise ValidationError("{!r} is not of type 'array'".format(data))
+    for item in data:
+        try:
+            _check_ts_kv(item)
+        except ValidationError:
+            try:
+                _check_kv(item)
+            except ValidationError:
+                raise ValidationError("{!r} is not valid under any of the given schemas".format(item))
+
+
+class StructuralValidator:
+    """Same checks as a Draft7Validator of one of the schemas above, without the jsonschema machinery"""
+
+    def __init__(self, check):
+        self.check = check
+
+    def validate(self, data):
+        self.check(data)
+
+
+STRUCTURAL_VALIDATORS = {
+    id(RPC_VALIDATOR): StructuralValidator(lambda data: _check_kv(data, 0)),
+    id(KV_VALIDATOR): StructuralValidator(_check_kv),
+    id(TS_KV_VALIDATOR): StructuralValidator(_check_ts_kv),
+    id(DEVICE_TS_KV_VALIDATOR): StructuralValidator(_check_device_ts_kv),
+    id(DEVICE_TS_OR_KV_VALIDATOR): StructuralValidator(_check_device_ts_or_kv),
+}
+
 RPC_RESPONSE_TOPIC = 'v1/devices/me/rpc/response/'
 RPC_REQUEST_TOPIC = 'v1/devices/me/rpc/request/'
 ATTRIBUTES_TOPIC = 'v1/devices/me/attributes'
@@ -105,13 +175,21 @@ class TBPublishInfo():
     def mid(self):
         return self.messageInfo.mid
 
+    def is_published(self):
+        return self.messageInfo.is_published()
+
     def get(self):
         self.messageInfo.wait_for_publish()
         return self.messageInfo.rc
 
 
 class TBDeviceMqttClient:
-    def __init__(self, host, token=None):
+    def __init__(self, host, token=None, scheduler=None, attr_request_timeout=30, rpc_request_timeout=30,
+                 validation="jsonschema", json_backend="auto"):
+        if validation not in VALIDATION_MODES:
+            raise ValueError("Unknown validation mode '{}', expected one of {}".format(validation, VALIDATION_MODES))
+        self.validation = validation
+        self._serializer = JsonSerializer(json_backend)
         self._client = paho.Client()
         self.__host = host
         if token == "":
@@ -120,11 +198,20 @@ class TBDeviceMqttClient:
             self._client.username_pw_set(token)
         self._lock = threading.Lock()
         self._attr_request_dict = {}
-        self.__timeout_queue = queue.Queue()
-        self.__timeout_thread = None
+        self.attr_request_timeout = attr_request_timeout
+        self.rpc_request_timeout = rpc_request_timeout
+        self.__attr_request_timers = {}
+        self.__rpc_request_timers = {}
+        # Runs the request timeouts, with call_later() and cancel(). A scheduler created here
+        # is also started and stopped here
+        self.__own_scheduler = scheduler is None
+        self._scheduler = Scheduler() if scheduler is None else scheduler
         self.__is_connected = False
+        self.__mqtt_loop = None
         self.__device_on_server_side_rpc_response = None
         self.__connect_callback = None
+        self.__publish_callback = None
+        self.__request_timeout_callback = None
         self.__device_max_sub_id = 0
         self.__device_client_rpc_number = 0
         self.__device_sub_dict = {}
@@ -144,7 +231,8 @@ class TBDeviceMqttClient:
 
     def _on_publish(self, client, userdata, result):
         log.debug("Data published to ThingsBoard!")
-        pass
+        if self.__publish_callback:
+            self.__publish_callback(result)
 
     def _on_connect(self, client, userdata, flags, rc, *extra_params):
         result_codes = {
@@ -154,8 +242,6 @@ class TBDeviceMqttClient:
             4: "bad username or password",
             5: "not authorised",
         }
-        if self.__connect_callback:
-            self.__connect_callback(client, userdata, flags, rc, *extra_params)
         if rc == 0:
             self.__is_connected = True
             log.info("connection SUCCESS")
@@ -169,12 +255,20 @@ class TBDeviceMqttClient:
                                                                                  explanation=result_codes[rc]))
             else:
                 log.error("connection FAIL with unknown error")
+        # Called once connected, so the callback can already publish
+        if self.__connect_callback:
+            self.__connect_callback(client, userdata, flags, rc, *extra_params)
 
     def _on_disconnect(self, client, userdata, rc):
         log.debug("MQTT client disconnected")
         self.__is_connected = False
 
-    def connect(self, callback=None, min_reconnect_delay=1, timeout=120, tls=False, port=1883, ca_certs=None, cert_file=None, key_file=None):
+    def connect(self, callback=None, min_reconnect_delay=1, timeout=120, tls=False, port=1883, ca_certs=None, cert_file=None, key_file=None,
+                loop_adapter=None):
+        """Returns right away, the connection is made and retried in the background, from a paho
+        network thread or from a 'loop_adapter'. It is called with the paho client and the reconnect
+        delays, before connecting, and returns the object driving the client instead of its network
+        thread, with start(connect), stop() and reconnect_delay_set(min_delay, max_delay)"""
         if tls:
             self._client.tls_set(ca_certs=ca_certs,
                                  certfile=cert_file,
@@ -183,29 +277,36 @@ class TBDeviceMqttClient:
                                  tls_version=ssl.PROTOCOL_TLSv1_2,
                                  ciphers=None)
             self._client.tls_insecure_set(False)
-        self._client.connect(self.__host, port)
-        self._client.loop_start()
         self.__connect_callback = callback
         self.reconnect_delay_set(min_reconnect_delay, timeout)
-        self.__timeout_thread = threading.Thread(target=self.__timeout_check)
-        self.__timeout_thread.do_run = True
-        self.__timeout_thread.start()
+        if loop_adapter is not None:
+            self.__mqtt_loop = loop_adapter(self._client, min_reconnect_delay, timeout)
+        self._client.connect_async(self.__host, port)
+        if self.__mqtt_loop is not None:
+            self.__mqtt_loop.start(connect=True)
+        else:
+            self._client.loop_start()
+        if self.__own_scheduler:
+            self._scheduler.start()
 
     def disconnect(self):
+        if self.__mqtt_loop is not None:
+            self.__mqtt_loop.stop()
         self._client.disconnect()
-        if self.__timeout_thread:
-            self.__timeout_thread.do_run = False
-            self.__timeout_thread.join()
-            self.__timeout_thread = None
+        if self.__own_scheduler:
+            self._scheduler.stop()
         log.info("Disconnected from ThingsBoard!")
 
     def _on_message(self, client, userdata, message):
-        content = self._decode(message)
+        try:
+            content = self._decode(message)
+        except ValueError as e:
+            log.error("Unable to decode the message on '{}': {}".format(message.topic, e))
+            return
         self._on_decoded_message(content, message)
 
-    @staticmethod
-    def _decode(message):
-        content = loads(message.payload.decode("utf-8"))
+    def _decode(self, message):
+        content = self._serializer.loads(message.payload)
         log.debug(content)
         log.debug(message.topic)
         return content
@@ -218,6 +319,14 @@ class TBDeviceMqttClient:
             log.error(e)
             raise e
 
+    def _validate(self, validator, data):
+        """Validates according to the validation mode of the client"""
+        if self.validation == "off":
+            return
+        if self.validation == "structural":
+            validator = STRUCTURAL_VALIDATORS[id(validator)]
+        self.validate(validator, data)
+
     def _on_decoded_message(self, content, message):
         if message.topic.startswith(RPC_REQUEST_TOPIC):
             request_id = message.topic[len(RPC_REQUEST_TOPIC):len(message.topic)]
@@ -226,7 +335,12 @@ class TBDeviceMqttClient:
         elif message.topic.startswith(RPC_RESPONSE_TOPIC):
             with self._lock:
                 request_id = int(message.topic[len(RPC_RESPONSE_TOPIC):len(message.topic)])
-                self.__device_client_rpc_dict.pop(request_id)(request_id, content, None)
+                self._scheduler.cancel(self.__rpc_request_timers.pop(request_id, None))
+                callback = self.__device_client_rpc_dict.pop(request_id, None)
+                if callback is not None:
+                    callback(request_id, content, None)
+                else:
+                    log.warning("RPC response {} received after its timeout".format(request_id))
         elif message.topic == ATTRIBUTES_TOPIC:
             with self._lock:
                 # callbacks for everything
@@ -248,7 +362,17 @@ class TBDeviceMqttClient:
             with self._lock:
                 req_id = int(message.topic[len(ATTRIBUTES_TOPIC+"/response/"):])
                 # pop callback and use it
-                self._attr_request_dict.pop(req_id)(content, None)
+                callback = self._pop_attr_request_callback(req_id)
+                if callback is not None:
+                    callback(content, None)
+                else:
+                    log.warning("Attributes response {} received after its timeout".format(req_id))
+
+    def validation_set(self, validation):
+        """Set the validation mode of the data sent, one of VALIDATION_MODES."""
+        if validation not in VALIDATION_MODES:
+            raise ValueError("Unknown validation mode '{}', expected one of {}".format(validation, VALIDATION_MODES))
+        self.validation = validation
 
     def max_inflight_messages_set(self, inflight):
         """Set the maximum number of messages with QoS>0 that can be part way through their network flow at once.
@@ -260,12 +384,19 @@ class TBDeviceMqttClient:
         Defaults to 0. 0 means unlimited. When the queue is full, any further outgoing messages would be dropped."""
         self._client.max_queued_messages_set(queue_size)
 
+    def is_in_flight(self, mid):
+        """Whether the QoS>0 message is still held by paho, which sends it again after reconnecting"""
+        with self._client._out_message_mutex:
+            return mid in self._client._out_messages
+
     def reconnect_delay_set(self, min_delay=1, max_delay=120):
         """The client will automatically retry connection. Between each attempt it will wait a number of seconds
          between min_delay and max_delay. When the connection is lost, initially the reconnection attempt is delayed
          of min_delay seconds. It’s doubled between subsequent attempt up to max_delay. The delay is reset to min_delay
           when the connection complete (e.g. the CONNACK is received, not just the TCP connection is established)."""
         self._client.reconnect_delay_set(min_delay, max_delay)
+        if self.__mqtt_loop is not None:
+            self.__mqtt_loop.reconnect_delay_set(min_delay, max_delay)
 
     def send_rpc_reply(self, req_id, resp, quality_of_service=1, wait_for_publish=False):
         if quality_of_service != 0 and quality_of_service != 1:
@@ -275,22 +406,34 @@ class TBDeviceMqttClient:
         if wait_for_publish:
             info.wait_for_publish()
 
-    def send_rpc_call(self, method, params, callback):
-        self.validate(RPC_VALIDATOR, params)
+    def send_rpc_call(self, method, params, callback, timeout=None):
+        self._validate(RPC_VALIDATOR, params)
+        if timeout is None:
+            timeout = self.rpc_request_timeout
         with self._lock:
             self.__device_client_rpc_number += 1
             self.__device_client_rpc_dict.update({self.__device_client_rpc_number: callback})
             rpc_request_id = self.__device_client_rpc_number
+            self.__rpc_request_timers[rpc_request_id] = self._scheduler.call_later(timeout, self.__rpc_timeout_handler,
+                                                                                    rpc_request_id)
         payload = {"method": method, "params": params}
         self._client.publish(RPC_REQUEST_TOPIC + str(rpc_request_id),
-                             dumps(payload),
+                             self._serializer.dumps(payload),
                              qos=1)
 
     def set_server_side_rpc_request_handler(self, handler):
         self.__device_on_server_side_rpc_response = handler
 
+    def set_publish_callback(self, callback):
+        """Set a callback called with the message id (mid) of every message acknowledged by the broker."""
+        self.__publish_callback = callback
+
+    def set_request_timeout_callback(self, callback):
+        """Set a callback called without arguments for every attribute or RPC request not answered in time."""
+        self.__request_timeout_callback = callback
+
     def publish_data(self, data, topic, qos):
-        data = dumps(data)
+        data = self._serializer.dumps(data)
         if qos != 0 and qos != 1:
             log.exception("Quality of service (qos) value must be 0 or 1")
             raise TBQoSException("Quality of service (qos) value must be 0 or 1")
@@ -300,11 +443,11 @@ class TBDeviceMqttClient:
     def send_telemetry(self, telemetry, quality_of_service=1):
         if type(telemetry) is not list:
             telemetry = [telemetry]
-        self.validate(DEVICE_TS_OR_KV_VALIDATOR, telemetry)
+        self._validate(DEVICE_TS_OR_KV_VALIDATOR, telemetry)
         return self.publish_data(telemetry, TELEMETRY_TOPIC, quality_of_service)
 
     def send_attributes(self, attributes, quality_of_service=1):
-        self.validate(KV_VALIDATOR, attributes)
+        self._validate(KV_VALIDATOR, attributes)
         return self.publish_data(attributes, ATTRIBUTES_TOPIC, quality_of_service)
 
     def unsubscribe_from_attribute(self, subscription_id):
@@ -329,7 +472,7 @@ class TBDeviceMqttClient:
             log.debug("Subscribed to {key} with id {id}".format(key=key, id=self.__device_max_sub_id))
             return self.__device_max_sub_id
 
-    def request_attributes(self, client_keys=None, shared_keys=None, callback=None):
+    def request_attributes(self, client_keys=None, shared_keys=None, callback=None, timeout=None):
         if client_keys is None and shared_keys is None:
             log.error("There are no keys to request")
             return False
@@ -352,13 +495,38 @@ class TBDeviceMqttClient:
         attr_request_number = self._add_attr_request_callback(callback)
 
         info = self._client.publish(topic=ATTRIBUTES_TOPIC_REQUEST + str(self.__attr_request_number),
-                                    payload=dumps(msg),
+                                    payload=self._serializer.dumps(msg),
                                     qos=1)
-        self._add_timeout(attr_request_number, ts_in_millis + 30000)
+        if timeout is None:
+            timeout = self.attr_request_timeout
+        self._add_timeout(attr_request_number, ts_in_millis + int(timeout * 1000))
         return info
 
+    def pending_attribute_requests(self):
+        """Number of attribute requests waiting for their response"""
+        with self._lock:
+            return len(self._attr_request_dict)
+
+    def pending_rpc_requests(self):
+        """Number of client side RPC calls waiting for their response"""
+        with self._lock:
+            return len(self.__device_client_rpc_dict)
+
     def _add_timeout(self, attr_request_number, ts):
-        self.__timeout_queue.put({"ts": ts, "attribute_request_id": attr_request_number})
+        delay = max(0, ts - int(round(time.time() * 1000))) / 1000.0
+        timer = self._scheduler.call_later(delay, self.__attr_request_timeout_handler, attr_request_number)
+        with self._lock:
+            if attr_request_number in self._attr_request_dict:
+                self.__attr_request_timers[attr_request_number] = timer
+            else:
+                # Already answered
+                self._scheduler.cancel(timer)
+        return timer
+
+    def _pop_attr_request_callback(self, attr_request_id):
+        """Removes the request and its timeout, self._lock must be held"""
+        self._scheduler.cancel(self.__attr_request_timers.pop(attr_request_id, None))
+        return self._attr_request_dict.pop(attr_request_id, None)
 
     def _add_attr_request_callback(self, callback):
         with self._lock:
@@ -367,33 +535,20 @@ class TBDeviceMqttClient:
             attr_request_number = self.__attr_request_number
         return attr_request_number
 
-    def __timeout_check(self):
-        t = threading.currentThread()
-        while getattr(t, "do_run", True):
-            try:
-                try:
-                    item = self.__timeout_queue.get(False)
-                except queue.Empty:
-                    time.sleep(0.1)
-                    continue
-                if item is not None:
-                    while getattr(t, "do_run", True):
-                        current_ts_in_millis = int(round(time.time() * 1000))
-                        if current_ts_in_millis > item["ts"]:
-                            break
-                        else:
-                            time.sleep(0.1)
-                    with self._lock:
-                        callback = None
-                        if item.get("attribute_request_id"):
-                            if self._attr_request_dict.get(item["attribute_request_id"]):
-                                callback = self._attr_request_dict.pop(item["attribute_request_id"])
-                        elif item.get("rpc_request_id"):
-                            if self.__device_client_rpc_dict.get(item["rpc_request_id"]):
-                                callback = self.__device_client_rpc_dict.pop(item["rpc_request_id"])
-                    if callback is not None:
-                        callback(None, TBTimeoutException("Timeout while waiting for reply from ThingsBoard!"))
-                else:
-                    time.sleep(0.1)
-            except Exception as e:
-                log.warning(e)
+    def __attr_request_timeout_handler(self, attr_request_id):
+        with self._lock:
+            self.__attr_request_timers.pop(attr_request_id, None)
+            callback = self._attr_request_dict.pop(attr_request_id, None)
+        if callback is not None:
+            if self.__request_timeout_callback is not None:
+                self.__request_timeout_callback()
+            callback(None, TBTimeoutException("Timeout while waiting for reply from ThingsBoard!"))
+
+    def __rpc_timeout_handler(self, rpc_request_id):
+        with self._lock:
+            self.__rpc_request_timers.pop(rpc_request_id, None)
+            callback = self.__device_client_rpc_dict.pop(rpc_request_id, None)
+        if callback is not None:
+            if self.__request_timeout_callback is not None:
+                self.__request_timeout_callback()
+            callback(rpc_request_id, None, TBTimeoutException("Timeout while waiting for reply from ThingsBoard!"))
@@ -0,0 +1,327 @@
+import struct
+from .tb_json import JsonSerializer
+
+# Payload encoders of the gateway API uplink messages and decoders of the downlink ones.
+# The protobuf codec reads and writes the messages of ThingsBoard's transport.proto (see
+# transport.proto next to this file) straight in the wire format, without generated classes.
+# Decoded downlink messages have the shape of their JSON counterparts.
+
+# KeyValueType
+BOOLEAN_V = 0
+LONG_V = 1
+DOUBLE_V = 2
+STRING_V = 3
+JSON_V = 4
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Downlink messages, by the topics they are received on
+GATEWAY_RPC_REQUEST = "gateway_rpc_request"
+GATEWAY_ATTRIBUTES_UPDATE = "gateway_attributes_update"
+GATEWAY_ATTRIBUTES_RESPONSE = "gateway_attributes_response"
+RPC_REQUEST = "rpc_request"
+RPC_RESPONSE = "rpc_response"
+ATTRIBUTES_UPDATE = "attributes_update"
+ATTRIBUTES_RESPONSE = "attributes_response"
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+_double = struct.Struct("<d")
+
+
+class JsonGatewayCodec:
+    name = "json"
+
+    def __init__(self, serializer=None):
+        self.serializer = serializer if serializer is not None else JsonSerializer()
+
+    def connect(self, device, device_type=None):
+        return self.serializer.dumps({"device": device} if device_type is None else {"device": device, "type": device_type})
+
+    def disconnect(self, device):
+        return self.serializer.dumps({"device": device})
+
+    def telemetry(self, telemetry):
+        return self.serializer.dumps(telemetry)
+
+    def attributes(self, attributes):
+        return self.serializer.dumps(attributes)
+
+    def attributes_request(self, request_id, device, client, keys):
+        return self.serializer.dumps({"key": ",".join(keys), "device": device, "client": client, "id": request_id})
+
+    def rpc_reply(self, device, request_id, data):
+        return self.serializer.dumps({"device": device, "id": request_id, "data": data})
+
+    def decode(self, message_type, payload):
+        return self.serializer.loads(payload)
+
+
+def _varint(value):
+    if value < 0:
+        value &= 0xffffffffffffffff
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _key(field, wire_type):
+    return _varint(field << 3 | wire_type)
+
+
+def _bytes_field(field, value):
+    return _key(field, LENGTH_DELIMITED) + _varint(len(value)) + value
+
+
+def _string_field(field, value):
+    return _bytes_field(field, value.encode("utf-8")) if value else b""
+
+
+def _varint_field(field, value):
+    return _key(field, VARINT) + _varint(value) if value else b""
+
+
+def _key_value(key, value, dumps):
+    """KeyValueProto: key = 1, type = 2, bool_v = 3, long_v = 4, double_v = 5, string_v = 6, json_v = 7"""
+    encoded = _string_field(1, key)
+    if isinstance(value, bool):
+        encoded += _varint_field(3, int(value))
+    elif isinstance(value, int) and INT64_MIN <= value <= INT64_MAX:
+        encoded += _varint_field(2, LONG_V) + _varint_field(4, value)
+    elif isinstance(value, (int, float)):
+        encoded += _varint_field(2, DOUBLE_V)
+        if value:
+            encoded += _key(5, FIXED64) + _double.pack(value)
+    elif isinstance(value, str):
+        encoded += _varint_field(2, STRING_V) + _string_field(6, value)
+    else:
+        encoded += _varint_field(2, JSON_V) + _bytes_field(7, dumps(value))
+    return encoded
+
+
+def _key_values(field, values, dumps):
+    return b"".join(_bytes_field(field, _key_value(key, value, dumps)) for key, value in values.items())
+
+
+def _post_telemetry(records, dumps):
+    """PostTelemetryMsg: tsKvList = 1, of TsKvListProto: ts = 1, kv = 2"""
+    encoded = bytearray()
+    for record in records:
+        if "values" in record:
+            ts_kv = _varint_field(1, record.get("ts", 0)) + _key_values(2, record["values"], dumps)
+        else:
+            ts_kv = _key_values(2, record, dumps)
+        encoded += _bytes_field(1, ts_kv)
+    return bytes(encoded)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """{field: [values]} of a message, varints as ints, the other wire types as bytes"""
+    fields = {}
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == FIXED64:
+            value, pos = bytes(buf[pos:pos + 8]), pos + 8
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            value, pos = bytes(buf[pos:pos + length]), pos + length
+        elif wire_type == FIXED32:
+            value, pos = bytes(buf[pos:pos + 4]), pos + 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+        if pos > end:
+            raise ValueError("Truncated protobuf message")
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def _first(fields, field, default):
+    values = fields.get(field)
+    return values[-1] if values else default
+
+
+def _text(fields, field):
+    return _first(fields, field, b"").decode("utf-8")
+
+
+def _signed64(value):
+    return value - (1 << 64) if value & (1 << 63) else value
+
+
+def _json_or_text(text, loads):
+    try:
+        return loads(text)
+    except ValueError:
+        return text
+
+
+def _read_key_value(buf, loads):
+    """KeyValueProto as a (key, value) pair"""
+    fields = _fields(buf)
+    kv_type = _first(fields, 2, BOOLEAN_V)
+    if kv_type == BOOLEAN_V:
+        value = bool(_first(fields, 3, 0))
+    elif kv_type == LONG_V:
+        value = _signed64(_first(fields, 4, 0))
+    elif kv_type == DOUBLE_V:
+        value = _double.unpack(_first(fields, 5, b"\0" * 8))[0]
+    elif kv_type == STRING_V:
+        value = _text(fields, 6)
+    else:
+        value = _json_or_text(_text(fields, 7), loads)
+    return _text(fields, 1), value
+
+
+def _read_ts_key_values(values, loads):
+    """Repeated TsKvProto (ts = 1, kv = 2) as {key: value}"""
+    return dict(_read_key_value(_first(_fields(value), 2, b""), loads) for value in values)
+
+
+def _read_rpc_request(buf, loads):
+    """ToDeviceRpcRequestMsg: requestId = 1, methodName = 2, params = 3 (JSON)"""
+    fields = _fields(buf)
+    return {"id": _first(fields, 1, 0), "method": _text(fields, 2), "params": _json_or_text(_text(fields, 3), loads)}
+
+
+def _read_attributes_update(buf, loads):
+    """AttributeUpdateNotificationMsg: sharedUpdated = 1, sharedDeleted = 2"""
+    fields = _fields(buf)
+    update = _read_ts_key_values(fields.get(1, []), loads)
+    if fields.get(2):
+        update["deleted"] = [key.decode("utf-8") for key in fields[2]]
+    return update
+
+
+def _read_attributes_response(buf, loads):
+    """GetAttributeResponseMsg: requestId = 1, clientAttributeList = 2, sharedAttributeList = 3, error = 5"""
+    fields = _fields(buf)
+    response = {"client": _read_ts_key_values(fields.get(2, []), loads),
+                "shared": _read_ts_key_values(fields.get(3, []), loads)}
+    if fields.get(5):
+        response["error"] = _text(fields, 5)
+    return _first(fields, 1, 0), response
+
+
+def _read_gateway_rpc_request(buf, loads):
+    """GatewayDeviceRpcRequestMsg: deviceName = 1, rpcRequestMsg = 2"""
+    fields = _fields(buf)
+    return {"device": _text(fields, 1), "data": _read_rpc_request(_first(fields, 2, b""), loads)}
+
+
+def _read_gateway_attributes_update(buf, loads):
+    """GatewayAttributeUpdateNotificationMsg: deviceName = 1, notificationMsg = 2"""
+    fields = _fields(buf)
+    return {"device": _text(fields, 1), "data": _read_attributes_update(_first(fields, 2, b""), loads)}
+
+
+def _read_gateway_attributes_response(buf, loads):
+    """GatewayAttributeResponseMsg: deviceName = 1, responseMsg = 2"""
+    fields = _fields(buf)
+    request_id, response = _read_attributes_response(_first(fields, 2, b""), loads)
+    values = dict(response["client"], **response["shared"])
+    decoded = {"id": request_id, "device": _text(fields, 1), "values": values}
+    if len(values) == 1:
+        decoded["value"] = next(iter(values.values()))
+    return decoded
+
+
+def _read_rpc_response(buf, loads):
+    """ToServerRpcResponseMsg: requestId = 1, payload = 2 (JSON), error = 3"""
+    fields = _fields(buf)
+    if fields.get(3):
+        return {"error": _text(fields, 3)}
+    return _json_or_text(_text(fields, 2), loads)
+
+
+def _read_device_attributes_response(buf, loads):
+    return _read_attributes_response(buf, loads)[1]
+
+
+_DOWNLINK_READERS = {
+    GATEWAY_RPC_REQUEST: _read_gateway_rpc_request,
+    GATEWAY_ATTRIBUTES_UPDATE: _read_gateway_attributes_update,
+    GATEWAY_ATTRIBUTES_RESPONSE: _read_gateway_attributes_response,
+    RPC_REQUEST: lambda buf, loads: {key: value for key, value in _read_rpc_request(buf, loads).items() if key != "id"},
+    RPC_RESPONSE: _read_rpc_response,
+    ATTRIBUTES_UPDATE: _read_attributes_update,
+    ATTRIBUTES_RESPONSE: _read_device_attributes_response,
+}
+
+
+class ProtobufGatewayCodec:
+    name = "protobuf"
+
+    def __init__(self, serializer=None):
+        # JSON values and RPC replies are still JSON inside the messages
+        self.serializer = serializer if serializer is not None else JsonSerializer()
+
+    def connect(self, device, device_type=None):
+        """ConnectMsg: deviceName = 1, deviceType = 2"""
+        return _string_field(1, device) + _string_field(2, device_type or "")
+
+    def disconnect(self, device):
+        """DisconnectMsg: deviceName = 1"""
+        return _string_field(1, device)
+
+    def telemetry(self, telemetry):
+        """GatewayTelemetryMsg: msg = 1, of TelemetryMsg: deviceName = 1, msg = 3"""
+        encoded = bytearray()
+        for device, records in telemetry.items():
+            if isinstance(records, dict):
+                records = [records]
+            encoded += _bytes_field(1, _string_field(1, device) + _bytes_field(3, _post_telemetry(records, self.serializer.dumps)))
+        return bytes(encoded)
+
+    def attributes(self, attributes):
+        """GatewayAttributesMsg: msg = 1, of AttributesMsg: deviceName = 1, msg = 2 (PostAttributeMsg: kv = 1)"""
+        encoded = bytearray()
+        for device, values in attributes.items():
+            encoded += _bytes_field(1, _string_field(1, device) + _bytes_field(2, _key_values(1, values, self.serializer.dumps)))
+        return bytes(encoded)
+
+    def attributes_request(self, request_id, device, client, keys):
+        """GatewayAttributesRequestMsg: id = 1, deviceName = 2, client = 3, keys = 4"""
+        return (_varint_field(1, request_id) + _string_field(2, device) + _varint_field(3, int(client))
+                + b"".join(_bytes_field(4, key.encode("utf-8")) for key in keys))
+
+    def rpc_reply(self, device, request_id, data):
+        """GatewayRpcResponseMsg: deviceName = 1, id = 2, data = 3 (JSON)"""
+        return _string_field(1, device) + _varint_field(2, request_id) + _bytes_field(3, self.serializer.dumps(data))
+
+    def decode(self, message_type, payload):
+        try:
+            return _DOWNLINK_READERS[message_type](payload, self.serializer.loads)
+        except (IndexError, struct.error) as e:
+            raise ValueError("Truncated protobuf message: {}".format(e))
+
+
+CODECS = {
+    JsonGatewayCodec.name: JsonGatewayCodec,
+    ProtobufGatewayCodec.name: ProtobufGatewayCodec,
+}
@@ -1,7 +1,10 @@
 import logging
 import time
-from json import dumps
-from .tb_device_mqtt import TBDeviceMqttClient, DEVICE_TS_KV_VALIDATOR, KV_VALIDATOR
+from jsonschema import ValidationError
+from .tb_device_mqtt import TBDeviceMqttClient, TBPublishInfo, TBQoSException, DEVICE_TS_KV_VALIDATOR, KV_VALIDATOR, TS_KV_VALIDATOR
+from .tb_device_mqtt import RPC_REQUEST_TOPIC, RPC_RESPONSE_TOPIC, ATTRIBUTES_TOPIC, ATTRIBUTES_TOPIC_RESPONSE
+from . import tb_gateway_codec
+from .tb_gateway_codec import CODECS
 
 
 GATEWAY_ATTRIBUTES_TOPIC = "v1/gateway/attributes"
@@ -13,13 +16,36 @@ GATEWAY_RPC_TOPIC = "v1/gateway/rpc"
 log = logging.getLogger(__name__)
 
 
+def _downlink_message_type(topic):
+    if topic == GATEWAY_RPC_TOPIC:
+        return tb_gateway_codec.GATEWAY_RPC_REQUEST
+    if topic == GATEWAY_ATTRIBUTES_TOPIC:
+        return tb_gateway_codec.GATEWAY_ATTRIBUTES_UPDATE
+    if topic.startswith(GATEWAY_ATTRIBUTES_RESPONSE_TOPIC):
+        return tb_gateway_codec.GATEWAY_ATTRIBUTES_RESPONSE
+    if topic.startswith(RPC_REQUEST_TOPIC):
+        return tb_gateway_codec.RPC_REQUEST
+    if topic.startswith(RPC_RESPONSE_TOPIC):
+        return tb_gateway_codec.RPC_RESPONSE
+    if topic == ATTRIBUTES_TOPIC:
+        return tb_gateway_codec.ATTRIBUTES_UPDATE
+    if topic.startswith(ATTRIBUTES_TOPIC_RESPONSE):
+        return tb_gateway_codec.ATTRIBUTES_RESPONSE
+    return None
+
+
 class TBGatewayAPI():
     pass
 
 
 class TBGatewayMqttClient(TBDeviceMqttClient):
-    def __init__(self, host, token=None):
-        super().__init__(host, token)
+    def __init__(self, host, token=None, scheduler=None, attr_request_timeout=30, rpc_request_timeout=30,
+                 validation="jsonschema", codec="json", json_backend="auto"):
+        super().__init__(host, token, scheduler, attr_request_timeout, rpc_request_timeout, validation, json_backend)
+        if codec not in CODECS:
+            raise ValueError("Unknown codec '{}', expected one of {}".format(codec, tuple(CODECS)))
+        # Encodes the payloads of the messages published to the gateway API and decodes the ones received
+        self.codec = CODECS[codec](self._serializer)
         self.__max_sub_id = 0
         self.__sub_dict = {}
         self.__connected_devices = set("*")
@@ -31,21 +57,36 @@ class TBGatewayMqttClient(TBDeviceMqttClient):
         super()._on_connect(client, userdata, flags, rc, *extra_params)
         if rc == 0:
             self._client.subscribe(GATEWAY_ATTRIBUTES_TOPIC, qos=1)
-            self._client.subscribe(GATEWAY_ATTRIBUTES_RESPONSE_TOPIC + "/+")
-            self._client.subscribe(GATEWAY_RPC_TOPIC + "/+")
+            # ThingsBoard sends the responses and requests on these very topics, with no id level
+            self._client.subscribe(GATEWAY_ATTRIBUTES_RESPONSE_TOPIC)
+            self._client.subscribe(GATEWAY_RPC_TOPIC)
 
     def _on_message(self, client, userdata, message):
-        content = self._decode(message)
+        try:
+            content = self._decode(message)
+        except ValueError as e:
+            log.error("Unable to decode the message on '{}': {}".format(message.topic, e))
+            return
         super()._on_decoded_message(content, message)
         self._on_decoded_message(content, message)
 
+    def _decode(self, message):
+        message_type = _downlink_message_type(message.topic)
+        if message_type is None:
+            return super()._decode(message)
+        content = self.codec.decode(message_type, message.payload)
+        log.debug(content)
+        log.debug(message.topic)
+        return content
+
     def _on_decoded_message(self, content, message):
         if message.topic.startswith(GATEWAY_ATTRIBUTES_RESPONSE_TOPIC):
             with self._lock:
                 req_id = content["id"]
                 # pop callback and use it
-                if self._attr_request_dict[req_id]:
-                    self._attr_request_dict.pop(req_id)(content, None)
+                callback = self._pop_attr_request_callback(req_id)
+                if callback is not None:
+                    callback(content, None)
                 else:
                     log.error("Unable to find callback to process attributes response from TB")
         elif message.topic == GATEWAY_ATTRIBUTES_TOPIC:
@@ -69,48 +110,99 @@ class TBGatewayMqttClient(TBDeviceMqttClient):
             if self.__devices_server_side_rpc_request_handler:
                 self.__devices_server_side_rpc_request_handler(content)
 
-    def __request_attributes(self, device, keys, callback, type_is_client=False):
+    def __request_attributes(self, device, keys, callback, type_is_client=False, timeout=None):
         if not keys:
             log.error("There are no keys to request")
             return False
-        keys_str = ""
-        for key in keys:
-            keys_str += key + ","
-        keys_str = keys_str[:len(keys_str) - 1]
         ts_in_millis = int(round(time.time() * 1000))
         attr_request_number = self._add_attr_request_callback(callback)
-        msg = {"key": keys_str,
-               "device": device,
-               "client": type_is_client,
-               "id": attr_request_number}
-        info = self._client.publish(GATEWAY_ATTRIBUTES_REQUEST_TOPIC, dumps(msg), 1)
-        self._add_timeout(attr_request_number, ts_in_millis + 30000)
+        info = self._client.publish(GATEWAY_ATTRIBUTES_REQUEST_TOPIC,
+                                    self.codec.attributes_request(attr_request_number, device, type_is_client, keys), 1)
+        if timeout is None:
+            timeout = self.attr_request_timeout
+        self._add_timeout(attr_request_number, ts_in_millis + int(timeout * 1000))
         return info
 
-    def gw_request_shared_attributes(self, device_name, keys, callback):
-        return self.__request_attributes(device_name, keys, callback, False)
+    def gw_request_shared_attributes(self, device_name, keys, callback, timeout=None):
+        return self.__request_attributes(device_name, keys, callback, False, timeout)
 
-    def gw_request_client_attributes(self, device_name, keys, callback):
-        return self.__request_attributes(device_name, keys, callback, True)
+    def gw_request_client_attributes(self, device_name, keys, callback, timeout=None):
+        return self.__request_attributes(device_name, keys, callback, True, timeout)
 
     def gw_send_attributes(self, device, attributes, quality_of_service=1):
-        self.validate(KV_VALIDATOR, attributes)
-        return self.publish_data({device: attributes}, GATEWAY_MAIN_TOPIC + "attributes", quality_of_service)
+        self._validate(KV_VALIDATOR, attributes)
+        return self.__publish(self.codec.attributes({device: attributes}), GATEWAY_MAIN_TOPIC + "attributes", quality_of_service)
 
     def gw_send_telemetry(self, device, telemetry, quality_of_service=1):
         if type(telemetry) is not list:
             telemetry = [telemetry]
-        self.validate(DEVICE_TS_KV_VALIDATOR, telemetry)
-        return self.publish_data({device: telemetry}, GATEWAY_MAIN_TOPIC + "telemetry", quality_of_service, )
+        self._validate(DEVICE_TS_KV_VALIDATOR, telemetry)
+        return self.__publish(self.codec.telemetry({device: telemetry}), GATEWAY_MAIN_TOPIC + "telemetry", quality_of_service)
+
+    def gw_send_attributes_batch(self, attributes, quality_of_service=1):
+        """Send the attributes of several devices, {device: {key: value}}, in a single message.
+        The devices with invalid attributes are left out, None is returned if no device is left."""
+        attributes = self.__valid_devices(KV_VALIDATOR, attributes)
+        if not attributes:
+            return None
+        return self.__publish(self.codec.attributes(attributes), GATEWAY_MAIN_TOPIC + "attributes", quality_of_service)
+
+    def gw_send_telemetry_batch(self, telemetry, quality_of_service=1):
+        """Send the telemetry of several devices, {device: [{"ts": ts, "values": {key: value}}]}, in a single message.
+        The invalid records are left out, None is returned if no record is left."""
+        telemetry = self.__valid_records(telemetry)
+        if not telemetry:
+            return None
+        return self.__publish(self.codec.telemetry(telemetry), GATEWAY_MAIN_TOPIC + "telemetry", quality_of_service)
+
+    def __valid_devices(self, validator, batch):
+        if self.validation == "off":
+            return batch
+        valid = {}
+        for device, data in batch.items():
+            try:
+                self._validate(validator, data)
+            except ValidationError:
+                log.error("Leaving the invalid data of device '{}' out of the batch".format(device))
+                continue
+            valid[device] = data
+        return valid
+
+    def __valid_records(self, telemetry):
+        if self.validation == "off":
+            return telemetry
+        valid = {}
+        for device, records in telemetry.items():
+            if not isinstance(records, list):
+                valid.update(self.__valid_devices(DEVICE_TS_KV_VALIDATOR, {device: records}))
+                continue
+            valid_records = []
+            for record in records:
+                try:
+                    self._validate(TS_KV_VALIDATOR, record)
+                except ValidationError:
+                    continue
+                valid_records.append(record)
+            if len(valid_records) < len(records):
+                log.error("Leaving {} invalid records of device '{}' out of the batch".format(len(records) - len(valid_records), device))
+            if valid_records:
+                valid[device] = valid_records
+        return valid
+
+    def __publish(self, payload, topic, qos):
+        if qos != 0 and qos != 1:
+            log.exception("Quality of service (qos) value must be 0 or 1")
+            raise TBQoSException("Quality of service (qos) value must be 0 or 1")
+        return TBPublishInfo(self._client.publish(topic, payload, qos))
 
     def gw_connect_device(self, device_name):
-        info = self._client.publish(topic=GATEWAY_MAIN_TOPIC + "connect", payload=dumps({"device": device_name}), qos=1)
+        info = self._client.publish(topic=GATEWAY_MAIN_TOPIC + "connect", payload=self.codec.connect(device_name), qos=1)
         self.__connected_devices.add(device_name)
         log.debug("Connected device {name}".format(name=device_name))
         return info
 
     def gw_disconnect_device(self, device_name):
-        info = self._client.publish(topic=GATEWAY_MAIN_TOPIC + "disconnect", payload=dumps({"device": device_name}), qos=1)
+        info = self._client.publish(topic=GATEWAY_MAIN_TOPIC + "disconnect", payload=self.codec.disconnect(device_name), qos=1)
         self.__connected_devices.remove(device_name)
         log.debug("Disconnected device {name}".format(name=device_name))
         return info
@@ -151,6 +243,6 @@ class TBGatewayMqttClient(TBDeviceMqttClient):
             log.error("Quality of service (qos) value must be 0 or 1")
             return
         info = self._client.publish(GATEWAY_RPC_TOPIC,
-                                    dumps({"device": device, "id": req_id, "data": resp}),
+                                    self.codec.rpc_reply(device, req_id, resp),
                                     qos=quality_of_service)
         return info
@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# The heap is rebuilt without the cancelled calls once they are more than half of it
+COMPACT_MIN_SIZE = 64
+
+
+class ScheduledCall:
+    """Handle of a call registered in a Scheduler"""
+
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """O(1): the call is only marked, it is discarded when it reaches the top of the heap"""
+        self.cancelled = True
+
+
+class Scheduler:
+    """Runs the request timeouts of a client that is given no scheduler, from a single thread.
+
+    The calls are kept in a heap ordered by deadline and the thread sleeps until
+    the earliest one is due. Same interface as the gateway's scheduler.Scheduler,
+    without run_blocking(), which the clients don't use."""
+
+    def __init__(self, name="tb-scheduler"):
+        self.name = name
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__cancelled = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__running = False
+
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name=self.name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """Calls 'callback(*args)' once time.monotonic() reaches 'deadline'"""
+        call = ScheduledCall(deadline, callback, args)
+        with self.__condition:
+            heapq.heappush(self.__heap, (deadline, next(self.__counter), call))
+            if self.__heap[0][2] is call:
+                self.__condition.notify()
+        return call
+
+    def cancel(self, call):
+        if call is None or call.cancelled:
+            return
+        call.cancel()
+        with self.__condition:
+            self.__cancelled += 1
+            if self.__cancelled > COMPACT_MIN_SIZE and self.__cancelled * 2 > len(self.__heap):
+                self.__heap = [entry for entry in self.__heap if not entry[2].cancelled]
+                heapq.heapify(self.__heap)
+                self.__cancelled = 0
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__heap) - self.__cancelled
+
+    def __next_due(self):
+        """Waits for the next call due, returns None when stopped"""
+        with self.__condition:
+            while self.__running:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                deadline, _, call = self.__heap[0]
+                if call.cancelled:
+                    heapq.heappop(self.__heap)
+                    self.__cancelled = max(0, self.__cancelled - 1)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.__condition.wait(remaining)
+                    continue
+                heapq.heappop(self.__heap)
+                # Cancelling from now on has no effect
+                call.cancelled = True
+                return call
+        return None
+
+    def __run(self):
+        while True:
+            call = self.__next_due()
+            if call is None:
+                return
+            try:
+                call.callback(*call.args)
+            except Exception as e:
+                log.exception("Error in scheduled call {}: {}".format(call.callback, e))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: transport.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0ftransport.proto\x12\ttransport\"\x97\x01\n\rKeyValueProto\x12\x0b\n\x03key\x18\x01 \x01(\t\x12%\n\x04type\x18\x02 \x01(\x0e\x32\x17.transport.KeyValueType\x12\x0e\n\x06\x62ool_v\x18\x03 \x01(\x08\x12\x0e\n\x06long_v\x18\x04 \x01(\x03\x12\x10\n\x08\x64ouble_v\x18\x05 \x01(\x01\x12\x10\n\x08string_v\x18\x06 \x01(\t\x12\x0e\n\x06json_v\x18\x07 \x01(\t\"=\n\tTsKvProto\x12\n\n\x02ts\x18\x01 \x01(\x03\x12$\n\x02kv\x18\x02 \x01(\x0b\x32\x18.transport.KeyValueProto\"A\n\rTsKvListProto\x12\n\n\x02ts\x18\x01 \x01(\x03\x12$\n\x02kv\x18\x02 \x03(\x0b\x32\x18.transport.KeyValueProto\">\n\x10PostTelemetryMsg\x12*\n\x08tsKvList\x18\x01 \x03(\x0b\x32\x18.transport.TsKvListProto\"8\n\x10PostAttributeMsg\x12$\n\x02kv\x18\x01 \x03(\x0b\x32\x18.transport.KeyValueProto\"4\n\nConnectMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12\x12\n\ndeviceType\x18\x02 \x01(\t\"#\n\rDisconnectMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\"L\n\x0cTelemetryMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12(\n\x03msg\x18\x03 \x01(\x0b\x32\x1b.transport.PostTelemetryMsg\"M\n\rAttributesMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12(\n\x03msg\x18\x02 \x01(\x0b\x32\x1b.transport.PostAttributeMsg\";\n\x13GatewayTelemetryMsg\x12$\n\x03msg\x18\x01 \x03(\x0b\x32\x17.transport.TelemetryMsg\"=\n\x14GatewayAttributesMsg\x12%\n\x03msg\x18\x01 \x03(\x0b\x32\x18.transport.AttributesMsg\"[\n\x1bGatewayAttributesRequestMsg\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x12\n\ndeviceName\x18\x02 \x01(\t\x12\x0e\n\x06\x63lient\x18\x03 \x01(\x08\x12\x0c\n\x04keys\x18\x04 \x03(\t\"E\n\x15GatewayRpcResponseMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12\n\n\x02id\x18\x02 \x01(\x05\x12\x0c\n\x04\x64\x61ta\x18\x03 \x01(\t\"\xa1\x01\n\x17GetAttributeResponseMsg\x12\x11\n\trequestId\x18\x01 \x01(\x05\x12\x31\n\x13\x63lientAttributeList\x18\x02 \x03(\x0b\x32\x14.transport.TsKvProto\x12\x31\n\x13sharedAttributeList\x18\x03 \x03(\x0b\x32\x14.transport.TsKvProto\x12\r\n\x05\x65rror\x18\x05 \x01(\t\"d\n\x1e\x41ttributeUpdateNotificationMsg\x12+\n\rsharedUpdated\x18\x01 \x03(\x0b\x32\x14.transport.TsKvProto\x12\x15\n\rsharedDeleted\x18\x02 \x03(\t\"N\n\x15ToDeviceRpcRequestMsg\x12\x11\n\trequestId\x18\x01 \x01(\x05\x12\x12\n\nmethodName\x18\x02 \x01(\t\x12\x0e\n\x06params\x18\x03 \x01(\t\"K\n\x16ToServerRpcResponseMsg\x12\x11\n\trequestId\x18\x01 \x01(\x05\x12\x0f\n\x07payload\x18\x02 \x01(\t\x12\r\n\x05\x65rror\x18\x03 \x01(\t\"j\n\x1bGatewayAttributeResponseMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12\x37\n\x0bresponseMsg\x18\x02 \x01(\x0b\x32\".transport.GetAttributeResponseMsg\"\x7f\n%GatewayAttributeUpdateNotificationMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12\x42\n\x0fnotificationMsg\x18\x02 \x01(\x0b\x32).transport.AttributeUpdateNotificationMsg\"i\n\x1aGatewayDeviceRpcRequestMsg\x12\x12\n\ndeviceName\x18\x01 \x01(\t\x12\x37\n\rrpcRequestMsg\x18\x02 \x01(\x0b\x32 .transport.ToDeviceRpcRequestMsg*Q\n\x0cKeyValueType\x12\r\n\tBOOLEAN_V\x10\x00\x12\n\n\x06LONG_V\x10\x01\x12\x0c\n\x08\x44OUBLE_V\x10\x02\x12\x0c\n\x08STRING_V\x10\x03\x12\n\n\x06JSON_V\x10\x04\x42\x37\n$org.thingsboard.server.gen.transportB\x0fTransportProtosb\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'transport_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  DESCRIPTOR._serialized_options = b'\n$org.thingsboard.server.gen.transportB\017TransportProtos'
+  _KEYVALUETYPE._serialized_start=1739
+  _KEYVALUETYPE._serialized_end=1820
+  _KEYVALUEPROTO._serialized_start=31
+  _KEYVALUEPROTO._serialized_end=182
+  _TSKVPROTO._serialized_start=184
+  _TSKVPROTO._serialized_end=245
+  _TSKVLISTPROTO._serialized_start=247
+  _TSKVLISTPROTO._serialized_end=312
+  _POSTTELEMETRYMSG._serialized_start=314
+  _POSTTELEMETRYMSG._serialized_end=376
+  _POSTATTRIBUTEMSG._serialized_start=378
+  _POSTATTRIBUTEMSG._serialized_end=434
+  _CONNECTMSG._serialized_start=436
+  _CONNECTMSG._serialized_end=488
+  _DISCONNECTMSG._serialized_start=490
+  _DISCONNECTMSG._serialized_end=525
+  _TELEMETRYMSG._serialized_start=527
+  _TELEMETRYMSG._serialized_end=603
+  _ATTRIBUTESMSG._serialized_start=605
+  _ATTRIBUTESMSG._serialized_end=682
+  _GATEWAYTELEMETRYMSG._serialized_start=684
+  _GATEWAYTELEMETRYMSG._serialized_end=743
+  _GATEWAYATTRIBUTESMSG._serialized_start=745
+  _GATEWAYATTRIBUTESMSG._serialized_end=806
+  _GATEWAYATTRIBUTESREQUESTMSG._serialized_start=808
+  _GATEWAYATTRIBUTESREQUESTMSG._serialized_end=899
+  _GATEWAYRPCRESPONSEMSG._serialized_start=901
+  _GATEWAYRPCRESPONSEMSG._serialized_end=970
+  _GETATTRIBUTERESPONSEMSG._serialized_start=973
+  _GETATTRIBUTERESPONSEMSG._serialized_end=1134
+  _ATTRIBUTEUPDATENOTIFICATIONMSG._serialized_start=1136
+  _ATTRIBUTEUPDATENOTIFICATIONMSG._serialized_end=1236
+  _TODEVICERPCREQUESTMSG._serialized_start=1238
+  _TODEVICERPCREQUESTMSG._serialized_end=1316
+  _TOSERVERRPCRESPONSEMSG._serialized_start=1318
+  _TOSERVERRPCRESPONSEMSG._serialized_end=1393
+  _GATEWAYATTRIBUTERESPONSEMSG._serialized_start=1395
+  _GATEWAYATTRIBUTERESPONSEMSG._serialized_end=1501
+  _GATEWAYATTRIBUTEUPDATENOTIFICATIONMSG._serialized_start=1503
+  _GATEWAYATTRIBUTEUPDATENOTIFICATIONMSG._serialized_end=1630
+  _GATEWAYDEVICERPCREQUESTMSG._serialized_start=1632
+  _GATEWAYDEVICERPCREQUESTMSG._serialized_end=1737
+# @@protoc_insertion_point(module_scope)
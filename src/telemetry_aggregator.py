@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+import fnmatch
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AggregationRule(object):
+    """Channels matching the device and channel patterns are aggregated, and
+    with 'keep_raw' their samples are forwarded as well"""
+
+    __slots__ = ("device", "channel", "keep_raw")
+
+    def __init__(self, device="*", channel="*", keep_raw=False):
+        for name, pattern in (("device", device), ("channel", channel)):
+            if not isinstance(pattern, str):
+                raise ValueError("'{}' of an aggregation rule must be a pattern string, not {!r}".format(name, pattern))
+        if not isinstance(keep_raw, bool):
+            raise ValueError("'keep_raw' of an aggregation rule must be a boolean, not {!r}".format(keep_raw))
+        self.device = device
+        self.channel = channel
+        self.keep_raw = keep_raw
+
+    def matches(self, device, channel):
+        return fnmatch.fnmatchcase(device, self.device) and fnmatch.fnmatchcase(channel, self.channel)
+
+
+def parse_rules(rules):
+    """Builds the AggregationRules of an AGGREGATION_RULES setting, raises ValueError when one of them is invalid"""
+    parsed = []
+    for rule in rules or []:
+        if not isinstance(rule, dict):
+            raise ValueError("Invalid aggregation rule {!r}, expected an object".format(rule))
+        try:
+            parsed.append(AggregationRule(**rule))
+        except TypeError as e:
+            # Misspelled or unknown keys
+            raise ValueError("Invalid aggregation rule {!r}: {}".format(rule, e))
+    return parsed
+
+
+class TelemetryAggregator(object):
+    """Replaces the numeric samples of the channels matching a rule by one
+    record per window with their min, max, mean, last value and count, sent
+    as '{channel}.{aggregate}' keys through 'emit(device, values, ts)'.
+
+    The samples of a window are kept in an array('d') per channel, 8 bytes
+    each. The report-by-exception filter leaves the aggregated channels alone,
+    so every sample gets here."""
+
+    def __init__(self, emit, window=10, rules=None):
+        self.emit = emit
+        self.window = window
+        self.rules = parse_rules(rules)
+        self.__rule_cache = {}
+        self.__samples = {}
+        self.__lock = threading.Lock()
+        self.__scheduler = None
+        self.__timer = None
+        self.__running = False
+
+    def start(self, scheduler):
+        with self.__lock:
+            self.__scheduler = scheduler
+            self.__running = True
+            self.__timer = scheduler.call_later(self.window, self.__tick)
+
+    def stop(self):
+        # Under the lock, a tick running meanwhile can't schedule the next one
+        with self.__lock:
+            self.__running = False
+            if self.__scheduler is not None:
+                self.__scheduler.cancel(self.__timer)
+            self.__timer = None
+        self.flush()
+
+    def configure(self, window, rules=None):
+        """Applies new settings, the samples kept so far are aggregated first. Raises ValueError,
+        leaving the current settings in place, when one of the rules is invalid"""
+        rules = parse_rules(rules)
+        self.flush()
+        with self.__lock:
+            self.rules = rules
+            self.__rule_cache = {}
+            if window != self.window:
+                self.window = window
+                if self.__running:
+                    self.__scheduler.cancel(self.__timer)
+                    self.__timer = self.__scheduler.call_later(self.window, self.__tick)
+
+    def add(self, device, values):
+        """Keeps the samples to aggregate and returns the values to forward as they are"""
+        if not self.rules:
+            return values
+        raw = {}
+        with self.__lock:
+            for channel, value in values.items():
+                rule = self.__rule(device, channel)
+                if rule is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raw[channel] = value
+                    continue
+                samples = self.__samples.setdefault(device, {})
+                if channel not in samples:
+                    samples[channel] = array('d')
+                samples[channel].append(value)
+                if rule.keep_raw:
+                    raw[channel] = value
+        return raw
+
+    def flush(self):
+        with self.__lock:
+            windows, self.__samples = self.__samples, {}
+        ts = int(round(time.time() * 1000))
+        for device, channels in windows.items():
+            values = {}
+            for channel, samples in channels.items():
+                count = len(samples)
+                values["{}.min".format(channel)] = min(samples)
+                values["{}.max".format(channel)] = max(samples)
+                values["{}.mean".format(channel)] = math.fsum(samples) / count
+                values["{}.last".format(channel)] = samples[-1]
+                values["{}.count".format(channel)] = count
+            try:
+                self.emit(device, values, ts)
+            except Exception as e:
+                logger.error("Error sending the aggregated telemetry of '{}': {}".format(device, e))
+
+    def __rule(self, device, channel):
+        key = (device, channel)
+        if key not in self.__rule_cache:
+            self.__rule_cache[key] = next((rule for rule in self.rules if rule.matches(device, channel)), None)
+        return self.__rule_cache[key]
+
+    def __tick(self):
+        with self.__lock:
+            if not self.__running:
+                return
+            self.__timer = self.__scheduler.call_later(self.window, self.__tick)
+        self.flush()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import metrics
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rough per-value overhead of the JSON encoding ('"key": value, ') used to
+# estimate the size of a pending batch without serializing it
+VALUE_OVERHEAD_BYTES = 24
+# The window grows up to this many times the observed publish latency
+LATENCY_FACTOR = 4
+# Weight of the newest latency sample in the moving average
+LATENCY_SMOOTHING = 0.2
+
+# Batches the gateway could neither send nor store
+SAMPLES_DROPPED = metrics.counter("thingsboard_samples_dropped",
+                                  "Telemetry records and attribute updates dropped as they could be neither sent nor stored",
+                                  per_device=True)
+
+
+class TelemetryBatcher(object):
+    """Collects telemetry and attribute updates from all devices and hands them
+    to 'flush_handler(telemetry, attributes)' in a single batch when the time
+    window, the sample count or the (estimated) byte size limit is reached."""
+
+    def __init__(self, flush_handler, window=0.2, max_window=2.0, max_samples=500, max_bytes=65536):
+        self.flush_handler = flush_handler
+        self.min_window = window
+        self.max_window = max(window, max_window)
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.window = window
+        self.latency = None
+        self.__telemetry = {}
+        self.__attributes = {}
+        self.__samples = 0
+        self.__bytes = 0
+        self.__deadline = None
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__running = False
+
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = threading.Thread(target=self.__flush_loop, name="telemetry-batcher")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def configure(self, window, max_window, max_samples, max_bytes):
+        """Applies new limits, from the next sample on"""
+        with self.__condition:
+            self.min_window = window
+            self.max_window = max(window, max_window)
+            self.max_samples = max_samples
+            self.max_bytes = max_bytes
+            self.window = min(self.max_window, max(self.min_window, self.window))
+
+    def add_telemetry(self, device, ts, values):
+        with self.__condition:
+            self.__telemetry.setdefault(device, []).append({ "ts": ts, "values": values })
+            self.__account(device, values)
+
+    def add_attributes(self, device, values):
+        with self.__condition:
+            self.__attributes.setdefault(device, {}).update(values)
+            self.__account(device, values)
+
+    def report_latency(self, latency):
+        """Feeds an observed publish latency (in seconds) back into the window:
+        a slow uplink gets wider windows and therefore fewer, larger publishes."""
+        with self.__condition:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.window = min(self.max_window, max(self.min_window, self.latency * LATENCY_FACTOR))
+
+    def flush(self):
+        with self.__condition:
+            telemetry, attributes = self.__take()
+        self.__dispatch(telemetry, attributes)
+
+    def __account(self, device, values):
+        self.__samples += 1
+        self.__bytes += len(device) + VALUE_OVERHEAD_BYTES * len(values) + sum(len(key) for key in values)
+        if self.__deadline is None:
+            self.__deadline = time.monotonic() + self.window
+            self.__condition.notify()
+        elif self.__samples >= self.max_samples or self.__bytes >= self.max_bytes:
+            self.__deadline = 0
+            self.__condition.notify()
+
+    def __take(self):
+        telemetry, attributes = self.__telemetry, self.__attributes
+        self.__telemetry = {}
+        self.__attributes = {}
+        self.__samples = 0
+        self.__bytes = 0
+        self.__deadline = None
+        return telemetry, attributes
+
+    def __dispatch(self, telemetry, attributes):
+        if not telemetry and not attributes:
+            return
+        try:
+            self.flush_handler(telemetry, attributes)
+        except Exception as e:
+            # The handler stores what it can't send, only what it can't store either gets here
+            for device, records in telemetry.items():
+                SAMPLES_DROPPED.inc(len(records), device)
+            for device in attributes:
+                SAMPLES_DROPPED.inc(1, device)
+            logger.exception("Error flushing telemetry batch, dropping it: {}".format(e))
+
+    def __flush_loop(self):
+        while True:
+            with self.__condition:
+                while self.__running:
+                    if self.__deadline is None:
+                        self.__condition.wait()
+                        continue
+                    remaining = self.__deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(remaining)
+                if not self.__running:
+                    return
+                telemetry, attributes = self.__take()
+            self.__dispatch(telemetry, attributes)
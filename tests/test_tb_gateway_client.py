@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Uplink and downlink round trip of the gateway client through the stand-in broker, with each codec.
+
+The broker plays ThingsBoard: it reads back what the client publishes (connect,
+telemetry, attributes, attribute requests, RPC replies) and sends it the
+downlink messages (RPC requests, attribute updates, attribute responses)
+encoded as ThingsBoard encodes them for the codec.
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+
+from fake_broker import FakeBroker, publish_packet
+import tb_proto
+from tb_mqtt_client.tb_gateway_codec import CODECS
+from tb_mqtt_client.tb_gateway_mqtt import TBGatewayMqttClient
+
+DEVICE = "device-00001"
+TIMEOUT = 5
+
+
+class JsonThingsBoard(object):
+    """Payloads of the gateway API in JSON, as ThingsBoard reads and writes them"""
+
+    def connect(self, payload):
+        return json.loads(payload)
+
+    def telemetry(self, payload):
+        return json.loads(payload)
+
+    def attributes(self, payload):
+        return json.loads(payload)
+
+    def attributes_request_id(self, payload):
+        return json.loads(payload)["id"]
+
+    def rpc_reply(self, payload):
+        return json.loads(payload)
+
+    def rpc_request(self, device, request_id, method, params):
+        return json.dumps({"device": device, "data": {"id": request_id, "method": method, "params": params}}).encode("utf-8")
+
+    def attributes_update(self, device, values):
+        return json.dumps({"device": device, "data": values}).encode("utf-8")
+
+    def attributes_response(self, device, request_id, values):
+        return json.dumps({"id": request_id, "device": device, "values": values}).encode("utf-8")
+
+
+class ProtobufThingsBoard(object):
+    """Payloads of the gateway API in protobuf, with the classes generated from src/tb_mqtt_client/transport.proto"""
+
+    def connect(self, payload):
+        return tb_proto.decode_connect(payload)
+
+    def telemetry(self, payload):
+        return tb_proto.decode_gateway_telemetry(payload)
+
+    def attributes(self, payload):
+        return tb_proto.decode_gateway_attributes(payload)
+
+    def attributes_request_id(self, payload):
+        return tb_proto.decode_attributes_request(payload)["id"]
+
+    def rpc_reply(self, payload):
+        return tb_proto.decode_rpc_reply(payload)
+
+    def rpc_request(self, device, request_id, method, params):
+        return tb_proto.encode_gateway_rpc_request(device, request_id, method, params)
+
+    def attributes_update(self, device, values):
+        return tb_proto.encode_gateway_attributes_update(device, values, ts=int(time.time() * 1000))
+
+    def attributes_response(self, device, request_id, values):
+        return tb_proto.encode_gateway_attributes_response(device, request_id, shared=values, ts=int(time.time() * 1000))
+
+
+class ThingsBoardBroker(FakeBroker):
+    """ThingsBoard handles the gateway API messages, it doesn't forward them to the subscribers"""
+
+    def route(self, topic, payload, retain=False):
+        if self.on_publish is not None:
+            self.on_publish(topic, payload)
+
+    def publish(self, topic, payload, retain=False):
+        data = publish_packet(topic, payload)
+        for session in self.sessions:
+            if session.matches(topic):
+                session.send(data)
+
+
+THINGSBOARD = {
+    "json": JsonThingsBoard,
+    "protobuf": ProtobufThingsBoard,
+}
+
+
+async def wait_for(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def round_trip(codec):
+    thingsboard = THINGSBOARD[codec]()
+    published = {}
+
+    def on_publish(topic, payload):
+        published.setdefault(topic, []).append(payload)
+
+    def last(topic):
+        return published.get(topic, [None])[-1]
+
+    broker = ThingsBoardBroker(on_publish=on_publish)
+    await broker.start()
+    client = TBGatewayMqttClient("127.0.0.1", codec=codec)
+    rpc_requests = []
+    attribute_updates = []
+    attribute_responses = []
+    client.gw_set_server_side_rpc_request_handler(rpc_requests.append)
+    client.connect(port=broker.port)
+    try:
+        # Connected once the gateway topics are subscribed, after the device ones
+        assert await wait_for(lambda: broker.sessions and "v1/gateway/rpc" in broker.sessions[0].subscriptions)
+
+        # Uplink
+        client.gw_connect_device(DEVICE)
+        assert await wait_for(lambda: last("v1/gateway/connect") is not None)
+        assert thingsboard.connect(last("v1/gateway/connect"))["device"] == DEVICE
+        telemetry = [{"ts": 1500000000000, "values": {"temperature": 21.5, "count": 7, "on": True, "label": "a"}}]
+        client.gw_send_telemetry(DEVICE, telemetry)
+        assert await wait_for(lambda: last("v1/gateway/telemetry") is not None)
+        assert thingsboard.telemetry(last("v1/gateway/telemetry")) == {DEVICE: telemetry}
+        attributes = {"firmware": "1.2.3", "slots": 4}
+        client.gw_send_attributes(DEVICE, attributes)
+        assert await wait_for(lambda: last("v1/gateway/attributes") is not None)
+        assert thingsboard.attributes(last("v1/gateway/attributes")) == {DEVICE: attributes}
+
+        # Downlink, RPC request and its reply
+        params = {"pin": 3, "on": True}
+        broker.publish("v1/gateway/rpc", thingsboard.rpc_request(DEVICE, 42, "setPin", params))
+        assert await wait_for(lambda: rpc_requests)
+        assert rpc_requests[0] == {"device": DEVICE, "data": {"id": 42, "method": "setPin", "params": params}}
+        client.gw_send_rpc_reply(DEVICE, 42, {"success": True})
+        assert await wait_for(lambda: last("v1/gateway/rpc") is not None)
+        assert thingsboard.rpc_reply(last("v1/gateway/rpc")) == {"device": DEVICE, "id": 42, "data": {"success": True}}
+
+        # Downlink, attribute update
+        client.gw_subscribe_to_all_device_attributes(DEVICE, attribute_updates.append)
+        update = {"interval": 30, "mode": "eco"}
+        broker.publish("v1/gateway/attributes", thingsboard.attributes_update(DEVICE, update))
+        assert await wait_for(lambda: attribute_updates)
+        assert attribute_updates[0] == update
+
+        # Downlink, attribute request and its response
+        client.gw_request_shared_attributes(DEVICE, ["interval"], lambda content, error: attribute_responses.append(content))
+        assert await wait_for(lambda: last("v1/gateway/attributes/request") is not None)
+        request_id = thingsboard.attributes_request_id(last("v1/gateway/attributes/request"))
+        broker.publish("v1/gateway/attributes/response", thingsboard.attributes_response(DEVICE, request_id, {"interval": 30}))
+        assert await wait_for(lambda: attribute_responses)
+        assert attribute_responses[0]["values"] == {"interval": 30}
+
+        # A malformed message is skipped, the next ones still handled
+        broker.publish("v1/gateway/rpc", b"\xff\xff\xff")
+        broker.publish("v1/gateway/rpc", thingsboard.rpc_request(DEVICE, 43, "getPin", {"pin": 3}))
+        assert await wait_for(lambda: len(rpc_requests) == 2)
+        assert rpc_requests[1]["data"]["id"] == 43
+    finally:
+        client.disconnect()
+        await broker.stop()
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_round_trip(codec):
+    asyncio.run(round_trip(codec))
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Encoding and decoding of each gateway API message of transport.proto"""
+
+import json
+import struct
+
+import pytest
+
+import tb_proto
+from tb_mqtt_client import tb_gateway_codec as codec
+from tb_mqtt_client import transport_pb2
+from tb_mqtt_client.tb_gateway_codec import (_bytes_field, _key, _key_value, _string_field, _varint_field,
+                                             JsonGatewayCodec, ProtobufGatewayCodec)
+
+DEVICE = "device-00001"
+TS = 1500000000000
+
+KEY_VALUES = [
+    ("bool_false", False, codec.BOOLEAN_V),
+    ("bool_true", True, codec.BOOLEAN_V),
+    ("long_zero", 0, codec.LONG_V),
+    ("long", 7, codec.LONG_V),
+    ("long_negative", -7, codec.LONG_V),
+    ("long_max", codec.INT64_MAX, codec.LONG_V),
+    ("long_min", codec.INT64_MIN, codec.LONG_V),
+    ("double_zero", 0.0, codec.DOUBLE_V),
+    ("double", 21.5, codec.DOUBLE_V),
+    ("double_negative", -0.125, codec.DOUBLE_V),
+    ("double_big_int", 2 ** 70, codec.DOUBLE_V),
+    ("string_empty", "", codec.STRING_V),
+    ("string", "ñandú", codec.STRING_V),
+    ("json_dict", {"a": [1, 2]}, codec.JSON_V),
+    ("json_list", [1, "b"], codec.JSON_V),
+]
+
+
+def dumps(value):
+    return json.dumps(value).encode("utf-8")
+
+
+@pytest.fixture
+def protobuf():
+    return ProtobufGatewayCodec()
+
+
+@pytest.mark.parametrize("key, value, kv_type", KEY_VALUES, ids=[key for key, _, _ in KEY_VALUES])
+def test_key_value(key, value, kv_type):
+    encoded = _key_value(key, value, dumps)
+    assert transport_pb2.KeyValueProto.FromString(encoded).type == kv_type
+    expected = float(value) if kv_type == codec.DOUBLE_V else value
+    assert codec._read_key_value(encoded, json.loads) == (key, expected)
+    assert tb_proto.decode_key_value(encoded) == (key, expected)
+    assert codec._read_key_value(tb_proto.key_value(key, value).SerializeToString(), json.loads) == (key, expected)
+
+
+def test_connect(protobuf):
+    assert tb_proto.decode_connect(protobuf.connect(DEVICE)) == {"device": DEVICE}
+    assert tb_proto.decode_connect(protobuf.connect(DEVICE, "sensor")) == {"device": DEVICE, "type": "sensor"}
+
+
+def test_disconnect(protobuf):
+    assert tb_proto.decode_disconnect(protobuf.disconnect(DEVICE)) == {"device": DEVICE}
+
+
+def test_telemetry(protobuf):
+    records = [{"ts": TS, "values": {key: value for key, value, _ in KEY_VALUES}},
+               {"ts": TS + 1000, "values": {"temperature": 22.0}}]
+    telemetry = {DEVICE: records, "device-00002": [{"ts": TS, "values": {"count": 1}}]}
+    decoded = tb_proto.decode_gateway_telemetry(protobuf.telemetry(telemetry))
+    assert decoded == json.loads(json.dumps(telemetry))
+
+
+def test_telemetry_without_timestamp(protobuf):
+    decoded = tb_proto.decode_gateway_telemetry(protobuf.telemetry({DEVICE: {"temperature": 21.5}}))
+    assert decoded == {DEVICE: [{"ts": 0, "values": {"temperature": 21.5}}]}
+
+
+def test_attributes(protobuf):
+    attributes = {DEVICE: {"firmware": "1.2.3", "slots": 4, "enabled": True}, "device-00002": {"ratio": 0.5}}
+    assert tb_proto.decode_gateway_attributes(protobuf.attributes(attributes)) == attributes
+
+
+def test_attributes_request(protobuf):
+    assert tb_proto.decode_attributes_request(protobuf.attributes_request(12, DEVICE, True, ["interval", "mode"])) == {
+        "id": 12, "device": DEVICE, "client": True, "key": "interval,mode"}
+    # The default values are left out, as protobuf serializes them
+    request = transport_pb2.GatewayAttributesRequestMsg(id=13, deviceName=DEVICE, keys=["interval"])
+    assert protobuf.attributes_request(13, DEVICE, False, ["interval"]) == request.SerializeToString()
+
+
+def test_rpc_reply(protobuf):
+    encoded = protobuf.rpc_reply(DEVICE, 42, {"success": True})
+    assert tb_proto.decode_rpc_reply(encoded) == {"device": DEVICE, "id": 42, "data": {"success": True}}
+
+
+def test_gateway_rpc_request(protobuf):
+    params = {"pin": 3, "on": True}
+    payload = tb_proto.encode_gateway_rpc_request(DEVICE, 42, "setPin", params)
+    assert protobuf.decode(codec.GATEWAY_RPC_REQUEST, payload) == {
+        "device": DEVICE, "data": {"id": 42, "method": "setPin", "params": params}}
+
+
+def test_gateway_attributes_update(protobuf):
+    update = {"interval": 30, "mode": "eco"}
+    payload = tb_proto.encode_gateway_attributes_update(DEVICE, update, ["old"], TS)
+    assert protobuf.decode(codec.GATEWAY_ATTRIBUTES_UPDATE, payload) == {
+        "device": DEVICE, "data": dict(update, deleted=["old"])}
+
+
+def test_gateway_attributes_response(protobuf):
+    payload = tb_proto.encode_gateway_attributes_response(DEVICE, 7, {"serial": "A1"}, {"interval": 30}, TS)
+    assert protobuf.decode(codec.GATEWAY_ATTRIBUTES_RESPONSE, payload) == {
+        "id": 7, "device": DEVICE, "values": {"serial": "A1", "interval": 30}}
+
+
+def test_gateway_attributes_response_single_value(protobuf):
+    payload = tb_proto.encode_gateway_attributes_response(DEVICE, 8, shared={"interval": 30}, ts=TS)
+    assert protobuf.decode(codec.GATEWAY_ATTRIBUTES_RESPONSE, payload) == {
+        "id": 8, "device": DEVICE, "values": {"interval": 30}, "value": 30}
+
+
+def test_rpc_request(protobuf):
+    assert protobuf.decode(codec.RPC_REQUEST, tb_proto.encode_rpc_request(5, "reboot", {"delay": 1})) == {
+        "method": "reboot", "params": {"delay": 1}}
+
+
+def test_rpc_response(protobuf):
+    assert protobuf.decode(codec.RPC_RESPONSE, tb_proto.encode_rpc_response(5, payload='{"ok": true}')) == {"ok": True}
+    assert protobuf.decode(codec.RPC_RESPONSE, tb_proto.encode_rpc_response(5, error="timeout")) == {"error": "timeout"}
+
+
+def test_attributes_update(protobuf):
+    assert protobuf.decode(codec.ATTRIBUTES_UPDATE, tb_proto.encode_attributes_update({"interval": 30}, ts=TS)) == {"interval": 30}
+
+
+def test_attributes_response(protobuf):
+    payload = tb_proto.encode_attributes_response(9, client={"serial": "A1"}, error="partial", ts=TS)
+    assert protobuf.decode(codec.ATTRIBUTES_RESPONSE, payload) == {
+        "client": {"serial": "A1"}, "shared": {}, "error": "partial"}
+
+
+def test_unknown_fields_skipped(protobuf):
+    payload = (_string_field(1, DEVICE) + _key(9, codec.FIXED32) + struct.pack("<f", 1.0)
+               + _bytes_field(2, tb_proto.encode_rpc_request(1, "ping", {})) + _varint_field(15, 3))
+    assert protobuf.decode(codec.GATEWAY_RPC_REQUEST, payload)["data"]["method"] == "ping"
+
+
+@pytest.mark.parametrize("message_type", sorted(codec._DOWNLINK_READERS))
+@pytest.mark.parametrize("payload", [b"\x0a\x10abc", b"\xff\xff\xff", b"\x0b"], ids=["truncated", "varint", "wire type"])
+def test_malformed_downlink(protobuf, message_type, payload):
+    with pytest.raises(ValueError):
+        protobuf.decode(message_type, payload)
+
+
+def test_json_codec():
+    json_codec = JsonGatewayCodec()
+    assert json.loads(json_codec.connect(DEVICE, "sensor")) == {"device": DEVICE, "type": "sensor"}
+    assert json.loads(json_codec.disconnect(DEVICE)) == {"device": DEVICE}
+    assert json.loads(json_codec.attributes_request(3, DEVICE, False, ["a", "b"])) == {
+        "key": "a,b", "device": DEVICE, "client": False, "id": 3}
+    assert json.loads(json_codec.rpc_reply(DEVICE, 4, "done")) == {"device": DEVICE, "id": 4, "data": "done"}
+    assert json_codec.decode(codec.GATEWAY_RPC_REQUEST, b'{"device": "d", "data": {}}') == {"device": "d", "data": {}}